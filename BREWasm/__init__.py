@@ -1,3 +1,4 @@
+from BREWasm.version import __version__
 from BREWasm.rewriter.BREWasm import BREWasm
 from BREWasm.rewriter.section_rewriter import *
 from BREWasm.rewriter.semantics_rewriter import *
\ No newline at end of file
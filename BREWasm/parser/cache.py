@@ -0,0 +1,143 @@
+import hashlib
+import marshal
+import os
+import zlib
+from array import array
+
+from ..parser.snapshot import dump_snapshot, load_snapshot, array_bytes, bytes_array
+from ..version import __version__
+
+CacheMagic = b"BREWasmC"
+
+
+class ParseCache:
+    # Decoded modules kept in directory, one file per module named by the sha256 of the library version and
+    # the bytes of the wasm file, so an entry is only ever found for the same bytes parsed by the same
+    # release. An entry is the snapshot of the module (BREWasm.parser.snapshot), so the bodies become
+    # Instruction trees on first access; until they are edited they are emitted from the bytes of the wasm
+    # file as after a parse.
+    #
+    # Entries are evicted least recently used first once the directory holds more than max_bytes; a hit
+    # refreshes the mtime of its entry. hits, misses and evictions count the lookups of this object.
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, data):
+        digest = hashlib.sha256(__version__.encode("utf-8"))
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def load(self, data, flyweight=False):
+        # the module decoded from data, or None on a miss
+        key = self.get_key(data)
+        path = self.get_entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            module = self.loads(blob, key, data, flyweight)
+        except Exception:
+            # truncated or foreign entry, parsed and stored again
+            self.remove_entry(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return module
+
+    def store(self, data, module):
+        # module has to be freshly decoded from data
+        key = self.get_key(data)
+        path = self.get_entry_path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(self.dumps(module, key, data))
+            os.replace(tmp_path, path)
+        except BaseException:
+            # a full disk or a module without a snapshot, no entry is left half written
+            self.remove_entry(tmp_path)
+            raise
+        self.evict()
+
+    def dumps(self, module, key, data):
+        # the snapshot of the module, with the offsets of the bodies in data to emit them from
+        bodies = array('Q')
+        for code in module.code_sec:
+            bodies.append(code._body_start)
+            bodies.append(code._body_end)
+        entry = marshal.dumps((__version__, key, array_bytes(bodies), dump_snapshot(module)), 4)
+        # the columns repeat a lot, level 1 shrinks them tenfold or more at little cost on either side
+        return CacheMagic + zlib.compress(entry, 1)
+
+    def loads(self, blob, key, data, flyweight=False):
+        if blob[:len(CacheMagic)] != CacheMagic:
+            raise Exception("not a cache entry")
+        version, entry_key, bodies, snapshot = marshal.loads(zlib.decompress(memoryview(blob)[len(CacheMagic):]))
+        if version != __version__ or entry_key != key:
+            raise Exception("cache entry of other bytes")
+        module = load_snapshot(snapshot, flyweight)
+        bodies = bytes_array('Q', bodies)
+        if len(bodies) != 2 * len(module.code_sec):
+            raise Exception("malformed cache entry")
+        view = memoryview(data)
+        for i, code in enumerate(module.code_sec):
+            body_start, body_end = bodies[2 * i], bodies[2 * i + 1]
+            if body_end > body_start:
+                code.set_raw_body(view[body_start:body_end])
+            code._body_start, code._body_end = body_start, body_end
+        return module
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if self.remove_entry(path):
+                self.evictions += 1
+            total -= size
+
+    @staticmethod
+    def remove_entry(path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+    def get_size(self):
+        # (entries, bytes) in the directory
+        entries = 0
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                entries += 1
+                total += os.path.getsize(os.path.join(self.directory, name))
+        return entries, total
@@ -0,0 +1,183 @@
+from array import array
+from collections import Counter
+from itertools import compress
+
+from ..parser.instruction import Instruction, BlockArgs, IfArgs, get_shared_instruction
+from ..parser.opcodes import Block, Loop, If, Else_, End_
+from ..parser.opnames import opcode_table, ImmNone, ImmBlock, ImmIf, ImmBrTable, ImmF32, ImmF64, ImmV128, \
+    ImmTableArg, ImmMemArg, ImmMemLaneArg
+from ..parser.walker import Walker
+
+FlatImmNone = 0
+FlatImmInt = 1
+FlatImmExtra = 2
+FlatImmBlock = 3
+
+# opcode -> how its immediate is kept in the imms column: nothing, the integer itself, the index of the
+# immediate object in extra, or the block type
+flat_imm_kinds = {}
+for _opcode, _info in opcode_table.items():
+    if _info.imm == ImmNone:
+        flat_imm_kinds[_opcode] = FlatImmNone
+    elif _info.imm in (ImmBlock, ImmIf):
+        flat_imm_kinds[_opcode] = FlatImmBlock
+    elif _info.imm in (ImmBrTable, ImmF32, ImmF64, ImmV128, ImmTableArg, ImmMemArg, ImmMemLaneArg):
+        flat_imm_kinds[_opcode] = FlatImmExtra
+    else:
+        flat_imm_kinds[_opcode] = FlatImmInt
+
+
+class FlatCode:
+    # A function body as parallel columns, one row per instruction in binary order with explicit Else_ and
+    # End_ rows (the End_ of the expr itself is left out, as in SectionRewriter.get_flat_instrs):
+    #
+    #   opcodes  array('I') opcode
+    #   imms     array('q') integer immediate (index, constant, lane, block type), or for br_table, float,
+    #            v128 and memory/table immediates the index of the immediate object in extra; 0 without one
+    #   depths   array('I') nesting depth, the Else_ and End_ rows of a block at the depth of the block
+    #   matches  array('I') Block/Loop -> its End_, If -> its Else_ or End_, Else_ -> the End_,
+    #            End_ -> the Block/Loop/If it closes; 0 for the other rows
+    #   extra    the immediate objects too large or too structured for imms
+    #
+    # Analyses scan the columns instead of walking Instruction objects; the arrays support the buffer
+    # protocol, so numpy.frombuffer views them without a copy where NumPy is around. from_expr and to_expr
+    # convert from and to the tree without loss; the objects in extra are shared with the tree, not copied.
+
+    def __init__(self):
+        self.opcodes = array('I')
+        self.imms = array('q')
+        self.depths = array('I')
+        self.matches = array('I')
+        self.extra = []
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def copy(self):
+        flat = FlatCode()
+        flat.opcodes = array('I', self.opcodes)
+        flat.imms = array('q', self.imms)
+        flat.depths = array('I', self.depths)
+        flat.matches = array('I', self.matches)
+        flat.extra = list(self.extra)
+        return flat
+
+    @staticmethod
+    def from_expr(expr):
+        flat = FlatCode()
+        opcodes, imms, depths, matches, extra = flat.opcodes, flat.imms, flat.depths, flat.matches, flat.extra
+        kinds = flat_imm_kinds
+        # [opener row, row waiting for its match] of the blocks being walked
+        open_blocks = []
+
+        def flatten_run(instrs):
+            depth = len(open_blocks)
+            for instr in instrs:
+                opcode = instr.opcode
+                kind = kinds[opcode]
+                opcodes.append(opcode)
+                depths.append(depth)
+                matches.append(0)
+                if kind == FlatImmNone:
+                    imms.append(0)
+                elif kind == FlatImmInt:
+                    imms.append(instr.args)
+                elif kind == FlatImmExtra:
+                    imms.append(len(extra))
+                    extra.append(instr.args)
+                else:
+                    imms.append(instr.args.bt)
+                    row = len(opcodes) - 1
+                    open_blocks.append([row, row])
+                    return instr
+            return None
+
+        def flatten_else(instr):
+            if instr.args.instrs2:
+                entry = open_blocks[-1]
+                matches[entry[1]] = len(opcodes)
+                entry[1] = len(opcodes)
+                opcodes.append(Else_)
+                imms.append(0)
+                depths.append(len(open_blocks) - 1)
+                matches.append(0)
+
+        def flatten_end(instr):
+            opener, pending = open_blocks.pop()
+            matches[pending] = len(opcodes)
+            opcodes.append(End_)
+            imms.append(0)
+            depths.append(len(open_blocks))
+            matches.append(opener)
+
+        Walker.walk_runs(expr, flatten_run, (flatten_else,), (flatten_end,))
+        return flat
+
+    def to_expr(self, flyweight=False):
+        # flyweight: the instructions without immediates are the shared ones of get_shared_instruction
+        opcodes, imms, extra = self.opcodes, self.imms, self.extra
+        kinds = flat_imm_kinds
+        expr = []
+        instrs = expr
+        # [block instr, list the block was appended to] of the open blocks
+        stack = []
+        for row in range(len(opcodes)):
+            opcode = opcodes[row]
+            kind = kinds[opcode]
+            if opcode == End_ and stack:
+                instrs = stack.pop()[1]
+            elif opcode == Else_:
+                if not stack or stack[-1][0].opcode != If:
+                    raise Exception("else outside of if")
+                instrs = stack[-1][0].args.instrs2
+            elif kind == FlatImmNone:
+                instrs.append(get_shared_instruction(opcode) if flyweight else Instruction(opcode))
+            elif kind == FlatImmInt:
+                instrs.append(Instruction(opcode, imms[row]))
+            elif kind == FlatImmExtra:
+                instrs.append(Instruction(opcode, extra[imms[row]]))
+            else:
+                if opcode == If:
+                    args = IfArgs()
+                    args.bt = imms[row]
+                    body = args.instrs1
+                else:
+                    args = BlockArgs(imms[row], [])
+                    body = args.instrs
+                instr = Instruction(opcode, args)
+                instrs.append(instr)
+                stack.append((instr, instrs))
+                instrs = body
+        if stack:
+            raise Exception("block without end")
+        return expr
+
+    def get_histogram(self):
+        # opcode -> number of rows, Else_ and End_ included
+        return Counter(self.opcodes)
+
+    def find(self, opcodes):
+        # the rows of an opcode or a list of them
+        if isinstance(opcodes, (list, tuple, set, frozenset)):
+            return list(compress(range(len(self.opcodes)), map(frozenset(opcodes).__contains__, self.opcodes)))
+        # array.index does the scanning between the rows found
+        rows = []
+        row = -1
+        find = self.opcodes.index
+        try:
+            while True:
+                row = find(opcodes, row + 1)
+                rows.append(row)
+        except ValueError:
+            return rows
+
+    def remap(self, opcodes, fn):
+        # replace the integer immediate x of the rows of opcodes with fn(x); returns the number changed
+        imms = self.imms
+        changed = 0
+        for row in self.find(opcodes):
+            new_idx = fn(imms[row])
+            if new_idx != imms[row]:
+                imms[row] = new_idx
+                changed += 1
+        return changed
@@ -1,13 +1,15 @@
-from ..parser.opnames import opnames
+from ..parser.opnames import opcode_table
 
 
 class Expr(list):
+    __slots__ = ()
 
     def __init__(self):
         super().__init__()
 
 
 class Instruction:
+    __slots__ = ("opcode", "args")
 
     def __init__(self, opcode=None, args=None):
         self.opcode = opcode
@@ -15,13 +17,15 @@ class Instruction:
         self.args = args
 
     def get_opname(self):
-        return opnames[self.opcode]
+        info = opcode_table.get(self.opcode)
+        return info.name if info is not None else ""
 
     def __str__(self):
-        return opnames[self.opcode]
+        return self.get_opname()
 
 
 class BlockArgs:
+    __slots__ = ("bt", "instrs")
 
     def __init__(self, bt=None, instrs=None):
         self.bt = bt
@@ -30,6 +34,7 @@ class BlockArgs:
 
 
 class IfArgs:
+    __slots__ = ("bt", "instrs1", "instrs2")
 
     def __init__(self):
         self.bt = None
@@ -38,6 +43,7 @@ class IfArgs:
 
 
 class BrTableArgs:
+    __slots__ = ("labels", "default")
 
     def __init__(self, labels=None, default=None):
         if labels is None:
@@ -48,13 +54,16 @@ class BrTableArgs:
 
 
 class MemArg:
+    __slots__ = ("align", "offset")
 
     def __init__(self, align=0, offset=0):
         self.align = align
 
         self.offset = offset
 
+
 class TableArg:
+    __slots__ = ("x", "y")
 
     def __init__(self, x=0, y=0):
         self.x = x
@@ -62,7 +71,21 @@ class TableArg:
 
 
 class MemLaneArg:
+    __slots__ = ("mem_arg", "laneidx")
 
     def __init__(self, mem_arg=None, laneidx=0):
         self.mem_arg = mem_arg
-        self.laneidx = laneidx
\ No newline at end of file
+        self.laneidx = laneidx
+
+
+# opcode -> the Instruction shared by every occurrence of an opcode without immediates, handed out by
+# get_shared_instruction to readers decoding with flyweight set. A shared instruction is never edited in
+# place; rewriters put a new Instruction in its slot instead
+shared_instructions = {}
+
+
+def get_shared_instruction(opcode):
+    instr = shared_instructions.get(opcode)
+    if instr is None:
+        instr = shared_instructions[opcode] = Instruction(opcode)
+    return instr
@@ -1,14 +1,19 @@
 from ..parser.errors import *
 
 
+# The last byte of a size-bit LEB128 value is byte size // 7 (0-based), it must not continue and
+# must not carry bits beyond size.
+
 def decode_var_uint(reader, size: int):
     result = 0
     i = 0
     while True:
         a = reader.read(1)
-        b = int.from_bytes(a, "little")
+        if not a:
+            raise ErrUnexpectedEnd
+        b = a[0]
 
-        if i == size / 7:
+        if i == size // 7:
             if b & 0x80 != 0:
                 raise ErrIntTooLong
             if b >> (size - i * 7) > 0:
@@ -17,58 +22,99 @@ def decode_var_uint(reader, size: int):
         if b & 0x80 == 0:
             return result, i + 1
         i += 1
-    raise ErrUnexpectedEnd
 
 
 def decode_var_uint111(data, size: int):
+    return decode_var_uint_at(data, 0, size)
+
+
+def decode_var_int(reader, size):
     result = 0
     i = 0
     while True:
-        b = int.from_bytes(data[:1], "little")
-        data = data[1:]
+        a = reader.read(1)
+        if not a:
+            raise ErrUnexpectedEnd
+        b = a[0]
 
-        if i == size / 7:
+        if i == size // 7:
             if b & 0x80 != 0:
                 raise ErrIntTooLong
-            if b >> (size - i * 7) > 0:
+            if b & 0x40 == 0 and b >> (size - i * 7 - 1) != 0 or \
+                    b & 0x40 != 0 and ((b | 0x80) - 0x100) >> (size - i * 7 - 1) != -1:
                 raise ErrIntTooLarge
         result |= (b & 0x7f) << (i * 7)
         if b & 0x80 == 0:
+            if (i * 7 < size) and (b & 0x40 != 0):
+                result |= -1 << ((i + 1) * 7)
             return result, i + 1
         i += 1
-    raise ErrUnexpectedEnd
 
 
-def decode_var_int(reader, size):
-    result = 0
-    i = 0
+def decode_var_uint_from_data(data, size: int):
+    return decode_var_uint_at(data, 0, size)
+
+
+def decode_var_uint_at(data, pos: int, size: int):
+    # decode the unsigned value starting at data[pos], returns (value, byte count)
+    try:
+        b = data[pos]
+        if b < 0x80:
+            return b, 1
+        b2 = data[pos + 1]
+        if b2 < 0x80:
+            return (b & 0x7f) | (b2 << 7), 2
+    except IndexError:
+        raise ErrUnexpectedEnd
+
+    # the first two bytes both continue, size // 7 >= 2 for every size in use
+    result = (b & 0x7f) | ((b2 & 0x7f) << 7)
+    i = 2
     while True:
-        b = int.from_bytes(reader.read(1), "little")
+        if pos + i >= len(data):
+            raise ErrUnexpectedEnd
+        b = data[pos + i]
 
-        if i == size / 7:
+        if i == size // 7:
             if b & 0x80 != 0:
                 raise ErrIntTooLong
-            if b & 0x40 == 0 and b >> (size - i * 7 - 1) != 0 or \
-                    b & 0x40 != 0 and int(b | 0x80) >> (size - i * 7 - 1) != -1:
+            if b >> (size - i * 7) > 0:
                 raise ErrIntTooLarge
         result |= (b & 0x7f) << (i * 7)
         if b & 0x80 == 0:
-            if (i * 7 < size) and (b & 0x40 != 0):
-                result |= -1 << ((i + 1) * 7)
             return result, i + 1
         i += 1
-    raise ErrUnexpectedEnd
 
 
-def decode_var_uint_from_data(data, size: int):
-    result = 0
-    for i, b in enumerate(data):
-        if i == size / 7:
+def decode_var_int_at(data, pos: int, size: int):
+    # decode the signed value starting at data[pos], returns (value, byte count)
+    try:
+        b = data[pos]
+        if b < 0x80:
+            return (b - 0x80 if b & 0x40 else b), 1
+        b2 = data[pos + 1]
+        if b2 < 0x80:
+            result = (b & 0x7f) | (b2 << 7)
+            return (result - 0x4000 if b2 & 0x40 else result), 2
+    except IndexError:
+        raise ErrUnexpectedEnd
+
+    result = (b & 0x7f) | ((b2 & 0x7f) << 7)
+    i = 2
+    while True:
+        if pos + i >= len(data):
+            raise ErrUnexpectedEnd
+        b = data[pos + i]
+
+        if i == size // 7:
             if b & 0x80 != 0:
                 raise ErrIntTooLong
-            if b >> (size - i * 7) > 0:
+            if b & 0x40 == 0 and b >> (size - i * 7 - 1) != 0 or \
+                    b & 0x40 != 0 and ((b | 0x80) - 0x100) >> (size - i * 7 - 1) != -1:
                 raise ErrIntTooLarge
         result |= (b & 0x7f) << (i * 7)
         if b & 0x80 == 0:
+            if (i * 7 < size) and (b & 0x40 != 0):
+                result |= -1 << ((i + 1) * 7)
             return result, i + 1
-    raise ErrUnexpectedEnd
+        i += 1
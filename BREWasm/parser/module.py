@@ -1,3 +1,6 @@
+import os
+
+from ..parser.flat_code import FlatCode
 from ..parser.types import BlockTypeI32, BlockTypeI64, BlockTypeF32, BlockTypeF64, BlockTypeEmpty, FuncType, \
     ValTypeI32, ValTypeI64, ValTypeF32, ValTypeF64
 
@@ -31,6 +34,23 @@ SecDataID = 11
 
 SecDataCountID = 12
 
+# section id -> the Module attribute holding it
+section_attrs = {
+    SecCustomID: "custom_secs",
+    SecTypeID: "type_sec",
+    SecImportID: "import_sec",
+    SecFuncID: "func_sec",
+    SecTableID: "table_sec",
+    SecMemID: "mem_sec",
+    SecGlobalID: "global_sec",
+    SecExportID: "export_sec",
+    SecStartID: "start_sec",
+    SecElemID: "elem_sec",
+    SecCodeID: "code_sec",
+    SecDataID: "data_sec",
+    SecDataCountID: "datacount_sec",
+}
+
 ImportTagFunc = 0
 ImportTagTable = 1
 ImportTagMem = 2
@@ -96,6 +116,227 @@ class Module:
         for i in range(12):
             self.section_range.append(SectionRange())
 
+        # the file the module was decoded from, section_range points into it while it is unchanged
+        self.source_path = None
+        self.source_stat = None
+        # ids of the sections changed by the rewriters, the others are copied from the source file on emit.
+        # Edits made directly on the module lists have to be reported with mark_dirty
+        self.dirty_secs = set()
+        # ids of the sections of the source file skipped by decode_file(sections=...), each attribute holds
+        # an UndecodedSection and the section is only ever copied from the source file
+        self.undecoded_secs = set()
+
+        # indexes behind the keyed selects of SectionRewriter, built on first use, extended on append and
+        # dropped on any other change of their section:
+        # (param types, result types) -> [typeidx], (module, name) -> [importidx], export name -> [exportidx]
+        self._type_index = None
+        self._import_index = None
+        self._export_index = None
+        # (import count, imports of each kind by ImportTag, index of each import in the space of its kind),
+        # rebuilt when the import count changes and dropped with the import index
+        self._import_counts = None
+
+        # the Transaction open on the module, rewriter calls are queued on it until it commits
+        self._transaction = None
+        # XrefIndex of the code section once enabled, see BREWasm.rewriter.xref
+        self.xref = None
+        # (memoryview, mmap) of the source file of a module decoded with mapped=True, until close
+        self._mapping = None
+
+    def set_source(self, path, stat=None):
+        self.source_path = path
+        self.source_stat = stat if stat is not None else get_stat_key(path)
+        self.dirty_secs = set()
+
+    def set_mapping(self, view, mapping):
+        self._mapping = (view, mapping)
+
+    def close(self):
+        # Release the mapping of a module decoded with decode_file(mapped=True). What the module still holds
+        # of the file (bodies, data segments, custom sections) is copied first, so the module stays usable
+        # and the file can be replaced. Also called by emit_binary before it replaces the source file
+        if self._mapping is None:
+            return
+        view, mapping = self._mapping
+        self._mapping = None
+        copy = None
+        if self.is_decoded(SecCodeID):
+            for code in self.code_sec:
+                if code._source is not None and get_view_base(code._source) is mapping:
+                    if copy is None:
+                        copy = view.tobytes()
+                    code._source = copy
+                elif code._encoded is not None and get_view_base(code._encoded) is mapping:
+                    if copy is None:
+                        copy = view.tobytes()
+                    code._encoded = memoryview(copy)[code._body_start:code._body_end]
+        if self.is_decoded(SecDataID):
+            for data in self.data_sec:
+                data.init = copy_view(data.init, mapping)
+        if self.is_decoded(SecCustomID):
+            for custom_sec in self.custom_secs:
+                custom_sec.custom_sec_data = copy_view(custom_sec.custom_sec_data, mapping)
+                if custom_sec.name_data is not None:
+                    for name in NameData.__slots__:
+                        setattr(custom_sec.name_data, name, copy_view(getattr(custom_sec.name_data, name), mapping))
+        view.release()
+        try:
+            mapping.close()
+        except BufferError:
+            raise Exception("views of %s taken from the module are still in use, the file stays mapped until "
+                            "they are released" % self.source_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def has_source(self):
+        if self.source_path is None:
+            return False
+        try:
+            return get_stat_key(self.source_path) == self.source_stat
+        except OSError:
+            return False
+
+    def mark_dirty(self, sec_id):
+        if sec_id in self.undecoded_secs:
+            raise Exception("section %s was not decoded" % section_attrs[sec_id])
+        self.dirty_secs.add(sec_id)
+
+    def set_undecoded(self, sec_id):
+        self.undecoded_secs.add(sec_id)
+        setattr(self, section_attrs[sec_id], UndecodedSection(section_attrs[sec_id]))
+
+    def is_decoded(self, sec_id):
+        return sec_id not in self.undecoded_secs
+
+    def invalidate_codes(self, codes=None):
+        # encode the bodies of codes (all of them by default) again on the next emit instead of copying them
+        self.mark_dirty(SecCodeID)
+        for code in self.code_sec if codes is None else codes:
+            code.invalidate()
+
+    def get_type_index(self):
+        # (signature of every type, signature -> [typeidx]); signatures are tuples of "i32"/"i64"/"f32"/"f64"
+        if self._type_index is None or len(self._type_index[0]) != len(self.type_sec):
+            self._type_index = [], {}
+            for functype in self.type_sec:
+                self.add_type_index(functype)
+        return self._type_index
+
+    def add_type_index(self, functype):
+        signatures, index = self._type_index
+        param_types, result_types = functype.get_signature()
+        signature = (tuple(param_types), tuple(result_types))
+        index.setdefault(signature, []).append(len(signatures))
+        signatures.append(signature)
+
+    def get_import_index(self):
+        # function imports only
+        if self._import_index is None or self._import_index[0] != len(self.import_sec):
+            self._import_index = 0, {}
+            for import_item in self.import_sec:
+                self.add_import_index(import_item)
+        return self._import_index[1]
+
+    def add_import_index(self, import_item):
+        size, index = self._import_index
+        if import_item.desc.func_type is not None:
+            index.setdefault((import_item.module, import_item.name), []).append(size)
+        self._import_index = size + 1, index
+
+    def get_import_counts(self):
+        if self._import_counts is None or self._import_counts[0] != len(self.import_sec):
+            self._import_counts = 0, [0, 0, 0, 0], []
+            for import_item in self.import_sec:
+                self.add_import_count(import_item)
+        return self._import_counts[1]
+
+    def add_import_count(self, import_item):
+        size, counts, space_idx = self._import_counts
+        space_idx.append(counts[import_item.desc.tag])
+        counts[import_item.desc.tag] += 1
+        self._import_counts = size + 1, counts, space_idx
+
+    def get_import_func_num(self):
+        return self.get_import_counts()[ImportTagFunc]
+
+    def get_import_table_num(self):
+        return self.get_import_counts()[ImportTagTable]
+
+    def get_import_mem_num(self):
+        return self.get_import_counts()[ImportTagMem]
+
+    def get_import_global_num(self):
+        return self.get_import_counts()[ImportTagGlobal]
+
+    def get_import_space_idx(self, importidx):
+        # index of the import in the index space of its kind, the funcidx of a function import
+        self.get_import_counts()
+        return self._import_counts[2][importidx]
+
+    def get_export_index(self):
+        if self._export_index is None or self._export_index[0] != len(self.export_sec):
+            self._export_index = 0, {}
+            for export_item in self.export_sec:
+                self.add_export_index(export_item)
+        return self._export_index[1]
+
+    def add_export_index(self, export_item):
+        size, index = self._export_index
+        index.setdefault(export_item.name, []).append(size)
+        self._export_index = size + 1, index
+
+    def index_appended(self, sec_id):
+        # the last item of the section was appended, extend its index if it has been built for the rest
+        if sec_id == SecTypeID and self._type_index is not None:
+            if len(self._type_index[0]) == len(self.type_sec) - 1:
+                self.add_type_index(self.type_sec[-1])
+        elif sec_id == SecImportID:
+            if self._import_index is not None and self._import_index[0] == len(self.import_sec) - 1:
+                self.add_import_index(self.import_sec[-1])
+            if self._import_counts is not None and self._import_counts[0] == len(self.import_sec) - 1:
+                self.add_import_count(self.import_sec[-1])
+        elif sec_id == SecExportID and self._export_index is not None:
+            if self._export_index[0] == len(self.export_sec) - 1:
+                self.add_export_index(self.export_sec[-1])
+
+    def drop_index(self, sec_id):
+        if sec_id == SecTypeID:
+            self._type_index = None
+        elif sec_id == SecImportID:
+            self._import_index = None
+            self._import_counts = None
+        elif sec_id == SecExportID:
+            self._export_index = None
+
+    def is_clean(self, sec_id):
+        # the section is still the byte range recorded in section_range of the source file
+        if self.source_path is None or sec_id in self.dirty_secs:
+            return False
+        if sec_id in self.undecoded_secs:
+            return True
+        if sec_id == SecCustomID:
+            return len(self.custom_secs) == len(self.section_range[SecCustomID]) != 0
+        if sec_id == SecCodeID and any(code.get_raw_body() is None for code in self.code_sec):
+            # a body was handed out through Code.locals / Code.expr and may have been edited in place
+            return False
+        sec_range = self.section_range[sec_id]
+        return sec_range.end > sec_range.start
+
+    def dump_snapshot(self):
+        # the module as bytes in the snapshot format of BREWasm.parser.snapshot
+        from ..parser.snapshot import dump_snapshot
+        return dump_snapshot(self)
+
+    @staticmethod
+    def load_snapshot(data, flyweight=False):
+        from ..parser.snapshot import load_snapshot
+        return load_snapshot(data, flyweight)
+
     def get_block_type(self, bt):
 
         if bt == BlockTypeI32:
@@ -112,7 +353,40 @@ class Module:
             return self.type_sec[bt]
 
 
+class UndecodedSection:
+    # Stands in for a section left undecoded by decode_file(sections=...): emit copies it from the source
+    # file as it is, any use of its contents raises
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def fail(self, *args, **kwargs):
+        raise Exception("section %s was not decoded" % self.name)
+
+    __len__ = __iter__ = __getitem__ = __setitem__ = __delitem__ = __contains__ = __bool__ = fail
+    append = insert = extend = pop = remove = index = count = clear = copy = fail
+
+
+def get_view_base(value):
+    # the object a memoryview is a view of, None for anything else
+    return value.obj if isinstance(value, memoryview) else None
+
+
+def copy_view(value, mapping):
+    # value as bytes when it is a view of mapping, unchanged otherwise
+    if get_view_base(value) is mapping:
+        return value.tobytes()
+    return value
+
+
+def get_stat_key(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
 class SectionRange:
+    __slots__ = ("start", "end", "name")
 
     def __init__(self, start=0, end=0, name=None):
         self.start = start
@@ -122,6 +396,7 @@ class SectionRange:
 
 
 class CustomSec:
+    __slots__ = ("name", "custom_sec_data", "name_data")
 
     def __init__(self, name="", custom_sec_data=None, name_data=None):
         self.name = name
@@ -130,6 +405,9 @@ class CustomSec:
 
 
 class NameData:
+    __slots__ = ("moduleNameSubSec", "funcNameSubSec", "localNameSubSec", "labelsNameSubSec", "typeNameSubSec",
+                 "tableNameSubSec", "memoryNameSubSec", "globalNameSubSec", "elemNameSubSec", "dataNameSubSec")
+
     def __init__(self, moduleNameSubSec=None, funcNameSubSec=None, globalNameSubSec=None, dataNameSubSec=None,
                  tableNameSubSec=None,
                  local_bytes=None, labels_bytes=None, type_bytes=None, memory_bytes=None, elem_bytes=None):
@@ -165,6 +443,7 @@ class NameData:
 
 
 class Import:
+    __slots__ = ("module", "name", "desc")
 
     def __init__(self, module="", name="", desc=None):
         self.module = module
@@ -175,6 +454,7 @@ class Import:
 
 
 class ImportDesc:
+    __slots__ = ("tag", "func_type", "table", "mem", "global_type")
 
     def __init__(self, tag, func_type=None, table=None, mem=None, global_type=None):
         self.tag = tag
@@ -185,6 +465,7 @@ class ImportDesc:
 
 
 class Global:
+    __slots__ = ("type", "init")
 
     def __init__(self, global_type=None, init=None):
         self.type = global_type
@@ -192,6 +473,7 @@ class Global:
 
 
 class Export:
+    __slots__ = ("name", "desc")
 
     def __init__(self, name="", export_desc=None):
         self.name = name
@@ -199,6 +481,7 @@ class Export:
 
 
 class ExportDesc:
+    __slots__ = ("tag", "idx")
 
     def __init__(self, tag=0, idx=0):
         self.tag = tag
@@ -206,6 +489,7 @@ class ExportDesc:
 
 
 class Elem:
+    __slots__ = ("table", "offset", "init")
 
     def __init__(self, table_idx=0, offset_expr=None, vec_init=None):
         if vec_init is None:
@@ -216,21 +500,155 @@ class Elem:
 
 
 class Code:
+    # A function body. emit copies a body decoded from a file from its bytes (get_raw_body) for as long as
+    # its locals and expr were not handed out: reading code.locals or code.expr drops the bytes, since the
+    # lists may be edited in place, and the body is encoded again from then on. Readers inside the library
+    # that leave the body as it is, or report their changes with invalidate(), use peek_locals/peek_expr
+    __slots__ = ("_locals", "_expr", "_source", "_body_start", "_body_end", "_encoded", "_flyweight", "_flat")
 
     def __init__(self, locals_vec=None, expr=None):
         if locals_vec is None:
             locals_vec = []
-        self.locals = locals_vec
-        self.expr = expr
+        self._locals = locals_vec
+        self._expr = expr
+        # lazily decoded body: source[body_start:body_end] holds the undecoded locals and expr. The offsets
+        # of the body in the file stay set once it is decoded
+        self._source = None
+        self._body_start = 0
+        self._body_end = 0
+        # expr kept as a FlatCode (loaded from a ParseCache) until it is first accessed
+        self._flat = None
+        # decode the lazy body with shared instructions for the opcodes without immediates
+        self._flyweight = False
+        # the bytes of the body in the file it was decoded from, None once locals or expr were handed out
+        self._encoded = None
+
+    @staticmethod
+    def lazy(source, body_start, body_end, flyweight=False):
+        code = Code()
+        code._source = source
+        code._body_start = body_start
+        code._body_end = body_end
+        code._flyweight = flyweight
+        return code
+
+    @staticmethod
+    def from_flat(locals_vec, flat, encoded=None, flyweight=False):
+        # a body whose expr is built from flat on first access; encoded is its encoded body if known
+        code = Code(locals_vec)
+        code._flat = flat
+        code._encoded = encoded
+        code._flyweight = flyweight
+        return code
+
+    @property
+    def locals(self):
+        self.decode()
+        self._encoded = None
+        return self._locals
+
+    @locals.setter
+    def locals(self, locals_vec):
+        if self._source is not None:
+            self.decode()
+        self._locals = locals_vec
+        self._encoded = None
+
+    @property
+    def expr(self):
+        self.decode()
+        self._encoded = None
+        return self._expr
+
+    @expr.setter
+    def expr(self, expr):
+        if self._source is not None:
+            self.decode()
+        self._flat = None
+        self._expr = expr
+        self._encoded = None
+
+    def peek_locals(self):
+        # the locals, keeping the bytes of the body
+        self.decode()
+        return self._locals
+
+    def peek_expr(self):
+        # the expr, keeping the bytes of the body
+        self.decode()
+        return self._expr
+
+    def is_decoded(self) -> bool:
+        return self._source is None and self._flat is None
+
+    def decode(self):
+        if self._flat is not None:
+            self._expr = self._flat.to_expr(self._flyweight)
+            self._flat = None
+            return
+        if self._source is None:
+            return
+        from ..parser.reader import decode_code_body
+        self._locals, self._expr = decode_code_body(self._source, self._body_start, self._body_end,
+                                                      self._flyweight)
+        self._encoded = memoryview(self._source)[self._body_start:self._body_end]
+        self._source = None
+        if self.get_local_count() >= (1 << 32 - 1):
+            raise Exception("too many locals: %d" % self.get_local_count())
+
+    def get_raw_body(self):
+        # the encoded body (locals and expr) in the file it was decoded from, None if it has to be encoded
+        if self._source is None:
+            return self._encoded
+        return self._source[self._body_start:self._body_end]
+
+    def set_raw_body(self, body):
+        self._encoded = body
+
+    def invalidate(self):
+        # drop the encoded body after the locals or expr were edited in place through peek_locals/peek_expr
+        if self._source is None:
+            self._encoded = None
+
+    def __getstate__(self):
+        # the source and the encoded body are views of the file, which pickle cannot take: a body not
+        # decoded yet is decoded and the encoded body copied
+        if self._source is not None:
+            self.decode()
+        state = {name: getattr(self, name) for name in Code.__slots__}
+        if isinstance(self._encoded, memoryview):
+            state["_encoded"] = self._encoded.tobytes()
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def get_flat(self):
+        # the expr as a FlatCode, decoded straight from the source bytes while it is not decoded yet
+        return self.get_flat_body()[1]
+
+    def get_flat_body(self):
+        # (locals, expr as a FlatCode) without building the expr of a body not decoded yet
+        if self._flat is not None:
+            return self._locals, self._flat.copy()
+        if self._source is not None:
+            from ..parser.reader import decode_flat_code_body
+            return decode_flat_code_body(self._source, self._body_start, self._body_end)
+        return self._locals, FlatCode.from_expr(self._expr)
+
+    def set_flat(self, flat):
+        self.expr = flat.to_expr()
 
     def get_local_count(self) -> int:
         n = 0
-        for locals_item in self.locals:
+        for locals_item in self.peek_locals():
             n += locals_item.n
         return n
 
 
 class Locals:
+    __slots__ = ("n", "type")
 
     def __init__(self, local_count=0, val_type=0):
         self.n = local_count
@@ -242,6 +660,7 @@ class Locals:
 
 
 class Data:
+    __slots__ = ("mem", "offset", "init")
 
     def __init__(self, mem_idx=0, offset_expr=None, vec_init=None):
         if vec_init is None:
@@ -1,6 +1,14 @@
 from ..parser.opcodes import *
 
-opnames = [""] * 0xFFFFFF
+
+# opcode -> name, an undefined opcode maps to ""
+class OpNames(dict):
+
+    def __missing__(self, opcode):
+        return ""
+
+
+opnames = OpNames()
 
 opnames[Unreachable] = "unreachable"
 opnames[Nop] = "nop"
@@ -458,3 +466,87 @@ opnames[I32x4TruncSatF64x2SZero] =  "i32x4.trunc_sat_f64x2_s_zero"
 opnames[I32x4TruncSatF64x2UZero] =  "i32x4.trunc_sat_f64x2_u_zero"
 opnames[F64x2ConvertLowI32x4S  ] =  "f64x2.convert_low_i32x4_s"
 opnames[F64x2ConvertLowI32x4U  ] =  "f64x2.convert_low_i32x4_u"
+
+
+# immediate kinds, one per shape of Instruction.args produced by WasmReader.read_args
+ImmNone = 0
+ImmBlock = 1
+ImmIf = 2
+ImmBrTable = 3
+ImmCallIndirect = 4
+ImmVarU32 = 5
+ImmVarS32 = 6
+ImmVarS64 = 7
+ImmF32 = 8
+ImmF64 = 9
+ImmV128 = 10
+ImmLane = 11
+ImmZero = 12
+ImmTableArg = 13
+ImmMemArg = 14
+ImmMemLaneArg = 15
+
+
+class OpcodeInfo:
+
+    def __init__(self, opcode, name, imm=ImmNone, prefix_len=1):
+        self.opcode = opcode
+        self.name = name
+        self.imm = imm
+        self.prefix_len = prefix_len
+        # the encoded opcode, e.g. b"\xfd\xe0\x01" for f32x4.abs
+        self.prefix = opcode.to_bytes(prefix_len, 'big')
+
+
+def get_prefix_len(opcode) -> int:
+    if opcode < 0x100:
+        return 1
+    elif opcode < 0x10000:
+        return 2
+    else:
+        return 3
+
+
+def get_imm_kind(opcode) -> int:
+    if opcode in [Block, Loop]:
+        return ImmBlock
+    elif opcode == If:
+        return ImmIf
+    elif opcode == BrTable:
+        return ImmBrTable
+    elif opcode == CallIndirect:
+        return ImmCallIndirect
+    elif opcode in [Br, BrIf, Call, LocalGet, LocalSet, LocalTee, GlobalGet, GlobalSet, RefNull, RefFunc,
+                    MemoryInit, DataDrop, ElemDrop, TableGrow, TableSize, TableFill]:
+        return ImmVarU32
+    elif opcode in [MemorySize, MemoryGrow]:
+        return ImmZero
+    elif opcode == I32Const:
+        return ImmVarS32
+    elif opcode == I64Const:
+        return ImmVarS64
+    elif opcode == F32Const:
+        return ImmF32
+    elif opcode == F64Const:
+        return ImmF64
+    elif opcode in [V128Const, I8x16Shuffle]:
+        return ImmV128
+    elif I8x16ExtractLaneS <= opcode <= F64x2ReplaceLane:
+        return ImmLane
+    elif opcode in [TableInit, TableCopy]:
+        return ImmTableArg
+    elif V128Load <= opcode <= V128Store or opcode in [V128Load32Zero, V128Load64Zero]:
+        return ImmMemArg
+    elif V128Load8Lane <= opcode <= V128Store64Lane:
+        return ImmMemLaneArg
+    elif I32Load <= opcode <= I64Store32:
+        return ImmMemArg
+    else:
+        return ImmNone
+
+
+# opcode -> OpcodeInfo, the registry used by the reader, the encoder and the dumper
+opcode_table = {}
+for _opcode, _name in opnames.items():
+    opcode_table[_opcode] = OpcodeInfo(_opcode, _name, get_imm_kind(_opcode), get_prefix_len(_opcode))
+del _opcode, _name
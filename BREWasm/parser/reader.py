@@ -1,13 +1,20 @@
 import ctypes
+import mmap
+import os
 import struct
+from concurrent.futures import ProcessPoolExecutor
 
-from ..parser.instruction import Instruction, BlockArgs, IfArgs, BrTableArgs, MemArg, TableArg, MemLaneArg
+from ..parser.instruction import Instruction, BlockArgs, IfArgs, BrTableArgs, MemArg, TableArg, MemLaneArg, \
+    get_shared_instruction
 from ..parser.module import Import, ImportDesc, ImportTagFunc, ImportTagTable, ImportTagMem, ImportTagGlobal, \
     Global, Export, ExportDesc, ExportTagFunc, ExportTagTable, ExportTagMem, ExportTagGlobal, Elem, Code, Locals, \
     Data, MagicNumber, Version, Module, SecCustomID, SecDataID, CustomSec, SecTypeID, SecImportID, SecFuncID, \
-    SecTableID, SecMemID, SecGlobalID, SecExportID, SecStartID, SecElemID, SecCodeID, SecDataCountID, NameData, SectionRange
+    SecTableID, SecMemID, SecGlobalID, SecExportID, SecStartID, SecElemID, SecCodeID, SecDataCountID, NameData, SectionRange, \
+    get_stat_key
 from ..parser.opcodes import *
-from ..parser.opnames import opnames
+from ..parser.flat_code import FlatCode, flat_imm_kinds, FlatImmNone, FlatImmInt, FlatImmExtra, FlatImmBlock
+from ..parser.opnames import opcode_table, ImmNone, ImmBlock, ImmIf, ImmBrTable, ImmCallIndirect, ImmVarU32, \
+    ImmVarS32, ImmVarS64, ImmF32, ImmF64, ImmV128, ImmLane, ImmZero, ImmTableArg, ImmMemArg, ImmMemLaneArg
 from ..parser.types import ValTypeI32, ValTypeI64, ValTypeF32, ValTypeF64, ValTypeV128, FuncType, FtTag, TableType, \
     FuncRef, \
     GlobalType, MutConst, MutVar, Limits, BlockTypeI32, BlockTypeI64, BlockTypeF32, BlockTypeF64, BlockTypeEmpty, \
@@ -15,44 +22,259 @@ from ..parser.types import ValTypeI32, ValTypeI64, ValTypeF32, ValTypeF64, ValTy
 from ..parser.leb128 import *
 
 
-def decode_file(file_name: str):
-    data, err = None, None
-    try:
-        f = open(file_name, 'rb+')
-        data = f.read()
-        f.seek(0)
-    except Exception as e:
-        err = e
-
-    if err is not None:
-        return Module(), err
-
-    return decode(data, f)
+def decode_file(file_name: str, buffered=False, mapped=False, lazy=False, workers=1, flyweight=False, cache=None,
+                sections=None):
+    # mapped: parse from a read-only mmap of the file; data segments, opaque custom sections and raw
+    # name subsections stay memoryview slices into the mapping instead of copies. The module owns the
+    # mapping: release it with module.close() or `with module:` once done, the module stays usable
+    # lazy: function bodies are only decoded on first access of Code.locals / Code.expr
+    # workers: decode function bodies in a pool of that many processes
+    # flyweight: every occurrence of an opcode without immediates (nop, i32.add, ...) is one shared
+    # Instruction, see get_shared_instruction
+    # cache: a ParseCache the module is loaded from when it holds the same bytes, and stored in otherwise
+    # sections: the ids of the sections to decode, the others are skipped over and only copied on emit (see
+    # UndecodedSection); SecCustomID stands for all the custom sections. A module decoded in part is not
+    # stored in the cache, a hit gives the whole module
+    if mapped:
+        try:
+            with open(file_name, 'rb') as f:
+                stat = get_stat_key(file_name)
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception as e:
+            return Module(), e
+        data, f, zero_copy = memoryview(mapping), None, True
+    else:
+        data, err = None, None
+        try:
+            f = open(file_name, 'rb+')
+            stat = get_stat_key(file_name)
+            data = f.read()
+            f.seek(0)
+            if buffered:
+                f.close()
+                f = None
+        except Exception as e:
+            err = e
+
+        if err is not None:
+            return Module(), err
+        zero_copy = False
+
+    module = cache.load(data, flyweight) if cache is not None else None
+    if module is not None:
+        err = None
+        if f is not None:
+            f.close()
+    else:
+        module, err = decode(data, f, zero_copy=zero_copy, lazy=lazy, workers=workers, flyweight=flyweight,
+                             sections=sections)
+        if err is None and cache is not None and sections is None:
+            cache.store(data, module)
+
+    if err is None:
+        module.set_source(file_name, stat)
+        if mapped:
+            # the module owns the mapping from here on, see Module.close
+            module.set_mapping(data, mapping)
+    elif mapped:
+        data.release()
+        try:
+            mapping.close()
+        except BufferError:
+            # views taken by the failed decode, the mapping is closed when they are collected
+            pass
+    return module, err
 
 
-def decode(data, f):
+def decode(data, f=None, zero_copy=False, lazy=False, workers=1, flyweight=False, sections=None):
+    # with no file object the module is parsed straight from data by WasmBufferReader
     module, err = None, None
     try:
         module = Module()
-        reader = WasmReader(data, f)
+        if f is None:
+            reader = WasmBufferReader(data, zero_copy)
+        else:
+            reader = WasmReader(data, f)
+        reader.lazy = lazy
+        reader.workers = workers
+        reader.flyweight = flyweight
+        reader.sections = sections
         reader.read_module(module)
 
-        f.close()
+        if f is not None:
+            f.close()
     except Exception as e:
         err = e
     return module, err
 
 
+def iter_sections(path_or_buffer, flyweight=False):
+    # the sections of a wasm file or buffer one at a time, as (section id, (start, end), payload), without
+    # building a Module:
+    #   custom          the CustomSec
+    #   code            one item per body: its (start, end) after the size prefix and a lazy Code over it
+    #   data            one item per segment: its (start, end) and the Data
+    #   start/datacount the index or count
+    #   the others      the list Module keeps for the section
+    # The range of a section covers its id and size prefix as in Module.section_range. A file is mapped,
+    # not read, and the payloads are views of the mapping, so a scan that breaks off early reads no further
+    # and one over the whole file holds no more than the items it keeps. The mapping is closed when the scan
+    # ends or is closed, or once the last item kept of it is collected
+    mapping = None
+    if isinstance(path_or_buffer, (str, os.PathLike)):
+        with open(path_or_buffer, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(mapping)
+    else:
+        data = memoryview(path_or_buffer)
+    try:
+        reader = WasmBufferReader(data, zero_copy=True)
+        reader.lazy = True
+        reader.flyweight = flyweight
+        yield from reader.iter_sections()
+    finally:
+        data.release()
+        if mapping is not None:
+            try:
+                mapping.close()
+            except BufferError:
+                # items kept by the caller are views of it
+                pass
+
+
+def decode_code_body(data, start, end, flyweight=False):
+    reader = WasmBufferReader(data)
+    reader.flyweight = flyweight
+    reader.seek(start)
+    locals_vec = reader.read_locals_vec()
+    expr = reader.read_expr()
+    if reader.tell() != end:
+        raise Exception("invalid code body at offset %d" % start)
+    return locals_vec, expr
+
+
+def decode_flat_code_body(data, start, end):
+    # the locals and the FlatCode of the body data[start:end]
+    reader = WasmBufferReader(data)
+    reader.seek(start)
+    locals_vec = reader.read_locals_vec()
+    flat = reader.read_flat_expr()
+    if reader.tell() != end:
+        raise Exception("invalid code body at offset %d" % start)
+    return locals_vec, flat
+
+
+def decode_code_shard(data, ranges, flyweight=False):
+    # the shared instructions of a shard stay shared within its results, each shard has its own
+    return [decode_code_body(data, start, end, flyweight) for start, end in ranges]
+
+
+def decode_code_bodies(data, ranges, workers, flyweight=False):
+    # decode the bodies data[start:end] of ranges in a process pool, each task gets a contiguous shard
+    # of bodies copied out of data; results come back in the order of ranges
+    total = ranges[-1][1] - ranges[0][0]
+    shard_size = max(total // (workers * 4), 1)
+    shards = []
+    shard = []
+    shard_bytes = 0
+    for start, end in ranges:
+        shard.append((start, end))
+        shard_bytes += end - start
+        if shard_bytes >= shard_size:
+            shards.append(shard)
+            shard = []
+            shard_bytes = 0
+    if shard:
+        shards.append(shard)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for shard in shards:
+            base, limit = shard[0][0], shard[-1][1]
+            futures.append(executor.submit(decode_code_shard, bytes(data[base:limit]),
+                                           [(start - base, end - base) for start, end in shard], flyweight))
+        bodies = []
+        for future in futures:
+            bodies.extend(future.result())
+    return bodies
+
+
+# immediate kind -> name of the WasmReader method decoding it
+imm_readers = {
+    ImmNone: None,
+    ImmBlock: "read_block_args",
+    ImmIf: "read_if_args",
+    ImmBrTable: "read_br_table_args",
+    ImmCallIndirect: "read_call_indirect_args",
+    ImmVarU32: "read_var_u32",
+    ImmVarS32: "read_var_s32",
+    ImmVarS64: "read_var_s64",
+    ImmF32: "read_f32",
+    ImmF64: "read_f64",
+    ImmV128: "read_v128",
+    ImmLane: "read_lane",
+    ImmZero: "read_zero",
+    ImmTableArg: "read_table_arg",
+    ImmMemArg: "read_mem_arg",
+    ImmMemLaneArg: "read_mem_lane_arg",
+}
+
+
+# section id -> name of the WasmReader method reading its payload
+section_readers = {
+    SecTypeID: "read_type_sec",
+    SecImportID: "read_import_sec",
+    SecFuncID: "read_indices",
+    SecTableID: "read_table_sec",
+    SecMemID: "read_mem_sec",
+    SecGlobalID: "read_global_sec",
+    SecExportID: "read_export_sec",
+    SecStartID: "read_start_sec",
+    SecElemID: "read_elem_sec",
+    SecDataCountID: "read_datacount_sec",
+}
+
+
 class WasmReader:
+    # opcode -> function decoding its immediates (None when it has none), resolved per reader class
+    arg_decoders = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.build_arg_decoders()
+
+    @classmethod
+    def build_arg_decoders(cls):
+        cls.arg_decoders = {}
+        for opcode, info in opcode_table.items():
+            name = imm_readers[info.imm]
+            cls.arg_decoders[opcode] = getattr(cls, name) if name is not None else None
 
     def __init__(self, data=None, reader=None):
         if data is None:
             data = []
         self.reader = reader
         self.data = data
+        self.lazy = False
+        self.workers = 1
+        self.flyweight = False
+        # ids of the sections to decode, None for all
+        self.sections = None
 
     def remaining(self):
-        return len(self.data) - self.reader.tell()
+        return len(self.data) - self.tell()
+
+    def tell(self):
+        return self.reader.tell()
+
+    def seek(self, pos):
+        self.reader.seek(pos)
+
+    def read(self, n):
+        return self.reader.read(n)
+
+    def read_view(self, n):
+        return self.read(n)
 
     def read_byte(self):
 
@@ -98,17 +320,23 @@ class WasmReader:
 
     def read_var_u32(self):
 
-        n, w = decode_var_uint(self.reader, 32)
+        pos = self.tell()
+        n, w = decode_var_uint_at(self.data, pos, 32)
+        self.seek(pos + w)
         return n
 
     def read_var_s32(self):
 
-        n, w = decode_var_int(self.reader, 32)
+        pos = self.tell()
+        n, w = decode_var_int_at(self.data, pos, 32)
+        self.seek(pos + w)
         return n
 
     def read_var_s64(self):
 
-        n, w = decode_var_int(self.reader, 64)
+        pos = self.tell()
+        n, w = decode_var_int_at(self.data, pos, 64)
+        self.seek(pos + w)
         return n
 
     def read_bytes(self):
@@ -119,6 +347,9 @@ class WasmReader:
         bytes_data = self.reader.read(n)
         return bytearray(bytes_data)
 
+    def read_bytes_view(self):
+        return self.read_bytes()
+
     def read_name(self):
         data = self.read_bytes()
         try:
@@ -129,21 +360,65 @@ class WasmReader:
         return str(data, 'utf-8')
 
     def read_module(self, module: Module):
+        module.magic, module.version = self.read_preamble()
+        self.read_sections(module)
+        if module.is_decoded(SecFuncID) and module.is_decoded(SecCodeID) and \
+                len(module.func_sec) != len(module.code_sec):
+            raise Exception("function and code section have inconsistent lengths")
+        if self.remaining() > 0:
+            raise Exception("junk after last section")
+
+    def read_preamble(self):
         if self.remaining() < 4:
             raise Exception("unexpected end of magic header")
-        module.magic = self.read_u32()
-        if module.magic != MagicNumber:
+        magic = self.read_u32()
+        if magic != MagicNumber:
             raise Exception("magic header not detected")
         if self.remaining() < 4:
             raise Exception("unexpected end of chaos version")
-        module.version = self.read_u32()
-        if module.version != Version:
-            raise Exception("unknown chaos version: %d" % module.version)
-        self.read_sections(module)
-        if len(module.func_sec) != len(module.code_sec):
-            raise Exception("function and code section have inconsistent lengths")
-        if self.remaining() > 0:
-            raise Exception("junk after last section")
+        version = self.read_u32()
+        if version != Version:
+            raise Exception("unknown chaos version: %d" % version)
+        return magic, version
+
+    def iter_sections(self):
+        # generator behind iter_sections; the code bodies are skipped over by their size prefixes
+        self.read_preamble()
+        prev_sec_id = 0
+        while self.remaining() > 0:
+            start = self.tell()
+            sec_id = self.read_byte()
+            n = self.read_var_u32()
+            if self.remaining() < int(n):
+                raise ErrUnexpectedEnd
+            end = self.tell() + n
+            if sec_id == SecCustomID:
+                yield sec_id, (start, end), self.read_custom_sec(n)[0]
+                continue
+            if sec_id > SecDataCountID:
+                raise Exception("malformed section id: %d" % sec_id)
+            if sec_id <= prev_sec_id and prev_sec_id != SecDataCountID:
+                raise Exception("junk after last section, id: %d" % sec_id)
+            prev_sec_id = sec_id
+            if sec_id == SecCodeID:
+                for _ in range(self.read_var_u32()):
+                    size = self.read_var_u32()
+                    if self.remaining() < int(size):
+                        raise ErrUnexpectedEnd
+                    body_start = self.tell()
+                    self.seek(body_start + size)
+                    # over a view of its own, the one of the scan is released when it ends
+                    yield sec_id, (body_start, body_start + size), Code.lazy(self.data[:], body_start,
+                                                                              body_start + size, self.flyweight)
+            elif sec_id == SecDataID:
+                for _ in range(self.read_var_u32()):
+                    entry_start = self.tell()
+                    data = self.read_data()
+                    yield sec_id, (entry_start, self.tell()), data
+            else:
+                yield sec_id, (start, end), getattr(self, section_readers[sec_id])()
+            if self.tell() != end:
+                raise Exception("section size mismatch, id: %d" % sec_id)
 
     def read_sections(self, module: Module):
 
@@ -152,10 +427,21 @@ class WasmReader:
             sec_id = self.read_byte()
             if sec_id == SecCustomID:
                 #     module.custom_secs = []
-                n, w = decode_var_uint(self.reader, 32)
+                pos = self.tell()
+                n = self.read_var_u32()
+                w = self.tell() - pos
                 from leb128 import LEB128U
-                start = self.reader.tell() - w - 1
-                end = self.reader.tell() + n
+                start = self.tell() - w - 1
+                end = self.tell() + n
+                if self.sections is not None and SecCustomID not in self.sections:
+                    # only the name is read, for the section range
+                    if self.remaining() < int(n):
+                        raise ErrUnexpectedEnd
+                    if module.is_decoded(SecCustomID):
+                        module.set_undecoded(SecCustomID)
+                    module.section_range[SecCustomID].append(SectionRange(start, end, self.read_name()))
+                    self.seek(end)
+                    continue
                 custom_sec, custom_sec_name = self.read_custom_sec(n)
                 module.section_range[SecCustomID].append(SectionRange(start, end, custom_sec_name))
                 module.custom_secs.append(custom_sec)
@@ -165,7 +451,17 @@ class WasmReader:
             if sec_id <= prev_sec_id and prev_sec_id != SecDataCountID:
                 raise Exception("junk after last section, id: %d" % sec_id)
             prev_sec_id = sec_id
-            n, w = decode_var_uint(self.reader, 32)
+            pos = self.tell()
+            n = self.read_var_u32()
+            w = self.tell() - pos
+            if self.sections is not None and sec_id not in self.sections:
+                if self.remaining() < int(n):
+                    raise ErrUnexpectedEnd
+                module.section_range[sec_id].start = pos - 1
+                module.section_range[sec_id].end = self.tell() + n
+                module.set_undecoded(sec_id)
+                self.seek(self.tell() + n)
+                continue
             remaining_before_read = self.remaining()
             self.read_non_custom_sec(sec_id, module, n, w)
             remain = self.remaining()
@@ -176,11 +472,11 @@ class WasmReader:
     def read_custom_sec(self, sec_size):
         name = self.read_name()
         if name != "name":
-            self.reader.seek(self.reader.tell() - len(name) - 1)
-            custom_sec_data = self.reader.read(sec_size)
+            self.seek(self.tell() - len(name) - 1)
+            custom_sec_data = self.read_view(sec_size)
             return CustomSec(name=name, custom_sec_data=custom_sec_data), name
 
-        name_data = self.read_name_data(self.reader.read(sec_size - len(name) - 1))
+        name_data = self.read_name_data(self.read_view(sec_size - len(name) - 1))
         return CustomSec(name=name, name_data=name_data), name
 
     @staticmethod
@@ -196,186 +492,154 @@ class WasmReader:
         memory_bytes = None
         elem_bytes = None
 
-        while len(data) != 0:
-            sub_sec_id = data[:1]
-            data = data[1:]
-            if sub_sec_id[0] == 0:
-                namesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                module_bytes = data[:namesubsec_size]
-                data = data[namesubsec_size:]
-
-            if sub_sec_id[0] == 1:
-                funcnamesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                name_map_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                funcname_map = []
-                for _ in range(name_map_size):
-                    idx, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name_size, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name = data[:name_size]
-                    name = bytearray(name).decode('utf-8')
-                    data = data[name_size:]
-                    name_assoc = NameAssoc(idx=idx, name=name)
-                    funcname_map.append(name_assoc)
-            if sub_sec_id[0] == 2:
-                namesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                local_bytes = data[:namesubsec_size]
-                data = data[namesubsec_size:]
-
-            if sub_sec_id[0] == 3:  # TODO
-                namesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                labels_bytes = data[:namesubsec_size]
-                data = data[namesubsec_size:]
-
-            if sub_sec_id[0] == 4:  # TODO
-                namesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                type_bytes = data[:namesubsec_size]
-                data = data[namesubsec_size:]
-
-            if sub_sec_id[0] == 5:
-                tablenamesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                name_map_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                tablename_map = []
-                for _ in range(name_map_size):
-                    idx, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name_size, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name = data[:name_size]
-                    name = bytearray(name).decode('utf-8')
-                    data = data[name_size:]
-                    name_assoc = NameAssoc(idx=idx, name=name)
-                    tablename_map.append(name_assoc)
-            if sub_sec_id[0] == 6:  # TODO
-                namesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                memory_bytes = data[:namesubsec_size]
-                data = data[namesubsec_size:]
-
-            if sub_sec_id[0] == 7:
-                globalnamesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                name_map_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                globalname_map = []
-                for _ in range(name_map_size):
-                    idx, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name_size, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name = data[:name_size]
-                    name = bytearray(name).decode('utf-8')
-                    data = data[name_size:]
-                    name_assoc = NameAssoc(idx=idx, name=name)
-                    globalname_map.append(name_assoc)
-            if sub_sec_id[0] == 8:  # TODO
-                namesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                elem_bytes = data[:namesubsec_size]
-                data = data[namesubsec_size:]
-
-            if sub_sec_id[0] == 9:
-                datanamesubsec_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                name_map_size, w = decode_var_uint_from_data(data, 32)
-                data = data[w:]
-                dataname_map = []
-                for _ in range(name_map_size):
-                    idx, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name_size, w = decode_var_uint_from_data(data, 32)
-                    data = data[w:]
-                    name = data[:name_size]
-                    name = bytearray(name).decode('utf-8')
-                    data = data[name_size:]
-                    name_assoc = NameAssoc(idx=idx, name=name)
-                    dataname_map.append(name_assoc)
+        pos = 0
+        while pos < len(data):
+            sub_sec_id = data[pos]
+            pos += 1
+            if sub_sec_id == 0:
+                namesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                module_bytes = data[pos:pos + namesubsec_size]
+                pos += namesubsec_size
+
+            if sub_sec_id == 1:
+                funcnamesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                funcname_map, pos = WasmReader.read_name_map(data, pos)
+            if sub_sec_id == 2:
+                namesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                local_bytes = data[pos:pos + namesubsec_size]
+                pos += namesubsec_size
+
+            if sub_sec_id == 3:  # TODO
+                namesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                labels_bytes = data[pos:pos + namesubsec_size]
+                pos += namesubsec_size
+
+            if sub_sec_id == 4:  # TODO
+                namesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                type_bytes = data[pos:pos + namesubsec_size]
+                pos += namesubsec_size
+
+            if sub_sec_id == 5:
+                tablenamesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                tablename_map, pos = WasmReader.read_name_map(data, pos)
+            if sub_sec_id == 6:  # TODO
+                namesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                memory_bytes = data[pos:pos + namesubsec_size]
+                pos += namesubsec_size
+
+            if sub_sec_id == 7:
+                globalnamesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                globalname_map, pos = WasmReader.read_name_map(data, pos)
+            if sub_sec_id == 8:  # TODO
+                namesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                elem_bytes = data[pos:pos + namesubsec_size]
+                pos += namesubsec_size
+
+            if sub_sec_id == 9:
+                datanamesubsec_size, w = decode_var_uint_at(data, pos, 32)
+                pos += w
+                dataname_map, pos = WasmReader.read_name_map(data, pos)
 
         name_data = NameData(module_bytes, funcname_map, globalname_map, dataname_map, tablename_map,
                              local_bytes, labels_bytes, type_bytes, memory_bytes, elem_bytes)
         return name_data
 
+    @staticmethod
+    def read_name_map(data, pos):
+        name_map = []
+        name_map_size, w = decode_var_uint_at(data, pos, 32)
+        pos += w
+        for _ in range(name_map_size):
+            idx, w = decode_var_uint_at(data, pos, 32)
+            pos += w
+            name_size, w = decode_var_uint_at(data, pos, 32)
+            pos += w
+            name = bytearray(data[pos:pos + name_size]).decode('utf-8')
+            pos += name_size
+            name_map.append(NameAssoc(idx=idx, name=name))
+        return name_map, pos
+
     def read_non_custom_sec(self, sec_id, module, sec_size, byte_count_size):
         # print("Paring the wasm binary:")
         if sec_id == SecTypeID:
-            module.section_range[SecTypeID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecTypeID].end = self.reader.tell() + sec_size
+            module.section_range[SecTypeID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecTypeID].end = self.tell() + sec_size
             # print("type start=" + str(module.section_range[SecTypeID].start))
             # print("type end=" + str(module.section_range[SecTypeID].end))
             module.type_sec = self.read_type_sec()
         elif sec_id == SecImportID:
-            module.section_range[SecImportID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecImportID].end = self.reader.tell() + sec_size
+            module.section_range[SecImportID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecImportID].end = self.tell() + sec_size
             # print("import start=" + str(module.section_range[SecImportID].start))
             # print("import end=" + str(module.section_range[SecImportID].end))
             module.import_sec = self.read_import_sec()
         elif sec_id == SecFuncID:
-            module.section_range[SecFuncID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecFuncID].end = self.reader.tell() + sec_size
+            module.section_range[SecFuncID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecFuncID].end = self.tell() + sec_size
             # print("func start=" + str(module.section_range[SecFuncID].start))
             # print("func end=" + str(module.section_range[SecFuncID].end))
             module.func_sec = self.read_indices()
         elif sec_id == SecTableID:
-            module.section_range[SecTableID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecTableID].end = self.reader.tell() + sec_size
+            module.section_range[SecTableID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecTableID].end = self.tell() + sec_size
             # print("table start=" + str(module.section_range[SecTableID].start))
             # print("table end=" + str(module.section_range[SecTableID].end))
             module.table_sec = self.read_table_sec()
         elif sec_id == SecMemID:
-            module.section_range[SecMemID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecMemID].end = self.reader.tell() + sec_size
+            module.section_range[SecMemID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecMemID].end = self.tell() + sec_size
             # print("mem start=" + str(module.section_range[SecMemID].start))
             # print("mem end=" + str(module.section_range[SecMemID].end))
             module.mem_sec = self.read_mem_sec()
         elif sec_id == SecGlobalID:
-            module.section_range[SecGlobalID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecGlobalID].end = self.reader.tell() + sec_size
+            module.section_range[SecGlobalID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecGlobalID].end = self.tell() + sec_size
             # print("global start=" + str(module.section_range[SecGlobalID].start))
             # print("global end=" + str(module.section_range[SecGlobalID].end))
             module.global_sec = self.read_global_sec()
         elif sec_id == SecExportID:
-            module.section_range[SecExportID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecExportID].end = self.reader.tell() + sec_size
+            module.section_range[SecExportID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecExportID].end = self.tell() + sec_size
             # print("export start=" + str(module.section_range[SecExportID].start))
             # print("export end=" + str(module.section_range[SecExportID].end))
             module.export_sec = self.read_export_sec()
         elif sec_id == SecStartID:
-            module.section_range[SecStartID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecStartID].end = self.reader.tell() + sec_size
+            module.section_range[SecStartID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecStartID].end = self.tell() + sec_size
             # print("start start=" + str(module.section_range[SecStartID].start))
             # print("start end=" + str(module.section_range[SecStartID].end))
             module.start_sec = self.read_start_sec()
         elif sec_id == SecElemID:
-            module.section_range[SecElemID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecElemID].end = self.reader.tell() + sec_size
+            module.section_range[SecElemID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecElemID].end = self.tell() + sec_size
             # print("elem start=" + str(module.section_range[SecElemID].start))
             # print("elem end=" + str(module.section_range[SecElemID].end))
             module.elem_sec = self.read_elem_sec()
         elif sec_id == SecCodeID:
-            module.section_range[SecCodeID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecCodeID].end = self.reader.tell() + sec_size
+            module.section_range[SecCodeID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecCodeID].end = self.tell() + sec_size
             # print("code start=" + str(module.section_range[SecCodeID].start))
             # print("code end=" + str(module.section_range[SecCodeID].end))
             module.code_sec = self.read_code_sec()
         elif sec_id == SecDataID:
-            module.section_range[SecDataID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecDataID].end = self.reader.tell() + sec_size
+            module.section_range[SecDataID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecDataID].end = self.tell() + sec_size
             # print("data start=" + str(module.section_range[SecDataID].start))
             # print("data end=" + str(module.section_range[SecDataID].end))
             module.data_sec = self.read_data_sec()
         elif sec_id == SecDataCountID:
             # bug
-            module.section_range[SecDataCountID].start = self.reader.tell() - byte_count_size - 1
-            module.section_range[SecDataCountID].end = self.reader.tell() + sec_size
+            module.section_range[SecDataCountID].start = self.tell() - byte_count_size - 1
+            module.section_range[SecDataCountID].end = self.tell() + sec_size
             # print("data start=" + str(module.section_range[SecDataCountID].start))
             # print("data end=" + str(module.section_range[SecDataCountID].end))
             module.datacount_sec = self.read_datacount_sec()
@@ -462,17 +726,55 @@ class WasmReader:
         return Elem(self.read_var_u32(), self.read_expr(), self.read_indices())
 
     def read_code_sec(self):
+        if self.workers > 1 and not self.lazy:
+            return self.read_code_sec_parallel()
         vec = [Code()] * self.read_var_u32()
         for i in range(len(vec)):
             vec[i] = self.read_code(i)
         return vec
 
+    def read_code_sec_parallel(self):
+        # one cheap pass over the size prefixes, then the bodies are decoded by a process pool
+        ranges = []
+        for _ in range(self.read_var_u32()):
+            n = self.read_var_u32()
+            if self.remaining() < int(n):
+                raise ErrUnexpectedEnd
+            start = self.tell()
+            self.seek(start + n)
+            ranges.append((start, start + n))
+        if not ranges:
+            return []
+
+        vec = []
+        data = memoryview(self.data)
+        for (start, end), (locals_vec, expr) in zip(ranges, decode_code_bodies(self.data, ranges, self.workers,
+                                                                                          self.flyweight)):
+            code = Code(locals_vec, expr)
+            code.set_raw_body(data[start:end])
+            code._body_start, code._body_end = start, end
+            if code.get_local_count() >= (1 << 32 - 1):
+                raise Exception("too many locals: %d" % code.get_local_count())
+            vec.append(code)
+        return vec
+
     def read_code(self, idx):
         n = self.read_var_u32()
+        if self.lazy:
+            if self.remaining() < int(n):
+                raise ErrUnexpectedEnd
+            start = self.tell()
+            self.seek(start + n)
+            return Code.lazy(self.data, start, start + n, self.flyweight)
         remaining_before_read = self.remaining()
+        start = self.tell()
         code = Code(self.read_locals_vec(), self.read_expr())
         if self.remaining() + int(n) != remaining_before_read:
             print("invalid code[%d]" % idx)
+        else:
+            # the body is emitted from these bytes until it is edited
+            code.set_raw_body(memoryview(self.data)[start:start + n])
+            code._body_start, code._body_end = start, start + n
         if code.get_local_count() >= (1 << 32 - 1):
             raise Exception("too many locals: %d" % code.get_local_count())
         return code
@@ -499,11 +801,11 @@ class WasmReader:
     def read_data(self):
         data_type = self.read_var_u32()
         if data_type == 0:
-            return Data(offset_expr=self.read_expr(), vec_init=self.read_bytes())
+            return Data(offset_expr=self.read_expr(), vec_init=self.read_bytes_view())
         elif data_type == 1:
-            return Data(vec_init=self.read_bytes())
+            return Data(vec_init=self.read_bytes_view())
         elif data_type == 2:
-            return Data(mem_idx=self.read_var_u32(), offset_expr=self.read_expr(), vec_init=self.read_bytes())
+            return Data(mem_idx=self.read_var_u32(), offset_expr=self.read_expr(), vec_init=self.read_bytes_view())
 
     def read_val_types(self):
         vec = []
@@ -571,73 +873,77 @@ class WasmReader:
                 return instrs, end
             instrs.append(instr)
 
-    def read_instruction(self):
-        instr = Instruction()
-        instr.opcode = self.read_byte()
-        if instr.opcode == 0xFC:
-            instr.opcode = instr.opcode*256 + self.read_byte()
-        elif instr.opcode == 0xFD:
+    def read_opcode(self):
+        opcode = self.read_byte()
+        if opcode == 0xFC:
+            opcode = opcode*256 + self.read_byte()
+        elif opcode == 0xFD:
             second_byte = self.read_byte()
             if second_byte > 0x7F:
-                instr.opcode = instr.opcode * 256 * 256 + second_byte * 256 + self.read_byte()
+                opcode = opcode * 256 * 256 + second_byte * 256 + self.read_byte()
             else:
-                instr.opcode = instr.opcode * 256 + second_byte
-        if opnames[instr.opcode] == "":
-            raise Exception("undefined opcode: 0x%02x" % instr.opcode)
-        instr.args = self.read_args(instr.opcode)
-        return instr
+                opcode = opcode * 256 + second_byte
+        return opcode
+
+    def read_instruction(self):
+        opcode = self.read_opcode()
+        try:
+            decoder = self.arg_decoders[opcode]
+        except KeyError:
+            raise Exception("undefined opcode: 0x%02x" % opcode)
+        if decoder is not None:
+            return Instruction(opcode, decoder(self))
+        if self.flyweight:
+            return get_shared_instruction(opcode)
+        return Instruction(opcode)
 
     def read_args(self, opcode):
-        if opcode in [Block, Loop]:
-            return self.read_block_args()
-        elif opcode == If:
-            return self.read_if_args()
-        elif opcode in [Br, BrIf]:
-            return self.read_var_u32()
-        elif opcode == BrTable:
-            return self.read_br_table_args()
-        elif opcode == Call:
-            return self.read_var_u32()
-        elif opcode == CallIndirect:
-            return self.read_call_indirect_args()
-        elif opcode in [LocalGet, LocalSet, LocalTee]:
-            return self.read_var_u32()
-        elif opcode in [GlobalGet, GlobalSet]:
-            return self.read_var_u32()
-        elif opcode in [MemorySize, MemoryGrow]:
-            return self.read_zero()
-        elif opcode == I32Const:
-            return self.read_var_s32()
-        elif opcode == I64Const:
-            return self.read_var_s64()
-        elif opcode == F32Const:
-            return self.read_f32()
-        elif opcode == F64Const:
-            return self.read_f64()
-        elif opcode == V128Const:
-            return self.read_v128()
-        elif opcode == I8x16Shuffle:
-            return self.read_v128()
-        elif I8x16ExtractLaneS <= opcode <= F64x2ReplaceLane:
-            return self.read_lane()
-        elif opcode in [RefNull, RefFunc]:
-            return self.read_var_u32()
-        elif opcode in [MemoryInit, DataDrop, ElemDrop, TableGrow, TableSize, TableFill]:
-            return self.read_var_u32()
-        elif opcode in [TableInit, TableCopy]:
-            x = self.read_var_u32()
-            y = self.read_var_u32()
-            return TableArg(x, y)
-        elif V128Load <= opcode <= V128Store or opcode in [V128Load32Zero, V128Load64Zero]:
-            return self.read_mem_arg()
-        elif V128Load8Lane <= opcode <= V128Store64Lane:
-            mem_arg = self.read_mem_arg()
-            laneidx = self.read_lane()
-            return MemLaneArg(mem_arg, laneidx)
-        elif I32Load <= opcode <= I64Store32:
-            return self.read_mem_arg()
-        else:
+        decoder = self.arg_decoders[opcode]
+        if decoder is None:
             return None
+        return decoder(self)
+
+    def read_flat_expr(self):
+        # the expr straight into the columns of a FlatCode, without Instruction objects
+        flat = FlatCode()
+        opcodes, imms, depths, matches, extra = flat.opcodes, flat.imms, flat.depths, flat.matches, flat.extra
+        kinds = flat_imm_kinds
+        # [opener row, row waiting for its match] of the open blocks
+        open_blocks = []
+        while True:
+            opcode = self.read_opcode()
+            kind = kinds.get(opcode)
+            if kind is None:
+                raise Exception("undefined opcode: 0x%02x" % opcode)
+            row = len(opcodes)
+            depth = len(open_blocks)
+            if opcode == End_:
+                if not open_blocks:
+                    return flat
+                opener, pending = open_blocks.pop()
+                matches[pending] = row
+                imm, match, depth = 0, opener, depth - 1
+            elif opcode == Else_:
+                if not open_blocks or opcodes[open_blocks[-1][0]] != If or open_blocks[-1][1] != open_blocks[-1][0]:
+                    raise Exception("else outside of if")
+                matches[open_blocks[-1][1]] = row
+                open_blocks[-1][1] = row
+                imm, match, depth = 0, 0, depth - 1
+            elif kind == FlatImmNone:
+                imm, match = 0, 0
+            elif kind == FlatImmInt:
+                imm, match = self.arg_decoders[opcode](self), 0
+            elif kind == FlatImmExtra:
+                imm, match = len(extra), 0
+                extra.append(self.arg_decoders[opcode](self))
+            else:
+                imm, match = self.read_block_type(), 0
+            opcodes.append(opcode)
+            imms.append(imm)
+            depths.append(depth)
+            matches.append(match)
+            if kind == FlatImmBlock:
+                open_blocks.append([row, row])
 
     def read_block_args(self):
         args = BlockArgs()
@@ -668,8 +974,134 @@ class WasmReader:
     def read_mem_arg(self):
         return MemArg(self.read_var_u32(), self.read_var_u32())
 
+    def read_mem_lane_arg(self):
+        mem_arg = self.read_mem_arg()
+        laneidx = self.read_lane()
+        return MemLaneArg(mem_arg, laneidx)
+
+    def read_table_arg(self):
+        x = self.read_var_u32()
+        y = self.read_var_u32()
+        return TableArg(x, y)
+
     def read_zero(self):
         b = self.read_byte()
         if b != 0:
             raise Exception("zero flag expected, got %d" % b)
         return 0
+
+
+WasmReader.build_arg_decoders()
+
+
+class WasmBufferReader(WasmReader):
+    # Reads from a single bytes-like object with an integer cursor instead of a file object.
+    # With zero_copy (data must be a memoryview) payload blobs are returned as slices of data.
+
+    def __init__(self, data=None, zero_copy=False):
+        if data is None:
+            data = b""
+        super().__init__(data, None)
+        self.pos = 0
+        self.zero_copy = zero_copy
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, n):
+        start = self.pos
+        self.pos = min(start + n, len(self.data))
+        return bytes(self.data[start:self.pos])
+
+    def read_view(self, n):
+        if not self.zero_copy:
+            return self.read(n)
+        start = self.pos
+        self.pos = min(start + n, len(self.data))
+        return self.data[start:self.pos]
+
+    def read_byte(self):
+
+        if self.pos >= len(self.data):
+            raise ErrUnexpectedEnd
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def read_u32(self):
+
+        if self.remaining() < 4:
+            raise ErrUnexpectedEnd
+        b = struct.unpack_from('<i', self.data, self.pos)[0]
+        self.pos += 4
+        return b
+
+    def read_f32(self):
+
+        if self.remaining() < 4:
+            raise ErrUnexpectedEnd
+        b = struct.unpack_from('<f', self.data, self.pos)[0]
+        self.pos += 4
+        return b
+
+    def read_f64(self):
+
+        if self.remaining() < 8:
+            raise ErrUnexpectedEnd
+        b = struct.unpack_from('<d', self.data, self.pos)[0]
+        self.pos += 8
+        return b
+
+    def read_v128(self):
+
+        if self.remaining() < 16:
+            raise ErrUnexpectedEnd
+        b = int.from_bytes(self.data[self.pos:self.pos + 16], byteorder='little')
+        self.pos += 16
+        return b
+
+    def read_lane(self):
+        return self.read_byte()
+
+    def read_var_u32(self):
+
+        n, w = decode_var_uint_at(self.data, self.pos, 32)
+        self.pos += w
+        return n
+
+    def read_var_s32(self):
+
+        n, w = decode_var_int_at(self.data, self.pos, 32)
+        self.pos += w
+        return n
+
+    def read_var_s64(self):
+
+        n, w = decode_var_int_at(self.data, self.pos, 64)
+        self.pos += w
+        return n
+
+    def read_bytes(self):
+
+        n = self.read_var_u32()
+        if self.remaining() < int(n):
+            raise ErrUnexpectedEnd
+        bytes_data = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return bytearray(bytes_data)
+
+    def read_bytes_view(self):
+        if not self.zero_copy:
+            return self.read_bytes()
+        n = self.read_var_u32()
+        if self.remaining() < int(n):
+            raise ErrUnexpectedEnd
+        bytes_data = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return bytes_data
@@ -0,0 +1,125 @@
+import struct
+from array import array
+from multiprocessing import shared_memory
+
+from ..parser.module import Code
+from ..parser.reader import decode
+
+SharedMagic = b"BREWasmM"
+# magic, wasm byte length, number of bodies, number of imported functions
+SharedHeader = struct.Struct("=8sQQQ")
+
+
+class SharedModule:
+    # The bytes of a wasm file and the offsets of its code bodies published once in a block of
+    # multiprocessing.shared_memory, for worker processes to attach to by name instead of each getting a
+    # copy of the module:
+    #
+    #   header, the (start, end) offsets of each body in the wasm bytes as native u64, the wasm bytes
+    #
+    # A worker decodes only what it uses, straight from the shared bytes: get_code builds a lazy Code from
+    # the offsets without parsing anything else, get_module parses the other sections with lazy bodies.
+    # Both hold views of the block, so close() only succeeds once they are gone. The process that published
+    # the block unlinks it on close.
+
+    def __init__(self, shm, owner=False, flyweight=False):
+        self.shm = shm
+        self.name = shm.name
+        self.owner = owner
+        self.flyweight = flyweight
+        magic, size, count, import_func_num = SharedHeader.unpack_from(shm.buf, 0)
+        if magic != SharedMagic:
+            shm.close()
+            raise Exception("not a shared module: %s" % shm.name)
+        self.import_func_num = import_func_num
+        pos = SharedHeader.size
+        self.offsets = shm.buf[pos:pos + count * 16].cast('Q')
+        pos += count * 16
+        self.data = shm.buf[pos:pos + size]
+        self.module = None
+
+    @staticmethod
+    def publish(module, data=None):
+        # data: the bytes module was decoded from, read from its source file when not given. The workers
+        # see these bytes, so a module edited since it was decoded cannot be published
+        if module.dirty_secs:
+            raise Exception("the module was edited since it was decoded")
+        if data is None:
+            if not module.has_source():
+                raise Exception("the source file of the module is gone or changed")
+            with open(module.source_path, 'rb') as f:
+                data = f.read()
+        offsets = array('Q')
+        for idx, code in enumerate(module.code_sec):
+            if code._body_end == 0 or code._body_end > len(data):
+                raise Exception("code[%d] has no body in the module bytes" % idx)
+            offsets.append(code._body_start)
+            offsets.append(code._body_end)
+
+        header = SharedHeader.pack(SharedMagic, len(data), len(module.code_sec), module.get_import_func_num())
+        table = offsets.tobytes()
+        shm = shared_memory.SharedMemory(create=True, size=len(header) + len(table) + len(data))
+        try:
+            buf = shm.buf
+            buf[:len(header)] = header
+            buf[len(header):len(header) + len(table)] = table
+            buf[len(header) + len(table):len(header) + len(table) + len(data)] = data
+            del buf
+            return SharedModule(shm, owner=True)
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+
+    @staticmethod
+    def attach(name, flyweight=False):
+        # flyweight: decode the bodies with shared instructions, see get_shared_instruction
+        return SharedModule(shared_memory.SharedMemory(name=name), flyweight=flyweight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def get_count(self):
+        return len(self.offsets) // 2
+
+    def get_funcidxs(self):
+        # the function indices of the bodies, the imported functions come first
+        return range(self.import_func_num, self.import_func_num + self.get_count())
+
+    def get_body_size(self, funcidx):
+        idx = funcidx - self.import_func_num
+        return self.offsets[2 * idx + 1] - self.offsets[2 * idx]
+
+    def get_code(self, funcidx):
+        # the Code of a defined function, decoded from the shared bytes on first access
+        idx = funcidx - self.import_func_num
+        if idx < 0:
+            raise Exception("Import function!")
+        if idx >= self.get_count():
+            raise Exception("no function %d" % funcidx)
+        return Code.lazy(self.data, self.offsets[2 * idx], self.offsets[2 * idx + 1], self.flyweight)
+
+    def get_module(self):
+        # the Module of the shared bytes with lazy bodies, decoded on the first call
+        if self.module is None:
+            module, err = decode(self.data, zero_copy=True, lazy=True, flyweight=self.flyweight)
+            if err is not None:
+                raise err
+            self.module = module
+        return self.module
+
+    def close(self):
+        self.module = None
+        if self.offsets is not None:
+            self.offsets.release()
+            self.data.release()
+            self.offsets = None
+            self.data = None
+        self.shm.close()
+        if self.owner:
+            self.owner = False
+            self.shm.unlink()
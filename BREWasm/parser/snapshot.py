@@ -0,0 +1,199 @@
+import marshal
+import struct
+import sys
+from array import array
+
+from ..parser.flat_code import FlatCode
+from ..parser.instruction import Instruction, BlockArgs, IfArgs, BrTableArgs, MemArg, TableArg, MemLaneArg
+from ..parser.module import Module, Code, Locals, Import, ImportDesc, Global, Export, ExportDesc, Elem, Data, \
+    CustomSec, NameData, SectionRange
+from ..parser.types import FuncType, Limits, TableType, GlobalType, NameAssoc
+
+# A snapshot is the parsed IR of a module as bytes, self-contained so that it can be stored or sent to
+# another process:
+#
+#   magic, u32 format version, u64 byte length and bytes of the tables, then five columns of an array
+#   typecode byte, u64 byte length and the little endian items:
+#   tables    marshal of the section tables, the locals and the extra immediates of each body
+#   opcodes   the opcodes column of every body, one after the other
+#   imms
+#   depths
+#   matches   rows counted from the start of each body
+#   bodies    the row each body starts at, and the row count at the end
+#
+# Each column is written with the narrowest typecode that holds its values and widened again on load. In
+# the tables an object of one of snapshot_classes is the tuple of the index of its class and the values of
+# its __slots__, an unset slot is Ellipsis.
+
+SnapshotMagic = b"BREWasmS"
+SnapshotVersion = 1
+
+snapshot_classes = [Import, ImportDesc, Global, Export, ExportDesc, Elem, Data, Locals, CustomSec, NameData,
+                    SectionRange, FuncType, Limits, TableType, GlobalType, NameAssoc, Instruction, BlockArgs, IfArgs,
+                    BrTableArgs, MemArg, TableArg, MemLaneArg]
+snapshot_class_ids = {cls: i for i, cls in enumerate(snapshot_classes)}
+SnapTuple = -1
+SnapByteArray = -2
+
+# typecode -> (lowest, highest) value of the narrower typecodes a column is written with
+column_ranges = {
+    'B': (0, (1 << 8) - 1),
+    'H': (0, (1 << 16) - 1),
+    'I': (0, (1 << 32) - 1),
+    'Q': (0, (1 << 64) - 1),
+    'b': (-(1 << 7), (1 << 7) - 1),
+    'h': (-(1 << 15), (1 << 15) - 1),
+    'i': (-(1 << 31), (1 << 31) - 1),
+    'q': (-(1 << 63), (1 << 63) - 1),
+}
+unsigned_typecodes = ['B', 'H', 'I', 'Q']
+signed_typecodes = ['b', 'h', 'i', 'q']
+
+# the Module attributes in the tables besides the code section
+snapshot_fields = ["magic", "version", "custom_secs", "type_sec", "import_sec", "func_sec", "table_sec", "mem_sec",
+                   "global_sec", "export_sec", "start_sec", "elem_sec", "data_sec", "datacount_sec", "section_range"]
+
+
+def pack_value(value):
+    value_type = type(value)
+    if value is None or value_type is int or value_type is str or value_type is float or value_type is bytes \
+            or value_type is bool:
+        return value
+    if isinstance(value, list):
+        return [pack_value(item) for item in value]
+    if value_type is bytearray:
+        return SnapByteArray, bytes(value)
+    if value_type is memoryview:
+        return value.tobytes()
+    if value_type is tuple:
+        return (SnapTuple,) + tuple(pack_value(item) for item in value)
+    class_id = snapshot_class_ids.get(value_type)
+    if class_id is None:
+        raise Exception("no snapshot of %s" % value_type.__name__)
+    return (class_id,) + tuple(pack_value(getattr(value, name, ...)) for name in value_type.__slots__)
+
+
+def unpack_value(value):
+    value_type = type(value)
+    if value_type is list:
+        return [unpack_value(item) for item in value]
+    if value_type is not tuple:
+        return value
+    class_id = value[0]
+    if class_id == SnapTuple:
+        return tuple(unpack_value(item) for item in value[1:])
+    if class_id == SnapByteArray:
+        return bytearray(value[1])
+    cls = snapshot_classes[class_id]
+    obj = cls.__new__(cls)
+    for name, field in zip(cls.__slots__, value[1:]):
+        if field is not ...:
+            setattr(obj, name, unpack_value(field))
+    return obj
+
+
+def write_column(out, column):
+    # column in the narrowest typecode of its signedness holding its values
+    typecodes = unsigned_typecodes if column.typecode in unsigned_typecodes else signed_typecodes
+    low, high = (min(column), max(column)) if column else (0, 0)
+    for typecode in typecodes:
+        if column_ranges[typecode][0] <= low and high <= column_ranges[typecode][1]:
+            break
+    if typecode != column.typecode:
+        column = array(typecode, column)
+    data = array_bytes(column)
+    out += typecode.encode("ascii")
+    out += struct.pack("<Q", len(data))
+    out += data
+
+
+def read_column(data, pos, typecode):
+    # (the column at pos widened to typecode, position after it)
+    stored = chr(data[pos])
+    if stored not in column_ranges:
+        raise Exception("malformed snapshot")
+    size, = struct.unpack_from("<Q", data, pos + 1)
+    pos += 9
+    if pos + size > len(data):
+        raise Exception("truncated snapshot")
+    column = bytes_array(stored, data[pos:pos + size])
+    if stored != typecode:
+        column = array(typecode, column)
+    return column, pos + size
+
+
+def array_bytes(column):
+    if sys.byteorder != "little":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def bytes_array(typecode, data):
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+def dump_snapshot(module):
+    opcodes, imms, depths, matches = array('I'), array('q'), array('I'), array('I')
+    bodies = array('Q', [0])
+    codes = []
+    for code in module.code_sec:
+        locals_vec, flat = code.get_flat_body()
+        opcodes.extend(flat.opcodes)
+        imms.extend(flat.imms)
+        depths.extend(flat.depths)
+        matches.extend(flat.matches)
+        bodies.append(len(opcodes))
+        codes.append(([(locals_item.n, locals_item.type) for locals_item in locals_vec], pack_value(flat.extra)))
+    tables = marshal.dumps(([pack_value(getattr(module, name)) for name in snapshot_fields], codes), 4)
+
+    out = bytearray(SnapshotMagic)
+    out += struct.pack("<I", SnapshotVersion)
+    out += struct.pack("<Q", len(tables))
+    out += tables
+    for column in [opcodes, imms, depths, matches, bodies]:
+        write_column(out, column)
+    return bytes(out)
+
+
+def load_snapshot(data, flyweight=False):
+    # the Module of a snapshot; the bodies are FlatCode until their expr is first accessed
+    data = memoryview(data)
+    if data[:len(SnapshotMagic)] != SnapshotMagic:
+        raise Exception("not a snapshot")
+    pos = len(SnapshotMagic)
+    version, = struct.unpack_from("<I", data, pos)
+    if version != SnapshotVersion:
+        raise Exception("snapshot format %d, expected %d" % (version, SnapshotVersion))
+    size, = struct.unpack_from("<Q", data, pos + 4)
+    pos += 12
+    if pos + size > len(data):
+        raise Exception("truncated snapshot")
+    fields, codes = marshal.loads(data[pos:pos + size])
+    pos += size
+    opcodes, pos = read_column(data, pos, 'I')
+    imms, pos = read_column(data, pos, 'q')
+    depths, pos = read_column(data, pos, 'I')
+    matches, pos = read_column(data, pos, 'I')
+    bodies, pos = read_column(data, pos, 'Q')
+    if len(bodies) != len(codes) + 1 or bodies[-1] != len(opcodes):
+        raise Exception("malformed snapshot")
+
+    module = Module()
+    for name, value in zip(snapshot_fields, fields):
+        setattr(module, name, unpack_value(value))
+    for i, (locals_vec, extra) in enumerate(codes):
+        start, end = bodies[i], bodies[i + 1]
+        flat = FlatCode()
+        flat.opcodes = opcodes[start:end]
+        flat.imms = imms[start:end]
+        flat.depths = depths[start:end]
+        flat.matches = matches[start:end]
+        flat.extra = unpack_value(extra)
+        module.code_sec.append(Code.from_flat([Locals(n, val_type) for n, val_type in locals_vec], flat,
+                                              flyweight=flyweight))
+    return module
@@ -22,6 +22,7 @@ MutVar = 1
 
 
 class FuncType:
+    __slots__ = ("tag", "param_types", "result_types")
 
     def __init__(self, tag=0, param_types=None, result_types=None):
         if result_types is None:
@@ -82,6 +83,7 @@ class FuncType:
 
 
 class Limits:
+    __slots__ = ("tag", "min", "max")
 
     def __init__(self, tag=0, min=0, max=0):
         self.tag = tag
@@ -96,6 +98,7 @@ MemType = Limits
 
 
 class TableType:
+    __slots__ = ("elem_type", "limits")
 
     def __init__(self, elem_type=0x70, limits=None):
         self.elem_type = elem_type
@@ -104,6 +107,7 @@ class TableType:
 
 
 class GlobalType:
+    __slots__ = ("val_type", "mut")
 
     def __init__(self, val_type=0, mut=0):
         self.val_type = val_type
@@ -115,6 +119,7 @@ class GlobalType:
 
 
 class NameAssoc:
+    __slots__ = ("idx", "name")
 
     def __init__(self, idx=0, name=None):
         self.idx = idx
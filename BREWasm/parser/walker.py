@@ -0,0 +1,129 @@
+from BREWasm.parser.opcodes import Block, Loop, If
+
+block_opcodes = frozenset([Block, Loop, If])
+
+
+class Walker:
+    # A pre-order walk over an expr and its nested blocks that keeps its own stack, so the nesting depth is
+    # not bounded by the recursion limit. Visitors are keyed by opcode and any number of them share the walk:
+    #
+    #   on(opcodes, fn)  fn(instr) for the instructions of opcodes (an opcode, a list of them, or None for all),
+    #                    for Block, Loop and If before their body
+    #   on_else(fn)      fn(instr) between the two arms of each If
+    #   on_end(fn)       fn(instr) after the body of each Block, Loop and If
+    #
+    # Visitors of the same instruction run in the order they were added. fuse combines the visitors of
+    # several walkers so that their analyses cost one walk.
+
+    def __init__(self):
+        # [(opcodes or None, fn)] in the order added
+        self.visitors = []
+        self.elses = []
+        self.ends = []
+        # opcode -> tuple of fns, built on the first walk
+        self.dispatch = None
+        self.default = ()
+
+    def on(self, opcodes, fn):
+        if opcodes is not None and not isinstance(opcodes, (list, tuple, set, frozenset)):
+            opcodes = [opcodes]
+        self.visitors.append((opcodes, fn))
+        self.dispatch = None
+        return self
+
+    def on_else(self, fn):
+        self.elses.append(fn)
+        return self
+
+    def on_end(self, fn):
+        self.ends.append(fn)
+        return self
+
+    @staticmethod
+    def fuse(*walkers):
+        fused = Walker()
+        for walker in walkers:
+            fused.visitors.extend(walker.visitors)
+            fused.elses.extend(walker.elses)
+            fused.ends.extend(walker.ends)
+        return fused
+
+    def build_dispatch(self):
+        keyed = set()
+        for opcodes, _ in self.visitors:
+            if opcodes is not None:
+                keyed.update(opcodes)
+        self.dispatch = {opcode: tuple(fn for opcodes, fn in self.visitors if opcodes is None or opcode in opcodes)
+                         for opcode in keyed}
+        self.default = tuple(fn for opcodes, fn in self.visitors if opcodes is None)
+
+    def walk(self, expr):
+        if self.dispatch is None:
+            self.build_dispatch()
+        dispatch = self.dispatch
+        default = self.default
+
+        def visit_run(instrs):
+            for instr in instrs:
+                for fn in dispatch.get(instr.opcode, default):
+                    fn(instr)
+                if instr.opcode in block_opcodes:
+                    return instr
+            return None
+
+        def visit_keyed_run(instrs):
+            # no visitor of every opcode, most instructions have none
+            for instr in instrs:
+                fns = dispatch.get(instr.opcode)
+                if fns is not None:
+                    for fn in fns:
+                        fn(instr)
+                if instr.opcode in block_opcodes:
+                    return instr
+            return None
+
+        self.walk_runs(expr, visit_run if default else visit_keyed_run, self.elses, self.ends)
+
+    @staticmethod
+    def walk_runs(expr, run, elses=(), ends=()):
+        # The walk itself. run(instrs) consumes instructions from the iterator instrs up to and including the
+        # next Block, Loop or If and returns it, or None once instrs is exhausted; the walk then continues in
+        # the body of that block and resumes instrs after its end. Visitors that handle every instruction
+        # inline their loop this way instead of taking a call per instruction.
+        elses = tuple(elses)
+        ends = tuple(ends)
+        if not elses and not ends:
+            # nothing to call between the bodies, the stack holds iterators only
+            stack = [iter(expr)]
+            push = stack.append
+            while stack:
+                block = run(stack[-1])
+                if block is None:
+                    stack.pop()
+                elif block.opcode == If:
+                    push(iter(block.args.instrs2))
+                    push(iter(block.args.instrs1))
+                else:
+                    push(iter(block.args.instrs))
+            return
+        # iterators of the bodies being walked, and (fns, instr) of the else and end visits pending
+        stack = [iter(expr)]
+        while stack:
+            top = stack.pop()
+            if type(top) is tuple:
+                for fn in top[0]:
+                    fn(top[1])
+                continue
+            block = run(top)
+            if block is None:
+                continue
+            stack.append(top)
+            if ends:
+                stack.append((ends, block))
+            if block.opcode == If:
+                stack.append(iter(block.args.instrs2))
+                if elses:
+                    stack.append((elses, block))
+                stack.append(iter(block.args.instrs1))
+            else:
+                stack.append(iter(block.args.instrs))
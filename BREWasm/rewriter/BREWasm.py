@@ -1,11 +1,51 @@
+from BREWasm.parser.cache import ParseCache
+from BREWasm.parser.shared import SharedModule
+from BREWasm.rewriter.fan_out import map_functions, merge_codes
 from BREWasm.rewriter.modify_binary import ModifyBinary
+from BREWasm.rewriter.section_rewriter import SectionRewriter, section_ids
+from BREWasm.rewriter.xref import XrefIndex
 
 
 class BREWasm:
 
-    def __init__(self, path):
+    def __init__(self, path, lazy=False, workers=1, xref=False, flyweight=False, cache=None, sections=None):
+        # cache: a ParseCache or the directory of one
+        # sections: the sections to decode, by rewriter name ('exportsec', 'importsec', ...) or section id;
+        # the others are emitted as they are in the file and a rewriter touching one raises
         self.path = path
-        self.module = ModifyBinary(module=None, path=path).module
+        if isinstance(cache, str):
+            cache = ParseCache(cache)
+        if sections is not None:
+            sections = {section_ids[sec] if isinstance(sec, str) else sec for sec in sections}
+        self.module = ModifyBinary(module=None, path=path, lazy=lazy, workers=workers,
+                                   flyweight=flyweight, cache=cache, sections=sections).module
+        if xref:
+            XrefIndex.enable(self.module)
 
-    def emit_binary(self, path):
-        ModifyBinary(path=self.path, module=self.module).emit_binary(path)
+    def batch(self):
+        # with binary.batch(): queues the rewriter calls of the block and applies them on exit, all of them or
+        # none. The calls return None inside the block and selects do not see the edits queued before them
+        return SectionRewriter.transaction(self.module)
+
+    def map_functions(self, fn, funcidxs=None, workers=2, flyweight=False):
+        # fn(shared, funcidx) on each function of funcidxs (all the defined ones by default) in a pool of
+        # workers processes. The wasm bytes and the body offsets are published once in shared memory and
+        # fn gets the SharedModule attached in its worker: shared.get_code(funcidx) decodes just that body,
+        # shared.get_module() the whole module with lazy bodies. fn has to be a module level function and
+        # the module unedited since it was decoded. Returns {funcidx: result}
+        with SharedModule.publish(self.module) as shared:
+            if funcidxs is None:
+                funcidxs = shared.get_funcidxs()
+            return map_functions(shared, fn, funcidxs, workers, flyweight)
+
+    def rewrite_functions(self, fn, funcidxs=None, workers=2, flyweight=False):
+        # map_functions with fn returning the new Code(local_vec=..., instr_list=...) of the function, or
+        # None to leave it as it is; the new bodies are applied with the code section rewriter
+        codes = self.map_functions(fn, funcidxs, workers, flyweight)
+        merge_codes(self.module, codes)
+        return codes
+
+    def emit_binary(self, path, reencode=False, copy_clean=False):
+        # reencode: encode everything again, copy_clean: copy the sections not marked dirty from the source
+        # file, see ModifyBinary.emit_binary
+        ModifyBinary(path=self.path, module=self.module).emit_binary(path, reencode, copy_clean)
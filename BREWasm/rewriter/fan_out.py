@@ -0,0 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from BREWasm.parser.shared import SharedModule
+from BREWasm.rewriter.defination import Code
+from BREWasm.rewriter.section_rewriter import SectionRewriter
+
+# name -> SharedModule attached by this worker process, kept for the tasks after the first one
+attached = {}
+
+
+def get_attached(name, flyweight=False):
+    shared = attached.get(name)
+    if shared is None:
+        shared = SharedModule.attach(name, flyweight)
+        attached[name] = shared
+    return shared
+
+
+def run_shard(name, funcidxs, fn, flyweight=False):
+    shared = get_attached(name, flyweight)
+    return [(funcidx, fn(shared, funcidx)) for funcidx in funcidxs]
+
+
+def map_functions(shared, fn, funcidxs, workers, flyweight=False):
+    # fn(shared, funcidx) for each of funcidxs in a pool of workers processes attached to shared; each task
+    # gets a contiguous shard of about the same body bytes. Returns {funcidx: result}
+    funcidxs = list(funcidxs)
+    if not funcidxs:
+        return {}
+    total = sum(shared.get_body_size(funcidx) for funcidx in funcidxs)
+    shard_size = max(total // (workers * 4), 1)
+    shards = []
+    shard = []
+    shard_bytes = 0
+    for funcidx in funcidxs:
+        shard.append(funcidx)
+        shard_bytes += shared.get_body_size(funcidx)
+        if shard_bytes >= shard_size:
+            shards.append(shard)
+            shard = []
+            shard_bytes = 0
+    if shard:
+        shards.append(shard)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_shard, shared.name, shard, fn, flyweight) for shard in shards]
+        for future in futures:
+            results.update(future.result())
+    return results
+
+
+def merge_codes(module, codes):
+    # apply {funcidx: Code(local_vec=..., instr_list=...)} to module with SectionRewriter.update in one
+    # transaction; a None Code leaves its function unchanged
+    rewriter = SectionRewriter(module, codesec=module.code_sec)
+    with SectionRewriter.transaction(module):
+        for funcidx, code in codes.items():
+            if code is not None:
+                rewriter.update(Code(funcidx), code)
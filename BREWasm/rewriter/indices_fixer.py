@@ -1,63 +1,333 @@
 import math
 
+from BREWasm.parser.module import SecImportID, SecFuncID, SecTableID, SecMemID, SecGlobalID, SecExportID, SecStartID, \
+    SecElemID, SecCodeID, SecDataID
 from BREWasm.parser.opcodes import *
 from BREWasm.parser.types import TableType, Limits
+from BREWasm.parser.walker import Walker, block_opcodes
 from BREWasm.rewriter.section_rewriter import *
 
 Insert = 0
 Delete = 1
 
+# index spaces shifted by IndicesFixer.record
+SpaceFunc = 0
+SpaceType = 1
+SpaceGlobal = 2
+SpaceTable = 3
+SpaceMem = 4
+SpaceData = 5
+SpaceElem = 6
+
+# opcode -> index space of its immediate, table.init and table.copy carry two and are handled apart
+index_immediates = {
+    Call: SpaceFunc,
+    RefFunc: SpaceFunc,
+    CallIndirect: SpaceType,
+    GlobalGet: SpaceGlobal,
+    GlobalSet: SpaceGlobal,
+    TableGrow: SpaceTable,
+    TableSize: SpaceTable,
+    TableFill: SpaceTable,
+    MemoryInit: SpaceData,
+    DataDrop: SpaceData,
+    ElemDrop: SpaceElem,
+}
+
+# export tag -> index space
+export_spaces = [SpaceFunc, SpaceTable, SpaceMem, SpaceGlobal]
+
+
+class IndexShifts:
+    # old -> new map of one index space, composed of the inserts and deletes recorded in order
+
+    def __init__(self):
+        self.shifts = []
+        self.memo = {}
+
+    def add(self, idx, delta, seq=0):
+        self.shifts.append((seq, idx, delta))
+        self.memo.clear()
+
+    def map(self, idx):
+        new_idx = self.memo.get(idx)
+        if new_idx is None:
+            new_idx = idx
+            for _, shift_idx, delta in self.shifts:
+                if new_idx >= shift_idx:
+                    new_idx += delta
+            self.memo[idx] = new_idx
+        return new_idx
+
+    def since(self, seq):
+        # the shifts recorded from seq on
+        later = IndexShifts()
+        later.shifts = [shift for shift in self.shifts if shift[0] >= seq]
+        return later
+
+
+class ExprRemapper:
+    # rewrites the index immediates of exprs for one set of remaps in a single walk, with one inline run
+    # visiting all the opcodes concerned
+
+    def __init__(self, remaps, active=None):
+        self.types = remaps.get(SpaceType)
+        self.tables = remaps.get(SpaceTable)
+        self.elems = remaps.get(SpaceElem)
+        self.active = active if active is not None else IndicesFixer.get_active_immediates(remaps)
+        self.changed = False
+
+    def remap(self, expr):
+        # returns whether an immediate changed
+        self.changed = False
+        Walker.walk_runs(expr, self.remap_run)
+        return self.changed
+
+    def remap_run(self, instrs):
+        active = self.active
+        types = self.types
+        for instr in instrs:
+            opcode = instr.opcode
+            shifts = active.get(opcode)
+            if shifts is not None:
+                new_idx = shifts.memo.get(instr.args)
+                if new_idx is None:
+                    new_idx = shifts.map(instr.args)
+                if new_idx != instr.args:
+                    instr.args = new_idx
+                    self.changed = True
+            elif opcode in block_opcodes:
+                args = instr.args
+                if types is not None and args.bt >= 0 and types.map(args.bt) != args.bt:
+                    args.bt = types.map(args.bt)
+                    self.changed = True
+                return instr
+            elif opcode == TableInit:
+                self.remap_table_init(instr)
+            elif opcode == TableCopy:
+                self.remap_table_copy(instr)
+        return None
+
+    def remap_table_init(self, instr):
+        if self.elems is not None and self.elems.map(instr.args.x) != instr.args.x:
+            instr.args.x = self.elems.map(instr.args.x)
+            self.changed = True
+        if self.tables is not None and self.tables.map(instr.args.y) != instr.args.y:
+            instr.args.y = self.tables.map(instr.args.y)
+            self.changed = True
+
+    def remap_table_copy(self, instr):
+        if self.tables is not None and (self.tables.map(instr.args.x) != instr.args.x or
+                                        self.tables.map(instr.args.y) != instr.args.y):
+            instr.args.x = self.tables.map(instr.args.x)
+            instr.args.y = self.tables.map(instr.args.y)
+            self.changed = True
+
 
 class IndicesFixer:
-    def __init__(self, module):
+    def __init__(self, module, deferred=False):
         self.module = module
+        # index space -> IndexShifts recorded since the last apply
+        self.remaps = {}
+        # a deferred fixer belongs to a Transaction, apply is a no-op and the shifts wait for flush
+        self.deferred = deferred
+        self.seq = 0
+        # id -> (item, seq) of the code bodies, exports and elems written while deferred, their references
+        # are already in the numbering of seq and only the shifts recorded from seq on apply to them
+        self.written = {}
+
+    def get_target(self):
+        # while a transaction replays its edits, every fixer of the module records into the transaction's
+        transaction = self.module._transaction
+        if transaction is not None and transaction.replaying:
+            return transaction.fixer
+        return self
+
+    def record(self, space, idx, type=Insert):
+        # an item was inserted at or deleted from idx of the index space, references at or above it move.
+        # Any number of shifts can be recorded before apply; they compose in the order they were recorded
+        # and only apply to references that existed before the first of them
+        target = self.get_target()
+        if target is not self:
+            target.record(space, idx, type)
+            return
+        delta = 1 if type == Insert else -1
+        if self.deferred and space == SpaceType:
+            # type references also live in func_sec and the imports which are not tracked, shift them now
+            types = IndexShifts()
+            types.add(idx, delta)
+            self.remap_module({SpaceType: types})
+            return
+        if space not in self.remaps:
+            self.remaps[space] = IndexShifts()
+        self.remaps[space].add(idx, delta, self.seq)
+        self.seq += 1
+
+    def mark_written(self, item):
+        # item now holds references in the current numbering
+        target = self.get_target()
+        if target.deferred:
+            target.written[id(item)] = (item, target.seq)
+
+    def settle(self):
+        # apply the shifts a transaction holds back before references of the module are read
+        target = self.get_target()
+        if target.deferred and (target.remaps or target.written):
+            target.flush()
+
+    def apply(self):
+        # rewrite every index reference of the module for the recorded shifts in a single pass
+        if self.deferred or not self.remaps:
+            return
+        remaps = self.remaps
+        self.remaps = {}
+        self.remap_module(remaps)
+
+    def flush(self):
+        remaps, written = self.remaps, self.written
+        self.remaps, self.written, self.seq = {}, {}, 0
+        if remaps:
+            self.remap_module(remaps, written)
+
+    @staticmethod
+    def get_item_remaps(remaps, written, item, cache):
+        # the shifts that apply to item: all of them unless it was written after some were recorded
+        entry = written.get(id(item)) if written else None
+        if entry is None or entry[0] is not item:
+            return remaps
+        seq = entry[1]
+        if seq not in cache:
+            later = {}
+            for space, shifts in remaps.items():
+                shifts = shifts.since(seq)
+                if shifts.shifts:
+                    later[space] = shifts
+            cache[seq] = later
+        return cache[seq]
+
+    @staticmethod
+    def get_remapper(remaps, remappers):
+        if id(remaps) not in remappers:
+            remappers[id(remaps)] = ExprRemapper(remaps)
+        return remappers[id(remaps)]
+
+    def remap_module(self, remaps, written=None):
+        module = self.module
+        cache = {}
+        # id(remaps) -> ExprRemapper, for the remaps of cache and remaps itself
+        remappers = {}
+
+        types = remaps.get(SpaceType)
+        if types is not None:
+            for i, typeidx in enumerate(module.func_sec):
+                if types.map(typeidx) != typeidx:
+                    module.func_sec[i] = types.map(typeidx)
+                    module.mark_dirty(SecFuncID)
+            for item in module.import_sec:
+                if item.desc.func_type is not None and types.map(item.desc.func_type) != item.desc.func_type:
+                    item.desc.func_type = types.map(item.desc.func_type)
+                    module.mark_dirty(SecImportID)
+
+        for item in module.export_sec:
+            shifts = self.get_item_remaps(remaps, written, item, cache).get(export_spaces[item.desc.tag])
+            if shifts is not None and shifts.map(item.desc.idx) != item.desc.idx:
+                item.desc.idx = shifts.map(item.desc.idx)
+                module.mark_dirty(SecExportID)
+
+        funcs = remaps.get(SpaceFunc)
+        if funcs is not None and module.start_sec is not None and funcs.map(module.start_sec) != module.start_sec:
+            module.start_sec = funcs.map(module.start_sec)
+            module.mark_dirty(SecStartID)
+
+        for elem in module.elem_sec:
+            elem_remaps = self.get_item_remaps(remaps, written, elem, cache)
+            tables = elem_remaps.get(SpaceTable)
+            funcs = elem_remaps.get(SpaceFunc)
+            changed = self.get_remapper(elem_remaps, remappers).remap(elem.offset)
+            if tables is not None and tables.map(elem.table) != elem.table:
+                elem.table = tables.map(elem.table)
+                changed = True
+            if funcs is not None:
+                for i, funcidx in enumerate(elem.init):
+                    if funcs.map(funcidx) != funcidx:
+                        elem.init[i] = funcs.map(funcidx)
+                        changed = True
+            if changed:
+                module.mark_dirty(SecElemID)
+
+        mems = remaps.get(SpaceMem)
+        for data in module.data_sec:
+            changed = self.get_remapper(remaps, remappers).remap(data.offset)
+            if mems is not None and mems.map(data.mem) != data.mem:
+                data.mem = mems.map(data.mem)
+                changed = True
+            if changed:
+                module.mark_dirty(SecDataID)
+
+        for global_item in module.global_sec:
+            if self.get_remapper(remaps, remappers).remap(global_item.init):
+                module.mark_dirty(SecGlobalID)
+
+        code_spaces = [space for space in [SpaceFunc, SpaceType, SpaceGlobal, SpaceTable, SpaceData, SpaceElem]
+                       if space in remaps]
+        xref = module.xref
+        if code_spaces and xref is not None and all(space in [SpaceFunc, SpaceGlobal] for space in code_spaces):
+            # only the sites of the shifted indices are visited
+            xref.sync()
+            for space in code_spaces:
+                get_shifts = None
+                if written:
+                    get_shifts = lambda code, space=space: self.get_item_remaps(remaps, written, code, cache).get(space)
+                for code in xref.remap(space, remaps[space], get_shifts):
+                    code.invalidate()
+                    module.mark_dirty(SecCodeID)
+        elif code_spaces:
+            for code in module.code_sec:
+                code_remaps = self.get_item_remaps(remaps, written, code, cache)
+                if code_remaps and self.get_remapper(code_remaps, remappers).remap(code.peek_expr()):
+                    code.invalidate()
+                    module.mark_dirty(SecCodeID)
+                    if xref is not None:
+                        xref.rescan(code)
+
+    @staticmethod
+    def get_active_immediates(remaps):
+        # opcode -> shifts of its immediate, for the spaces that moved
+        return {opcode: remaps[space] for opcode, space in index_immediates.items() if space in remaps}
+
+    @staticmethod
+    def remap_expr(expr, remaps, active=None):
+        # rewrite the index immediates of expr and its nested blocks, returns whether one changed
+        return ExprRemapper(remaps, active).remap(expr)
 
     def fix_call_instructions(self, expr, funcidx, type=None):
-        for _, instr in enumerate(expr):
-            if instr.opcode == Call and instr.args >= funcidx:
-                if type is None or type == Insert:
-                    instr.args += 1
-                elif type == Delete:
-                    instr.args -= 1
-            elif instr.opcode == If:
-                self.fix_call_instructions(instr.args.instrs1, funcidx)
-                self.fix_call_instructions(instr.args.instrs2, funcidx)
-            elif instr.opcode in [Block, Loop]:
-                self.fix_call_instructions(instr.args.instrs, funcidx)
-            else:
-                pass
+        self.module.mark_dirty(SecCodeID)
+        return self.fix_instructions(expr, [Call], funcidx, type)
 
     def fix_callIndirect_instructions(self, expr, typeidx, type=None):
-        for _, instr in enumerate(expr):
-            if instr.opcode == CallIndirect and instr.args >= typeidx:
-                if type is None or type == Insert:
-                    instr.args += 1
-                elif type == Delete:
-                    instr.args -= 1
-            elif instr.opcode == If:
-                self.fix_callIndirect_instructions(instr.args.instrs1, typeidx)
-                self.fix_callIndirect_instructions(instr.args.instrs2, typeidx)
-            elif instr.opcode in [Block, Loop]:
-                self.fix_callIndirect_instructions(instr.args.instrs, typeidx)
-            else:
-                pass
+        self.module.mark_dirty(SecCodeID)
+        return self.fix_instructions(expr, [CallIndirect], typeidx, type)
 
     def fix_global_instructions(self, expr, globalidx, type=None):
-        for _, instr in enumerate(expr):
-            if (instr.opcode == GlobalGet or instr.opcode == GlobalSet) and instr.args >= globalidx:
-                if type is None or type == Insert:
-                    instr.args += 1
-                elif type == Delete:
-                    instr.args -= 1
-            elif instr.opcode == If:
-                self.fix_global_instructions(instr.args.instrs1, globalidx)
-                self.fix_global_instructions(instr.args.instrs2, globalidx)
-            elif instr.opcode in [Block, Loop]:
-                self.fix_global_instructions(instr.args.instrs, globalidx)
-            else:
-                pass
+        self.module.mark_dirty(SecCodeID)
+        return self.fix_instructions(expr, [GlobalGet, GlobalSet], globalidx, type)
+
+    @staticmethod
+    def fix_instructions(expr, opcodes, idx, type=None):
+        # move the immediates of opcodes at or above idx by one, returns whether one changed
+        delta = -1 if type == Delete else 1
+        fixed = []
+
+        def fix(instr):
+            if instr.args >= idx:
+                instr.args += delta
+                fixed.append(instr)
+
+        Walker().on(opcodes, fix).walk(expr)
+        return len(fixed) != 0
 
     def fix_elem_funcidx(self, elem_sec, funcidx, type=None):
+        self.module.mark_dirty(SecElemID)
         for elem in elem_sec:
             for _, func_idx in enumerate(elem.init):
                 if func_idx >= funcidx:
@@ -74,6 +344,7 @@ class IndicesFixer:
     #     return item_idx
 
     def fix_export_funcidx(self, export_sec, funcidx, type=None):
+        self.module.mark_dirty(SecExportID)
         for export_item in export_sec:
             if export_item.desc.tag == 0 and export_item.desc.idx >= funcidx:
                 if type is None or type == Insert:
@@ -82,6 +353,7 @@ class IndicesFixer:
                     export_item.desc.idx -= 1
 
     def fix_export_globalidx(self, export_sec, globalidx, type=None):
+        self.module.mark_dirty(SecExportID)
         for export_item in export_sec:
             if export_item.desc.tag == 3 and export_item.desc.idx >= globalidx:
                 if type is None or type == Insert:
@@ -90,6 +362,7 @@ class IndicesFixer:
                     export_item.desc.idx += 1
 
     def fix_func_functypeidx(self, func_sec, functypeidx, type=None):
+        self.module.mark_dirty(SecFuncID)
         for _, idx in enumerate(func_sec):
             if idx >= functypeidx:
                 if type is None or type == Insert:
@@ -98,6 +371,7 @@ class IndicesFixer:
                     func_sec[_] -= 1
 
     def fix_import_func_functypeidx(self, import_sec, functypeidx, type=None):
+        self.module.mark_dirty(SecImportID)
         for item in import_sec:
             if item.desc.func_type is not None and item.desc.func_type >= functypeidx:
                 if type is None or type == Insert:
@@ -106,11 +380,13 @@ class IndicesFixer:
                     item.desc.func_type -= 1
 
     def fix_table_limits(self, table_sec, indirect_func_num, type=None):
+        self.module.mark_dirty(SecTableID)
         if not table_sec:
             table_sec.append(TableType(limits=Limits(1, indirect_func_num + 1, indirect_func_num + 1)))
         elif table_sec[0].limits.max != 0 and indirect_func_num > table_sec[0].limits.max:
             table_sec[0].limits.max = (indirect_func_num + 1)
 
     def fix_memory_limits(self, mem_sec, length, type=None):
+        self.module.mark_dirty(SecMemID)
         if mem_sec[0].max != 0 and length >= mem_sec[0].max * 65536:
             mem_sec[0].max += math.ceil((length - mem_sec[0].max) / 65536)
@@ -6,14 +6,56 @@ from BREWasm.parser import reader
 from BREWasm.parser.instruction import Instruction
 from BREWasm.parser.module import *
 from BREWasm.parser.opcodes import *
+from BREWasm.parser.opnames import opcode_table, ImmNone, ImmBlock, ImmIf, ImmBrTable, ImmCallIndirect, ImmVarU32, \
+    ImmVarS32, ImmVarS64, ImmF32, ImmF64, ImmV128, ImmLane, ImmZero, ImmTableArg, ImmMemArg, ImmMemLaneArg
 from BREWasm.parser.types import val_type_to_str, GlobalType
+from BREWasm.parser.walker import Walker, block_opcodes
+
+
+# immediate kind -> name of the ModifyBinary method appending its encoding to a bytearray
+imm_writers = {
+    ImmNone: None,
+    ImmBlock: "write_block_args_to",
+    ImmIf: "write_if_args_to",
+    ImmBrTable: "write_br_table_args_to",
+    ImmCallIndirect: "write_call_indirect_args_to",
+    ImmVarU32: "write_var_u32_to",
+    ImmVarS32: "write_var_s_to",
+    ImmVarS64: "write_var_s_to",
+    ImmF32: "write_f32_to",
+    ImmF64: "write_f64_to",
+    ImmV128: "write_v128_to",
+    ImmLane: "write_lane_to",
+    ImmZero: "write_zero_to",
+    ImmTableArg: "write_table_arg_to",
+    ImmMemArg: "write_mem_arg_to",
+    ImmMemLaneArg: "write_mem_lane_arg_to",
+}
+
+
+def is_same_file(path, other):
+    # modules loaded from a snapshot have no file, or one that is gone
+    return path is not None and os.path.isfile(path) and os.path.samefile(path, other)
 
 
 class ModifyBinary:
 
-    def __init__(self, module: Module, path: str):
+    def __init__(self, module: Module, path: str, lazy=False, workers=1, flyweight=False, cache=None,
+                 sections=None):
+        # opcode -> (encoded opcode, bound method appending its immediates or None)
+        self.arg_encoders = {}
+        for opcode, info in opcode_table.items():
+            name = imm_writers[info.imm]
+            self.arg_encoders[opcode] = (info.prefix, getattr(self, name) if name is not None else None)
+        # the nested bodies are walked by the encoder, blocks only write their head before them
+        self.head_encoders = dict(self.arg_encoders)
+        for opcode in block_opcodes:
+            self.head_encoders[opcode] = (opcode_table[opcode].prefix, self.write_block_type_to)
+        self.encode_out = None
+
         if module is None:
-            module, err = reader.decode_file(path)
+            module, err = reader.decode_file(path, lazy=lazy, workers=workers, flyweight=flyweight,
+                                             cache=cache, sections=sections)
             if err is not None:
                 print(err.args)
                 print("=================================")
@@ -23,30 +65,49 @@ class ModifyBinary:
             self.module.path = path
 
             self.func_name = []
-            for custom in self.module.custom_secs:
-                if custom.name == "name":
-                    if custom.name_data.funcNameSubSec is not None:
-
-                        for func_name_item in custom.name_data.funcNameSubSec[self.get_import_func_num():]:
-                            self.func_name.append(func_name_item.name)
+            # the names need the custom and import sections, left empty when one was not decoded
+            if self.module.is_decoded(SecCustomID) and self.module.is_decoded(SecImportID):
+                for custom in self.module.custom_secs:
+                    if custom.name == "name":
+                        if custom.name_data.funcNameSubSec is not None:
+
+                            for func_name_item in custom.name_data.funcNameSubSec[self.get_import_func_num():]:
+                                self.func_name.append(func_name_item.name)
         else:
             self.module = module
             self.module.path = path
 
     def get_import_func_num(self):
-
-        num = 0
-        for _, import_item in enumerate(self.module.import_sec):
-            if import_item.desc.func_type != None:
-                num += 1
-
-        return num
-
-    def emit_binary(self, path):
-
+        return self.module.get_import_func_num()
+
+    def emit_binary(self, path, reencode=False, copy_clean=False):
+        # The sections not decoded (sections=) are copied from the source file, and so is the code section
+        # while none of its bodies was handed out for editing, see Code. The other sections are encoded again
+        # unless copy_clean is set: then the ones no rewriter marked dirty are copied as well, which loses any
+        # edit made directly on their objects (module.global_sec[0].init[0].args = ...) without
+        # Module.mark_dirty.
+        # reencode: encode every decoded section and code body again
+        if self.module.undecoded_secs and not self.module.has_source():
+            # the sections left undecoded by sections= only exist as byte ranges of the source file
+            raise Exception("the source file %s changed since it was decoded with sections=, the sections not "
+                            "decoded cannot be emitted" % self.module.source_path)
+        if reencode and self.module.is_decoded(SecCodeID):
+            self.module.invalidate_codes()
+
+        target = path
         if os.path.isfile(path):
-            if not os.path.samefile(self.module.path, path):
+            if not is_same_file(self.module.path, path) and not (
+                    self.module.has_source() and os.path.samefile(self.module.source_path, path)):
                 os.remove(path)
+            else:
+                # the module may still be backed by the original file (mapped data, sections copied on emit),
+                # write aside and swap. A mapping of the file is released first, a mapped file cannot be
+                # replaced everywhere
+                self.module.close()
+                path = path + ".tmp"
+
+        # sections left untouched since decoding may be copied from the source file as they are
+        src = open(self.module.source_path, "rb") if self.module.has_source() else None
 
         with open(path, "wb+") as f:
 
@@ -54,33 +115,74 @@ class ModifyBinary:
             f.write(magic_version_number)
 
 
-            if self.module.type_sec:
+            if not self.pass_through(src, f, SecTypeID, reencode, copy_clean) and self.module.type_sec:
                 self.emit_type_section(self.module.type_sec, f)
-            if self.module.import_sec:
+            if not self.pass_through(src, f, SecImportID, reencode, copy_clean) and self.module.import_sec:
                 self.emit_import_section(self.module.import_sec, f)
-            if self.module.func_sec:
+            if not self.pass_through(src, f, SecFuncID, reencode, copy_clean) and self.module.func_sec:
                 self.emit_func_section(self.module.func_sec, f)
-            if self.module.table_sec:
+            if not self.pass_through(src, f, SecTableID, reencode, copy_clean) and self.module.table_sec:
                 self.emit_table_section(self.module.table_sec, f)
-            if self.module.mem_sec:
+            if not self.pass_through(src, f, SecMemID, reencode, copy_clean) and self.module.mem_sec:
                 self.emit_memory_section(self.module.mem_sec, f)
-            if self.module.global_sec:
+            if not self.pass_through(src, f, SecGlobalID, reencode, copy_clean) and self.module.global_sec:
                 self.emit_global_section(self.module.global_sec, f)
-            if self.module.export_sec:
+            if not self.pass_through(src, f, SecExportID, reencode, copy_clean) and self.module.export_sec:
                 self.emit_export_section(self.module.export_sec, f)
-            if self.module.start_sec:
+            if not self.pass_through(src, f, SecStartID, reencode, copy_clean) and self.module.start_sec:
                 self.emit_start_section(self.module.start_sec, f)
-            if self.module.elem_sec:
+            if not self.pass_through(src, f, SecElemID, reencode, copy_clean) and self.module.elem_sec:
                 self.emit_elem_section(self.module.elem_sec, f)
-            if self.module.code_sec:
+            if not self.pass_through(src, f, SecCodeID, reencode, copy_clean) and self.module.code_sec:
                 self.emit_code_section(self.module.code_sec, f)
-            if self.module.data_sec:
+            if not self.pass_through(src, f, SecDataID, reencode, copy_clean) and self.module.data_sec:
                 self.emit_data_section(self.module.data_sec, f)
-            if self.module.datacount_sec:
+            if not self.pass_through(src, f, SecDataCountID, reencode, copy_clean) and self.module.datacount_sec:
                 self.emit_datacount_section(self.module.datacount_sec, f)
-            if self.module.custom_secs:
+            if not self.pass_through(src, f, SecCustomID, reencode, copy_clean) and self.module.custom_secs:
                 self.emit_custom_section(self.module.custom_secs, f)
 
+        if src is not None:
+            src.close()
+
+        if path != target:
+            os.replace(path, target)
+
+
+    def pass_through(self, src, fp, sec_id, reencode=False, copy_clean=False):
+        if src is None or not self.module.is_clean(sec_id):
+            return False
+        if self.module.is_decoded(sec_id) and (reencode or not copy_clean and sec_id != SecCodeID):
+            return False
+        if sec_id == SecCustomID:
+            for sec_range in self.module.section_range[SecCustomID]:
+                self.copy_range(src, fp, sec_range.start, sec_range.end)
+        else:
+            sec_range = self.module.section_range[sec_id]
+            self.copy_range(src, fp, sec_range.start, sec_range.end)
+        return True
+
+    @staticmethod
+    def copy_range(src, fp, start, end):
+        # append src[start:end] to fp, inside the kernel where os.copy_file_range is available
+        fp.flush()
+        pos = fp.tell()
+        count = end - start
+        if hasattr(os, "copy_file_range"):
+            try:
+                while count > 0:
+                    n = os.copy_file_range(src.fileno(), fp.fileno(), count, start, pos)
+                    if n == 0:
+                        break
+                    start, pos, count = start + n, pos + n, count - n
+            except OSError:
+                pass
+        if count > 0:
+            src.seek(start)
+            fp.seek(pos)
+            fp.write(src.read(count))
+            pos += count
+        fp.seek(pos)
 
     def print_function(self, func_id):
 
@@ -103,144 +205,125 @@ class ModifyBinary:
         print("(param %s)" % param_types_str, end="")
         print("(result %s)" % result_types_str)
 
-        if self.module.code_sec[func_id].locals is not None:
+        if self.module.code_sec[func_id].peek_locals() is not None:
             print("(locals", end=" ")
-            for local in self.module.code_sec[func_id].locals:
+            for local in self.module.code_sec[func_id].peek_locals():
                 print((val_type_to_str(local.type) + " ") * local.n, end="")
             print(")")
-        self.dump_expr("    ", self.module.code_sec[func_id].expr)
+        self.dump_expr("    ", self.module.code_sec[func_id].peek_expr())
         print(")")
 
 
     def dump_expr(self, indentation, expr):
 
-        for _, instr in enumerate(expr):
-            if instr.opcode in [Block, Loop]:
-                args = instr.args
-                bt = self.module.get_block_type(args.bt)
-                print("%s%s %s" % (indentation, instr.get_opname(), bt))
-                self.dump_expr(indentation + "  ", args.instrs)
-                print("%s%s" % (indentation, "end"))
-            elif instr.opcode == If:
-                args = instr.args
-                bt = self.module.get_block_type(args.bt)
+        # the indentation of the body being printed, one level deeper per open block
+        levels = [indentation]
+
+        def dump_instr(instr):
+            info = opcode_table[instr.opcode]
+            indentation = levels[-1]
+            if info.imm == ImmBlock:
+                bt = self.module.get_block_type(instr.args.bt)
+                print("%s%s %s" % (indentation, info.name, bt))
+                levels.append(indentation + "  ")
+            elif info.imm == ImmIf:
+                bt = self.module.get_block_type(instr.args.bt)
                 print("%s%s %s" % (indentation, "if", bt))
-                self.dump_expr(indentation + "  ", args.instrs1)
-                print("%s%s" % (indentation, "else"))
-                self.dump_expr(indentation + "  ", args.instrs2)
-                print("%s%s" % (indentation, "end"))
+                levels.append(indentation + "  ")
+            elif instr.args is not None:
+                if info.imm == ImmMemArg:
+                    print("{}{} align={} offset={} ".format(indentation, info.name, instr.args.align,
+                                                            instr.args.offset))
+                elif info.imm == ImmMemLaneArg:
+                    print("{}{} align={} offset={} {}".format(indentation, info.name, instr.args.mem_arg.align,
+                                                              instr.args.mem_arg.offset, instr.args.laneidx))
+                else:
+                    print("{}{} {}".format(indentation, info.name, instr.args))
             else:
-                if instr.args is not None:
-                    if 0x36 <= instr.opcode <= 0x3E or 0x28 <= instr.opcode <= 0x35:
-                        print("{}{} align={} offset={} ".format(indentation, instr.get_opname(), instr.args.align,
-                                                                instr.args.offset))
-                    else:
-                        print("{}{} {}".format(indentation, instr.get_opname(), instr.args))
-                elif instr.args is None:
-                    print("{}{}".format(indentation, instr.get_opname()))
+                print("{}{}".format(indentation, info.name))
 
+        def dump_else(instr):
+            print("%s%s" % (levels[-2], "else"))
 
+        def dump_end(instr):
+            levels.pop()
+            print("%s%s" % (levels[-1], "end"))
+
+        Walker().on(None, dump_instr).on_else(dump_else).on_end(dump_end).walk(expr)
+
+    @staticmethod
+    def write_section(fp, sec_id, payload):
+        fp.write(bytes([sec_id]) + LEB128U.encode(len(payload)))
+        fp.write(payload)
+
+    @staticmethod
+    def patch_length(out, start):
+        # everything after start was written without its size, prefix it now
+        out[start:start] = LEB128U.encode(len(out) - start)
+
+    @staticmethod
+    def write_raw_subsec(out, subsec_id, subsec):
+        out.append(subsec_id)
+        out += LEB128U.encode(len(subsec))
+        out += subsec
+
+    @staticmethod
+    def write_name_map_subsec(out, subsec_id, name_map):
+        out.append(subsec_id)
+        start = len(out)
+        out += LEB128U.encode(len(name_map))
+        for name_item in name_map:
+            out += LEB128U.encode(name_item.idx)
+            out += LEB128U.encode(len(name_item.name))
+            out += bytes(name_item.name, encoding="utf-8")
+        ModifyBinary.patch_length(out, start)
 
     def emit_custom_section(self, custom_vec: list, fp):
 
         for _, custom in enumerate(custom_vec):
             if custom.name == "name":
-                name_section_bytes = bytes()
+                name_section_bytes = bytearray()
                 name_section_bytes += LEB128U.encode(len(custom.name))
                 name_section_bytes += bytes(custom.name, encoding="utf-8")
-                if custom.name_data.moduleNameSubSec != None:
-                    name_section_bytes += bytes([0x00])
-                    name_section_bytes += LEB128U.encode(len(custom.name_data.moduleNameSubSec))
-                    name_section_bytes += custom.name_data.moduleNameSubSec
-                if custom.name_data.funcNameSubSec != []:
-
-                    funcname_bytes = bytes()
-                    funcname_bytes += LEB128U.encode(len(custom.name_data.funcNameSubSec))
-                    for funcname in custom.name_data.funcNameSubSec:
-                        funcname_bytes += LEB128U.encode(funcname.idx)
-                        funcname_bytes += LEB128U.encode(len(funcname.name))
-                        funcname_bytes += bytes(funcname.name, encoding="utf-8")
-                    name_section_bytes += (bytes([0x01]) + LEB128U.encode(len(funcname_bytes))) + funcname_bytes
-
-                if custom.name_data.localNameSubSec != None:
-                    name_section_bytes += bytes([0x02])
-                    name_section_bytes += LEB128U.encode(len(custom.name_data.localNameSubSec))
-                    name_section_bytes += custom.name_data.localNameSubSec
-                if custom.name_data.labelsNameSubSec != None:
-                    name_section_bytes += bytes([0x03])
-                    name_section_bytes += LEB128U.encode(len(custom.name_data.labelsNameSubSec))
-                    name_section_bytes += custom.name_data.labelsNameSubSec
-                if custom.name_data.typeNameSubSec != None:
-                    name_section_bytes += bytes([0x04])
-                    name_section_bytes += LEB128U.encode(len(custom.name_data.typeNameSubSec))
-                    name_section_bytes += custom.name_data.typeNameSubSec
-                if custom.name_data.tableNameSubSec != []:
-                    tablename_bytes = bytes()
-                    tablename_bytes += LEB128U.encode(len(custom.name_data.tableNameSubSec))
-                    for tablename in custom.name_data.tableNameSubSec:
-                        tablename_bytes += LEB128U.encode(tablename.idx)
-                        tablename_bytes += LEB128U.encode(len(tablename.name))
-                        tablename_bytes += bytes(tablename.name, encoding="utf-8")
-                    name_section_bytes += (bytes([0x05]) + LEB128U.encode(len(tablename_bytes))) + tablename_bytes
-                if custom.name_data.memoryNameSubSec != None:
-                    name_section_bytes += bytes([0x06])
-                    name_section_bytes += LEB128U.encode(len(custom.name_data.memoryNameSubSec))
-                    name_section_bytes += custom.name_data.memoryNameSubSec
-                if custom.name_data.globalNameSubSec != []:
-                    globalname_bytes = bytes()
-                    globalname_bytes += LEB128U.encode(len(custom.name_data.globalNameSubSec))
-                    for globalname in custom.name_data.globalNameSubSec:
-                        globalname_bytes += LEB128U.encode(globalname.idx)
-                        globalname_bytes += LEB128U.encode(len(globalname.name))
-                        globalname_bytes += bytes(globalname.name, encoding="utf-8")
-                    name_section_bytes += (bytes([0x07]) + LEB128U.encode(len(globalname_bytes))) + globalname_bytes
-                if custom.name_data.elemNameSubSec != None:
-                    name_section_bytes += bytes([0x08])
-                    name_section_bytes += LEB128U.encode(len(custom.name_data.elemNameSubSec))
-                    name_section_bytes += custom.name_data.elemNameSubSec
-                if custom.name_data.dataNameSubSec != []:
-                    dataname_bytes = bytes()
-                    dataname_bytes += LEB128U.encode(len(custom.name_data.dataNameSubSec))
-                    for dataname in custom.name_data.dataNameSubSec:
-                        dataname_bytes += LEB128U.encode(dataname.idx)
-                        dataname_bytes += LEB128U.encode(len(dataname.name))
-                        dataname_bytes += bytes(dataname.name, encoding="utf-8")
-                    name_section_bytes += (bytes([0x09]) + LEB128U.encode(len(dataname_bytes))) + dataname_bytes
-
-
-                name_section_bytes = bytes([0x00]) + LEB128U.encode(len(name_section_bytes)) + name_section_bytes
-
-                fp.write(name_section_bytes)
+                name_data = custom.name_data
+                if name_data.moduleNameSubSec != None:
+                    self.write_raw_subsec(name_section_bytes, 0x00, name_data.moduleNameSubSec)
+                if name_data.funcNameSubSec != []:
+                    self.write_name_map_subsec(name_section_bytes, 0x01, name_data.funcNameSubSec)
+                if name_data.localNameSubSec != None:
+                    self.write_raw_subsec(name_section_bytes, 0x02, name_data.localNameSubSec)
+                if name_data.labelsNameSubSec != None:
+                    self.write_raw_subsec(name_section_bytes, 0x03, name_data.labelsNameSubSec)
+                if name_data.typeNameSubSec != None:
+                    self.write_raw_subsec(name_section_bytes, 0x04, name_data.typeNameSubSec)
+                if name_data.tableNameSubSec != []:
+                    self.write_name_map_subsec(name_section_bytes, 0x05, name_data.tableNameSubSec)
+                if name_data.memoryNameSubSec != None:
+                    self.write_raw_subsec(name_section_bytes, 0x06, name_data.memoryNameSubSec)
+                if name_data.globalNameSubSec != []:
+                    self.write_name_map_subsec(name_section_bytes, 0x07, name_data.globalNameSubSec)
+                if name_data.elemNameSubSec != None:
+                    self.write_raw_subsec(name_section_bytes, 0x08, name_data.elemNameSubSec)
+                if name_data.dataNameSubSec != []:
+                    self.write_name_map_subsec(name_section_bytes, 0x09, name_data.dataNameSubSec)
+
+                self.write_section(fp, SecCustomID, name_section_bytes)
             else:
-                custom_section_bytes = bytes()
-                custom_section_bytes += custom.custom_sec_data
-
-                custom_section_bytes = bytes([0x00]) + LEB128U.encode(
-                    len(custom_section_bytes)) + custom_section_bytes
-                fp.write(custom_section_bytes)
+                self.write_section(fp, SecCustomID, custom.custom_sec_data)
 
     def emit_start_section(self, start_funcid, fp):
-        start_funcid_bytes = LEB128U.encode(start_funcid)
-        start_section_bytes = bytes([0x08]) + LEB128U.encode(len(start_funcid_bytes)) + start_funcid_bytes
-
-        fp.write(start_section_bytes)
+        self.write_section(fp, SecStartID, LEB128U.encode(start_funcid))
 
 
     def emit_datacount_section(self, datacount: int, fp):
         if datacount != None:
-            datacount_bytes = LEB128U.encode(datacount)
-            datacount_section_bytes = bytes([SecDataCountID]) + LEB128U.encode(len(datacount_bytes)) + datacount_bytes
-
-            fp.write(datacount_section_bytes)
+            self.write_section(fp, SecDataCountID, LEB128U.encode(datacount))
 
     def emit_import_section(self, import_vec: list, fp):
 
-        import_vec_len = len(import_vec)
-        import_vec_len_bytes = LEB128U.encode(import_vec_len)
-        import_vec_bytes = bytes()
-        import_vec_bytes += import_vec_len_bytes
         if import_vec == []:
             return
+        import_vec_bytes = bytearray(LEB128U.encode(len(import_vec)))
         for i in import_vec:
             import_vec_bytes += LEB128U.encode(len(i.module))
             import_vec_bytes += bytes(i.module, encoding="utf-8")
@@ -255,380 +338,351 @@ class ModifyBinary:
                 import_vec_bytes += self.write_limits(i.desc.mem)
             elif i.desc.global_type is not None:
                 import_vec_bytes += self.write_global_type(i.desc.global_type)
-        import_section_bytes = bytes([0x02]) + LEB128U.encode(len(import_vec_bytes)) + import_vec_bytes
 
-        fp.write(import_section_bytes)
+        self.write_section(fp, SecImportID, import_vec_bytes)
 
     def emit_export_section(self, export_vec: list, fp):
-        export_vec_len = len(export_vec)
-        export_vec_len_bytes = LEB128U.encode(export_vec_len)
-        export_vec_bytes = bytes()
-        export_vec_bytes += export_vec_len_bytes
         if export_vec == []:
             return
+        export_vec_bytes = bytearray(LEB128U.encode(len(export_vec)))
         for export_item in export_vec:
             export_vec_bytes += LEB128U.encode(len(export_item.name))
             export_vec_bytes += bytes(export_item.name, encoding="utf-8")
             export_vec_bytes += LEB128U.encode(export_item.desc.tag)
             export_vec_bytes += LEB128U.encode(export_item.desc.idx)
 
-        export_section_bytes = bytes([0x07]) + LEB128U.encode(len(export_vec_bytes)) + export_vec_bytes
-
-        fp.write(export_section_bytes)
+        self.write_section(fp, SecExportID, export_vec_bytes)
 
     def emit_memory_section(self, memory_vec: list, fp):
-        memory_vec_len = len(memory_vec)
-        memory_vec_len_bytes = LEB128U.encode(memory_vec_len)
-        memory_vec_bytes = bytes()
-        memory_vec_bytes += memory_vec_len_bytes
         if memory_vec == []:
             return
+        memory_vec_bytes = bytearray(LEB128U.encode(len(memory_vec)))
         for memory_item in memory_vec:
-            memory_item_bytes = bytes()
-            memory_item_bytes += bytes([memory_item.tag])
-            memory_item_bytes += LEB128U.encode(memory_item.min)
+            memory_vec_bytes.append(memory_item.tag)
+            memory_vec_bytes += LEB128U.encode(memory_item.min)
             if memory_item.max != 0:
-                memory_item_bytes += LEB128U.encode(memory_item.max)
-            memory_vec_bytes += memory_item_bytes
+                memory_vec_bytes += LEB128U.encode(memory_item.max)
 
-        memroy_section_bytes = bytes([SecMemID]) + LEB128U.encode(len(memory_vec_bytes)) + memory_vec_bytes
-
-        fp.write(memroy_section_bytes)
+        self.write_section(fp, SecMemID, memory_vec_bytes)
 
     def emit_data_section(self, data_vec: list, fp):
-        data_vec_len = len(data_vec)
-        data_vec_len_bytes = LEB128U.encode(data_vec_len)
-        data_vec_bytes = bytes()
-        data_vec_bytes += data_vec_len_bytes
         if not data_vec:
             return
+        data_vec_bytes = bytearray(LEB128U.encode(len(data_vec)))
         for data_item in data_vec:
-            data_item_bytes = bytes()
-            data_item_bytes += LEB128U.encode(data_item.mem)
-            data_item_bytes += self.write_expr(data_item.offset)
-            data_item_bytes += LEB128U.encode(len(data_item.init))
-            data_item_bytes += data_item.init
-
-            data_vec_bytes += data_item_bytes
+            data_vec_bytes += LEB128U.encode(data_item.mem)
+            self.write_expr_to(data_vec_bytes, data_item.offset)
+            data_vec_bytes += LEB128U.encode(len(data_item.init))
+            data_vec_bytes += data_item.init
 
-        data_section_bytes = bytes([SecDataID]) + LEB128U.encode(len(data_vec_bytes)) + data_vec_bytes
-
-        fp.write(data_section_bytes)
+        self.write_section(fp, SecDataID, data_vec_bytes)
 
     def emit_elem_section(self, elem_vec: list, fp):
 
-        elem_vec_len = len(elem_vec)
-        elem_vec_len_bytes = LEB128U.encode(elem_vec_len)
-        elem_vec_bytes = bytes()
-        elem_vec_bytes += elem_vec_len_bytes
         if elem_vec == []:
             return
+        elem_vec_bytes = bytearray(LEB128U.encode(len(elem_vec)))
         for elem in elem_vec:
             elem_vec_bytes += LEB128U.encode(elem.table)
-            elem_vec_bytes += self.write_expr(elem.offset)
+            self.write_expr_to(elem_vec_bytes, elem.offset)
             elem_vec_bytes += LEB128U.encode(len(elem.init))
             for func_idx in elem.init:
                 elem_vec_bytes += LEB128U.encode(func_idx)
-        elem_section_bytes = bytes([SecElemID]) + LEB128U.encode(len(elem_vec_bytes)) + elem_vec_bytes
 
-        fp.write(elem_section_bytes)
+        self.write_section(fp, SecElemID, elem_vec_bytes)
 
     def emit_type_section(self, functype_vec: list, fp):
 
-        functype_vec_len = len(functype_vec)
-        functype_vec_len_bytes = LEB128U.encode(functype_vec_len)
-        functype_vec_bytes = bytes()
-        functype_vec_bytes += functype_vec_len_bytes
         if functype_vec == []:
             return
+        functype_vec_bytes = bytearray(LEB128U.encode(len(functype_vec)))
         for functype in functype_vec:
-            functype_bytes = bytes()
-            functype_bytes += bytes([0x60])
-            functype_bytes += self.write_val_types(functype.param_types)
-            functype_bytes += self.write_val_types(functype.result_types)
-            functype_vec_bytes += functype_bytes
-        type_section_bytes = bytes([0x01]) + LEB128U.encode(len(functype_vec_bytes)) + functype_vec_bytes
+            functype_vec_bytes.append(0x60)
+            functype_vec_bytes += self.write_val_types(functype.param_types)
+            functype_vec_bytes += self.write_val_types(functype.result_types)
 
-        fp.write(type_section_bytes)
+        self.write_section(fp, SecTypeID, functype_vec_bytes)
 
     def emit_global_section(self, global_vec: list, fp):
 
-        global_vec_len = len(global_vec)
-        global_vec_len_bytes = LEB128U.encode(global_vec_len)
-        global_vec_bytes = bytes()
-        global_vec_bytes += global_vec_len_bytes
         if global_vec == []:
             return
+        global_vec_bytes = bytearray(LEB128U.encode(len(global_vec)))
         for global_item in global_vec:
-            global_bytes = bytes()
-            global_bytes += self.write_global(global_item)
-            global_vec_bytes += global_bytes
-
-        global_section_bytes = bytes([0x06]) + LEB128U.encode(len(global_vec_bytes)) + global_vec_bytes
+            self.write_global_to(global_vec_bytes, global_item)
 
-        fp.write(global_section_bytes)
+        self.write_section(fp, SecGlobalID, global_vec_bytes)
 
     def emit_func_section(self, type_vec, fp):
 
-        type_vec_len = len(type_vec)
-        type_vec_len_bytes = LEB128U.encode(type_vec_len)
-        type_vec_bytes = bytes()
-        type_vec_bytes += type_vec_len_bytes
         if type_vec == []:
             return
+        type_vec_bytes = bytearray(LEB128U.encode(len(type_vec)))
         for type_item in type_vec:
             type_vec_bytes += LEB128U.encode(type_item)
-        func_section_bytes = bytes([0x03]) + LEB128U.encode(len(type_vec_bytes)) + type_vec_bytes
 
-        fp.write(func_section_bytes)
+        self.write_section(fp, SecFuncID, type_vec_bytes)
 
     def emit_code_section(self, code_vec: list, fp):
 
-        code_vec_len = len(code_vec)
-        code_vec_len_bytes = LEB128U.encode(code_vec_len)
-        code_vec_bytes = bytes()
-        code_vec_bytes += code_vec_len_bytes
         if code_vec == []:
             return
+        code_vec_bytes = bytearray(LEB128U.encode(len(code_vec)))
         for code in code_vec:
-            code_bytes = bytes()
-            locals_vec_len = len(code.locals)
-            locals_vec_len_bytes = LEB128U.encode(locals_vec_len)
-            locals_vec_bytes = bytes()
-            expr_bytes = bytes()
-
-            for local in code.locals:
-                local_count = local.n
-                local_type = local.type
-                locals_vec_bytes += LEB128U.encode(local_count)
-                locals_vec_bytes += bytes([local_type])
-
-            expr_bytes += self.write_expr(code.expr)
-            code_bytes += (locals_vec_len_bytes + locals_vec_bytes + expr_bytes)
-            code_vec_bytes += LEB128U.encode(len(code_bytes)) + code_bytes
-        code_section_bytes = bytes([0x0A]) + LEB128U.encode(len(code_vec_bytes)) + code_vec_bytes
-
-        fp.write(code_section_bytes)
+            raw_body = code.get_raw_body()
+            if raw_body is not None:
+                code_vec_bytes += LEB128U.encode(len(raw_body))
+                code_vec_bytes += raw_body
+                continue
+            start = len(code_vec_bytes)
+            locals_vec = code.peek_locals()
+            code_vec_bytes += LEB128U.encode(len(locals_vec))
+            for local in locals_vec:
+                code_vec_bytes += LEB128U.encode(local.n)
+                code_vec_bytes.append(local.type)
+            self.write_expr_to(code_vec_bytes, code.peek_expr())
+            self.patch_length(code_vec_bytes, start)
+
+        self.write_section(fp, SecCodeID, code_vec_bytes)
 
     def emit_table_section(self, table_vec: list, fp):
 
-        table_vec_len = len(table_vec)
-        table_vec_len_bytes = LEB128U.encode(table_vec_len)
-        table_vec_bytes = bytes()
-        table_vec_bytes += table_vec_len_bytes
         if table_vec == []:
             return
+        table_vec_bytes = bytearray(LEB128U.encode(len(table_vec)))
         for table_type in table_vec:
-            table_type_bytes = bytes()
-            table_type_bytes += bytes([table_type.elem_type])
-            table_type_bytes += bytes([table_type.limits.tag])
-            table_type_bytes += LEB128U.encode(table_type.limits.min)
+            table_vec_bytes.append(table_type.elem_type)
+            table_vec_bytes.append(table_type.limits.tag)
+            table_vec_bytes += LEB128U.encode(table_type.limits.min)
             if 0 != table_type.limits.max:
-                table_type_bytes += LEB128U.encode(table_type.limits.max)
-            table_vec_bytes += table_type_bytes
+                table_vec_bytes += LEB128U.encode(table_type.limits.max)
 
-        table_section_bytes = bytes([0x04]) + LEB128U.encode(len(table_vec_bytes)) + table_vec_bytes
+        self.write_section(fp, SecTableID, table_vec_bytes)
 
-        fp.write(table_section_bytes)
+    # The write_*_to methods append to a bytearray so that a whole section is built in one buffer,
+    # the other write_* methods return the encoding of a single item.
 
     def write_expr(self, expr: list):
 
-        instructions_bytes = self.write_instructions(expr)
-        expr_bytes = instructions_bytes + bytes([0x0b])
+        out = bytearray()
+        self.write_expr_to(out, expr)
+        return bytes(out)
 
-        return expr_bytes
+    def write_expr_to(self, out, expr: list):
+
+        self.write_instructions_to(out, expr)
+        out.append(0x0b)
 
     def write_instructions(self, expr: list):
 
-        instructions_bytes = bytes()
-        for index in range(len(expr)):
-            instructions_bytes += self.write_instruction(expr[index])
+        out = bytearray()
+        self.write_instructions_to(out, expr)
+        return bytes(out)
+
+    def write_instructions_to(self, out, expr: list):
+
+        outer = self.encode_out
+        self.encode_out = out
+        try:
+            Walker.walk_runs(expr, self.encode_run, (self.encode_else,), (self.encode_end,))
+        finally:
+            self.encode_out = outer
+
+    def encode_run(self, instrs):
+        out = self.encode_out
+        head_encoders = self.head_encoders
+        for instr in instrs:
+            try:
+                prefix, write_args = head_encoders[instr.opcode]
+            except KeyError:
+                raise Exception("Invalid opcode: 0x%02x" % instr.opcode)
+            out += prefix
+            if write_args is not None:
+                write_args(out, instr)
+                if instr.opcode in block_opcodes:
+                    return instr
+        return None
+
+    def encode_else(self, instr):
+        if instr.args.instrs2:
+            self.encode_out.append(0x05)
 
-        return instructions_bytes
+    def encode_end(self, instr):
+        self.encode_out.append(0x0b)
 
     def write_instruction(self, instr: Instruction):
 
-        binary_data = bytes()
+        out = bytearray()
+        self.write_instructions_to(out, (instr,))
+        return bytes(out)
 
-        if instr.opcode < 0xFC:
-            binary_data += bytes([instr.opcode])
+    def write_args(self, instr):
 
+        prefix, write_args = self.arg_encoders[instr.opcode]
+        if write_args is None:
+            return None
+        out = bytearray()
+        write_args(out, instr)
+        return bytes(out)
 
-        elif instr.opcode <= 0xFD7F:
-            binary_data += instr.opcode.to_bytes(2, 'big')
+    @staticmethod
+    def write_var_u32_to(out, instr):
+        out += LEB128U.encode(instr.args)
 
+    @staticmethod
+    def write_var_s_to(out, instr):
+        out += LEB128S.encode(instr.args)
 
-        elif instr.opcode <= 0xFDFF01:
-            binary_data += instr.opcode.to_bytes(3, 'big')
+    @staticmethod
+    def write_f32_to(out, instr):
+        out += struct.pack('<f', instr.args)
 
-        else:
-            raise Exception("Invalid opcode: 0x%02x" % instr.opcode)
+    @staticmethod
+    def write_f64_to(out, instr):
+        out += struct.pack('<d', instr.args)
 
-        args_bytes = self.write_args(instr)
-        if args_bytes != None:
-            binary_data += args_bytes
+    @staticmethod
+    def write_v128_to(out, instr):
+        out += instr.args.to_bytes(16, 'little')
 
-        return binary_data
+    @staticmethod
+    def write_lane_to(out, instr):
+        out.append(instr.args)
 
-    def write_args(self, instr):
+    @staticmethod
+    def write_zero_to(out, instr):
+        out.append(0x00)
 
-        opcode = instr.opcode
-        if opcode in [Block, Loop]:
-            return self.write_block_args(instr)
-        elif opcode == If:
-            return self.write_if_args(instr)
-        elif opcode in [Br, BrIf]:
-            return LEB128U.encode(instr.args)
-        elif opcode == BrTable:
-            return self.write_br_table_args(instr)
-        elif opcode == Call:
-            return LEB128U.encode(instr.args)
-        elif opcode == CallIndirect:
-            return self.write_call_indirect_args(instr)
-        elif opcode in [LocalGet, LocalSet, LocalTee]:
-            return LEB128U.encode(instr.args)
-        elif opcode in [GlobalGet, GlobalSet]:
-            return LEB128U.encode(instr.args)
-        elif opcode in [MemorySize, MemoryGrow]:
-            return bytes([0x00])
-        elif opcode == I32Const:
-            return LEB128S.encode(instr.args)
-        elif opcode == I64Const:
-            return LEB128S.encode(instr.args)
-        elif opcode == F32Const:
-            return struct.pack('<f', instr.args)
-        elif opcode == F64Const:
-            return struct.pack('<d', instr.args)
-        elif opcode == V128Const:
-            return instr.args.to_bytes(16, 'little')
-        elif opcode == I8x16Shuffle:
-            return instr.args.to_bytes(16, 'little')
-        elif I8x16ExtractLaneS <= opcode <= F64x2ReplaceLane:
-            return bytes([instr.args])
-        elif opcode in [RefNull, RefFunc]:
-            return LEB128U.encode(instr.args)
-        elif opcode in [MemoryInit, DataDrop, ElemDrop, TableGrow, TableSize, TableFill]:
-            return LEB128U.encode(instr.args)
-        elif opcode in [TableInit, TableCopy]:
-            x = LEB128U.encode(instr.args.x)
-            y = LEB128U.encode(instr.args.y)
-            return x + y
-        elif V128Load <= opcode <= V128Store or opcode in [V128Load32Zero, V128Load64Zero]:
-            return self.write_mem_arg(instr)
-        elif V128Load8Lane <= opcode <= V128Store64Lane:
-            return self.write_mem_lane_arg(instr)
-        elif I32Load <= instr.opcode <= I64Store32:
-            return self.write_mem_arg(instr)
-        else:
-            return None
+    @staticmethod
+    def write_table_arg_to(out, instr):
+        out += LEB128U.encode(instr.args.x)
+        out += LEB128U.encode(instr.args.y)
+
+    @staticmethod
+    def write_block_type_to(out, instr):
+        out += LEB128S.encode(instr.args.bt)
 
     def write_block_args(self, instr):
 
-        args_bytes = bytes()
-        args_bytes += LEB128S.encode(instr.args.bt)
-        args_bytes += self.write_instructions(instr.args.instrs)
-        args_bytes += bytes([0x0b])
+        out = bytearray()
+        self.write_block_args_to(out, instr)
+        return bytes(out)
+
+    def write_block_args_to(self, out, instr):
 
-        return args_bytes
+        out += LEB128S.encode(instr.args.bt)
+        self.write_instructions_to(out, instr.args.instrs)
+        out.append(0x0b)
 
     def write_if_args(self, instr):
 
-        args_bytes = bytes()
-        args_bytes += LEB128S.encode(instr.args.bt)
-        args_bytes += self.write_instructions(instr.args.instrs1)
-        if instr.args.instrs2:
-            args_bytes += bytes([0x05])
-            args_bytes += self.write_instructions(instr.args.instrs2)
-            args_bytes += bytes([0x0b])
-        else:
-            args_bytes += bytes([0x0b])
+        out = bytearray()
+        self.write_if_args_to(out, instr)
+        return bytes(out)
 
-        return args_bytes
+    def write_if_args_to(self, out, instr):
+
+        out += LEB128S.encode(instr.args.bt)
+        self.write_instructions_to(out, instr.args.instrs1)
+        if instr.args.instrs2:
+            out.append(0x05)
+            self.write_instructions_to(out, instr.args.instrs2)
+        out.append(0x0b)
 
     @staticmethod
     def write_br_table_args(instr):
 
-        args_bytes = bytes()
-        args_bytes += LEB128U.encode(len(instr.args.labels))
-        for label in instr.args.labels:
-            args_bytes += LEB128U.encode(label)
-        args_bytes += LEB128U.encode(instr.args.default)
+        out = bytearray()
+        ModifyBinary.write_br_table_args_to(out, instr)
+        return bytes(out)
 
-        return args_bytes
+    @staticmethod
+    def write_br_table_args_to(out, instr):
+
+        out += LEB128U.encode(len(instr.args.labels))
+        for label in instr.args.labels:
+            out += LEB128U.encode(label)
+        out += LEB128U.encode(instr.args.default)
 
     @staticmethod
     def write_call_indirect_args(instr):
 
-        args_bytes = bytes()
-        args_bytes += LEB128U.encode(instr.args)
-        args_bytes += bytes([0x00])
+        return LEB128U.encode(instr.args) + bytes([0x00])
+
+    @staticmethod
+    def write_call_indirect_args_to(out, instr):
 
-        return args_bytes
+        out += LEB128U.encode(instr.args)
+        out.append(0x00)
 
     @staticmethod
     def write_mem_arg(instr):
 
-        args_bytes = bytes()
-        args_bytes += LEB128U.encode(instr.args.align)
-        args_bytes += LEB128U.encode(instr.args.offset)
+        return LEB128U.encode(instr.args.align) + LEB128U.encode(instr.args.offset)
+
+    @staticmethod
+    def write_mem_arg_to(out, instr):
 
-        return args_bytes
+        out += LEB128U.encode(instr.args.align)
+        out += LEB128U.encode(instr.args.offset)
 
     @staticmethod
     def write_mem_lane_arg(instr):
 
-        args_bytes = bytes()
-        args_bytes += LEB128U.encode(instr.args.mem_arg.align)
-        args_bytes += LEB128U.encode(instr.args.mem_arg.offset)
-        args_bytes += LEB128U.encode(instr.args.laneidx)
+        out = bytearray()
+        ModifyBinary.write_mem_lane_arg_to(out, instr)
+        return bytes(out)
+
+    @staticmethod
+    def write_mem_lane_arg_to(out, instr):
 
-        return args_bytes
+        out += LEB128U.encode(instr.args.mem_arg.align)
+        out += LEB128U.encode(instr.args.mem_arg.offset)
+        out += LEB128U.encode(instr.args.laneidx)
 
     @staticmethod
     def write_val_types(val_types):
 
-        val_types_bytes = bytes()
-        val_types_bytes += LEB128U.encode(len(val_types))
-        for val in val_types:
-            val_types_bytes += bytes([val])
+        val_types_bytes = bytearray(LEB128U.encode(len(val_types)))
+        val_types_bytes += bytes(val_types)
 
-        return val_types_bytes
+        return bytes(val_types_bytes)
 
     @staticmethod
     def write_global_type(global_type):
 
-        global_type_bytes = bytes()
-        global_type_bytes += bytes([global_type.val_type])
-        global_type_bytes += bytes([global_type.mut])
-        return global_type_bytes
+        return bytes([global_type.val_type, global_type.mut])
 
     @staticmethod
     def write_limits(mem):
 
-        mem_bytes = bytes()
-        mem_bytes += bytes([mem.tag])
+        mem_bytes = bytearray()
+        mem_bytes.append(mem.tag)
         mem_bytes += LEB128U.encode(mem.min)
         if mem.tag == 1:
             mem_bytes += LEB128U.encode(mem.max)
-        return mem_bytes
+        return bytes(mem_bytes)
 
     @staticmethod
     def write_table_type(table_type):
 
-        table_type_bytes = bytes()
-        table_type_bytes += bytes([table_type.elem_type])
-        table_type_bytes += bytes([table_type.limits.tag])
+        table_type_bytes = bytearray()
+        table_type_bytes.append(table_type.elem_type)
+        table_type_bytes.append(table_type.limits.tag)
         if table_type.limits.min != 0:
             table_type_bytes += LEB128U.encode(table_type.limits.min)
         if table_type.limits.max != 0:
             table_type_bytes += LEB128U.encode(table_type.limits.max)
-        return table_type_bytes
+        return bytes(table_type_bytes)
 
     def write_global(self, global_item):
-        global_bytes = bytes()
-        global_bytes += self.write_global_type(global_item.type)
-        global_bytes += self.write_expr(global_item.init)
-        return global_bytes
+        out = bytearray()
+        self.write_global_to(out, global_item)
+        return bytes(out)
+
+    def write_global_to(self, out, global_item):
+        out += self.write_global_type(global_item.type)
+        self.write_expr_to(out, global_item.init)
 
 
 
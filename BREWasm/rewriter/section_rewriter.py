@@ -4,8 +4,32 @@ from BREWasm.rewriter.defination import *
 from BREWasm.rewriter.indices_fixer import *
 from BREWasm.parser.instruction import Instruction
 from BREWasm.rewriter.indices_fixer import IndicesFixer
+from BREWasm.rewriter.transaction import Transaction, queued
 #     def __init__(self, index, instr, instrs):
 #         self.instr = instr
+section_ids = {
+    'typesec': module.SecTypeID,
+    'importsec': module.SecImportID,
+    'funcsec': module.SecFuncID,
+    'tablesec': module.SecTableID,
+    'memsec': module.SecMemID,
+    'globalsec': module.SecGlobalID,
+    'exportsec': module.SecExportID,
+    'startsec': module.SecStartID,
+    'elemsec': module.SecElemID,
+    'codesec': module.SecCodeID,
+    'datasec': module.SecDataID,
+    'datacountsec': module.SecDataCountID,
+    'customsec': module.SecCustomID,
+}
+# sections whose inserts and deletes can renumber an index space, and the sections holding the references
+# IndicesFixer rewrites then
+renumbering_secs = [module.SecTypeID, module.SecImportID, module.SecFuncID, module.SecTableID, module.SecMemID,
+                    module.SecGlobalID, module.SecElemID, module.SecCodeID, module.SecDataID]
+index_ref_secs = [module.SecImportID, module.SecFuncID, module.SecGlobalID, module.SecExportID, module.SecStartID,
+                  module.SecElemID, module.SecCodeID, module.SecDataID]
+
+
 class SectionRewriter:
 
     def __init__(self, module, **section):
@@ -37,40 +61,94 @@ class SectionRewriter:
         self.indices_fixer = IndicesFixer(module)
 
         setattr(self, param_name, section[param_name])
+        self.sec_id = section_ids[param_name]
+
+    @staticmethod
+    def transaction(module):
+        # with SectionRewriter.transaction(module): queues the rewriter calls of the block and replays them
+        # when it exits, with a single index fixup for all of them; an exception in the block drops the queue
+        return Transaction(module)
+
+    def find_types(self, query):
+        # a query with the full signature or the typeidx is answered from the index, others scan all types
+        signatures, index = self.module.get_type_index()
+        if query.arg_types is not None and query.ret_types is not None:
+            candidates = index.get((tuple(query.arg_types), tuple(query.ret_types)), [])
+        elif query.typeidx is not None:
+            candidates = [query.typeidx] if 0 <= query.typeidx < len(signatures) else []
+        else:
+            candidates = range(len(signatures))
+
+        type_list = []
+        for idx in candidates:
+            param_types, result_types = signatures[idx]
+            if all(
+                    (query.typeidx is None or query.typeidx == idx,
+                     query.arg_types is None or tuple(query.arg_types) == param_types,
+                     query.ret_types is None or tuple(query.ret_types) == result_types,)
+            ):
+                type_list.append(Type(idx, list(param_types), list(result_types)))
+        return type_list
+
+    def find_imports(self, query):
+        # function imports only, looked up by (module, name) or importidx when the query gives them
+        index = self.module.get_import_index()
+        if query.module is not None and query.name is not None:
+            candidates = index.get((query.module, query.name), [])
+        elif query.importidx is not None:
+            candidates = [query.importidx] if 0 <= query.importidx < len(self.module.import_sec) else []
+        else:
+            candidates = range(len(self.module.import_sec))
 
-    def select(self, query):
-        if self.typesec is not None and isinstance(query, Type):
-            type_list = []
-            for idx, item in enumerate(self.module.type_sec):
-                param_types, result_types = item.get_signature()
+        import_list = []
+        for idx in candidates:
+            item = self.module.import_sec[idx]
+            if item.desc.func_type is not None:
                 if all(
-                        (query.typeidx is None or query.typeidx == idx,
-                         query.arg_types is None or query.arg_types == param_types,
-                         query.ret_types is None or query.ret_types == result_types,)
+                        (query.importidx is None or query.importidx == idx,
+                         query.module is None or query.module == item.module,
+                         query.name is None or query.name == item.name,
+                         query.typeidx is None or query.typeidx == item.desc.func_type)
                 ):
-                    type_list.append(Type(idx, param_types, result_types))
-            return type_list
+                    import_list.append(Import(idx, item.module, item.name, item.desc.func_type))
+        return import_list
+
+    def find_exports(self, query, func_only=True):
+        # looked up by name or exportidx when the query gives them
+        if query.funcidx is not None:
+            self.indices_fixer.settle()
+        index = self.module.get_export_index()
+        if query.name is not None:
+            candidates = index.get(query.name, [])
+        elif query.exportidx is not None:
+            candidates = [query.exportidx] if 0 <= query.exportidx < len(self.module.export_sec) else []
+        else:
+            candidates = range(len(self.module.export_sec))
+
+        export_list = []
+        for idx in candidates:
+            item = self.module.export_sec[idx]
+            if all(
+                    (query.exportidx is None or query.exportidx == idx,
+                     query.name is None or query.name == item.name,
+                     query.funcidx is None or query.funcidx == item.desc.idx)
+            ) and (not func_only or item.desc.tag == 0):
+                export_list.append(Export(idx, name=item.name, funcidx=item.desc.idx))
+        return export_list
+
+    def select(self, query):
+        if self.sec_id in (module.SecExportID, module.SecStartID, module.SecElemID, module.SecCodeID):
+            self.indices_fixer.settle()
+        if self.typesec is not None and isinstance(query, Type):
+            return self.find_types(query)
 
         elif self.importsec is not None and isinstance(query, Import):
 
-            import_list = []
-            for idx, item in enumerate(self.module.import_sec):
-                if item.desc.func_type is not None:
-                    if all(
-                            (query.importidx is None or query.importidx == idx,
-                             query.module is None or query.module == item.module,
-                             query.name is None or query.name == item.name,
-                             query.typeidx is None or query.typeidx == item.desc.func_type)
-                    ):
-                        import_list.append(Import(idx, item.module, item.name, item.desc.func_type))
-            return import_list
+            return self.find_imports(query)
 
         elif self.funcsec is not None and isinstance(query, Function):
             function_list = []
-            import_func_num = 0
-            for import_func in self.module.import_sec:
-                if import_func.desc.func_type is not None:
-                    import_func_num += 1
+            import_func_num = self.module.get_import_func_num()
 
             if query.funcidx is not None:
                 query.funcidx -= import_func_num
@@ -116,15 +194,7 @@ class SectionRewriter:
             return global_list
 
         elif self.exportsec is not None and isinstance(query, Export):
-            export_list = []
-            for idx, item in enumerate(self.module.export_sec):
-                if all(
-                        (query.exportidx is None or query.exportidx == idx,
-                         query.name is None or query.name == item.name,
-                         query.funcidx is None or query.funcidx == item.desc.idx)
-                ) and item.desc.tag == 0:
-                    export_list.append(Export(idx, name=item.name, funcidx=item.desc.idx))
-            return export_list
+            return self.find_exports(query)
 
         elif self.startsec is not None and isinstance(query, Start):
             match query:
@@ -147,10 +217,7 @@ class SectionRewriter:
 
         elif self.codesec is not None and isinstance(query, Code):
             code_list = []
-            import_func_num = 0
-            for import_func in self.module.import_sec:
-                if import_func.desc.func_type is not None:
-                    import_func_num += 1
+            import_func_num = self.module.get_import_func_num()
             if query.funcidx < import_func_num:
                 raise Exception("Import function!")
             query.funcidx -= import_func_num
@@ -214,45 +281,35 @@ class SectionRewriter:
         else:
             raise Exception("error")
 
+    @queued
     def insert(self, query, inserted_item):
 
+        self.check_renumbering()
+        self.module.mark_dirty(self.sec_id)
         if self.typesec is not None and isinstance(inserted_item, Type):
             if query is None:
                 self.module.type_sec.append(inserted_item.convert())
+                self.module.index_appended(module.SecTypeID)
             elif isinstance(query, Type):
-                type_list = []
-                for idx, item in enumerate(self.module.type_sec):
-                    param_types, result_types = item.get_signature()
-                    if all(
-                            (query.typeidx is None or query.typeidx == idx,
-                             query.arg_types is None or query.arg_types == param_types,
-                             query.ret_types is None or query.ret_types == result_types,)
-                    ):
-                        type_list.append(Type(idx, param_types, result_types))
+                type_list = self.find_types(query)
                 if len(type_list) != 1:
                     raise Exception("error")
 
                 idx = type_list[0].typeidx
                 self.module.type_sec.insert(idx, inserted_item.convert())
-                self.indices_fixer.fix_func_functypeidx(self.module.func_sec, idx)
-                self.indices_fixer.fix_import_func_functypeidx(self.module.import_sec, idx)
+                self.module.drop_index(module.SecTypeID)
+                self.indices_fixer.record(SpaceType, idx)
+                self.indices_fixer.apply()
 
         elif self.importsec is not None and isinstance(inserted_item, Import):
             if query is None:
                 self.module.import_sec.append(module.Import(inserted_item.module, inserted_item.name,
                                                             module.ImportDesc(tag=0,
                                                                               func_type=inserted_item.typeidx)))
+                self.module.index_appended(module.SecImportID)
+                idx = len(self.module.import_sec) - 1
             elif isinstance(query, Import):
-                import_list = []
-                for idx, item in enumerate(self.module.import_sec):
-                    if item.desc.func_type is not None:
-                        if all(
-                                (query.importidx is None or query.importidx == idx,
-                                 query.module is None or query.module == item.module,
-                                 query.name is None or query.name == item.name,
-                                 query.typeidx is None or query.typeidx == item.desc.func_type)
-                        ):
-                            import_list.append(Import(idx, item.module, item.name, item.desc.func_type))
+                import_list = self.find_imports(query)
 
                 if len(import_list) != 1:
                     raise Exception("error")
@@ -262,24 +319,16 @@ class SectionRewriter:
                 self.module.import_sec.insert(idx, module.Import(inserted_item.module, inserted_item.name,
                                                                  module.ImportDesc(tag=0,
                                                                                    func_type=inserted_item.typeidx)))
-            import_func_id = None
-            for i, import_item in enumerate([i for i in self.module.import_sec if i.desc.func_type is not None]):
-                if import_item.module == inserted_item.module and import_item.name == inserted_item.name:
-                    import_func_id = i
-            for _, code in enumerate(self.module.code_sec):
-                self.indices_fixer.fix_call_instructions(code.expr, import_func_id)
-            self.indices_fixer.fix_elem_funcidx(self.module.elem_sec, import_func_id)
-            self.indices_fixer.fix_export_funcidx(self.module.export_sec, import_func_id)
+                self.module.drop_index(module.SecImportID)
+            self.indices_fixer.record(SpaceFunc, self.module.get_import_space_idx(idx))
+            self.indices_fixer.apply()
 
         elif self.funcsec is not None and isinstance(inserted_item, Function):
             if query is None:
                 self.module.func_sec.append(inserted_item.typeidx)
             elif isinstance(query, Function):
                 function_list = []
-                import_func_num = 0
-                for import_func in self.module.import_sec:
-                    if import_func.desc.func_type is not None:
-                        import_func_num += 1
+                import_func_num = self.module.get_import_func_num()
 
                 if query.funcidx is not None:
                     query.funcidx -= import_func_num
@@ -296,10 +345,8 @@ class SectionRewriter:
 
                 idx = function_list[0].funcidx
                 self.module.func_sec.insert(idx - import_func_num, inserted_item.typeidx)
-                self.indices_fixer.fix_export_funcidx(self.module.export_sec, idx)
-                self.indices_fixer.fix_elem_funcidx(self.module.elem_sec, idx)
-                for _, code in enumerate(self.module.code_sec):
-                    self.indices_fixer.fix_call_instructions(code.expr, idx)
+                self.indices_fixer.record(SpaceFunc, idx)
+                self.indices_fixer.apply()
         # elif self.tablesec is not None and isinstance(query, Table):
         #     table_list = []
         #         if all(
@@ -347,23 +394,17 @@ class SectionRewriter:
                 idx = global_list[0].globalidx
                 self.module.global_sec.insert(idx, module.Global(GlobalType(inserted_item.valtype, inserted_item.mut),
                                                                  [init_value_instr]))
-                self.indices_fixer.fix_export_globalidx(self.module.export_sec, idx)
-                for code in self.module.code_sec:
-                    self.indices_fixer.fix_global_instructions(code.expr, idx)
+                self.indices_fixer.record(SpaceGlobal, self.get_import_global_num() + idx)
+                self.indices_fixer.apply()
 
         elif self.exportsec is not None and isinstance(inserted_item, Export):
             if query is None:
                 self.module.export_sec.append(
                     module.Export(inserted_item.name, module.ExportDesc(0, inserted_item.funcidx)))
+                self.module.index_appended(module.SecExportID)
+                self.indices_fixer.mark_written(self.module.export_sec[-1])
             elif isinstance(query, Export):
-                export_list = []
-                for idx, item in enumerate(self.module.export_sec):
-                    if all(
-                            (query.exportidx is None or query.exportidx == idx,
-                             query.name is None or query.name == item.name,
-                             query.funcidx is None or query.funcidx == item.desc.idx)
-                    ):
-                        export_list.append(Export(idx, name=item.name, funcidx=item.desc.idx))
+                export_list = self.find_exports(query, func_only=False)
 
                 if len(export_list) != 1:
                     raise Exception("error")
@@ -371,6 +412,8 @@ class SectionRewriter:
                 idx = export_list[0].exportidx
                 self.module.export_sec.insert(idx, module.Export(inserted_item.name,
                                                                  module.ExportDesc(0, inserted_item.funcidx)))
+                self.module.drop_index(module.SecExportID)
+                self.indices_fixer.mark_written(self.module.export_sec[idx])
 
         elif self.startsec is not None and isinstance(inserted_item, Start):
             match query:
@@ -397,13 +440,11 @@ class SectionRewriter:
 
             if query is None:
                 self.module.code_sec.append(module.Code(locals, fold_instrs))
+                self.indices_fixer.mark_written(self.module.code_sec[-1])
             elif isinstance(query, Code):
 
                 code_list = []
-                import_func_num = 0
-                for import_func in self.module.import_sec:
-                    if import_func.desc.func_type is not None:
-                        import_func_num += 1
+                import_func_num = self.module.get_import_func_num()
                 if query.funcidx < import_func_num:
                     raise Exception("Import function!")
                 query.funcidx -= import_func_num
@@ -424,6 +465,7 @@ class SectionRewriter:
                 idx = code_list[0].funcidx - import_func_num
 
                 self.module.code_sec.insert(idx, module.Code(locals, fold_instrs))
+                self.indices_fixer.mark_written(self.module.code_sec[idx])
 
         elif self.datasec is not None and isinstance(inserted_item, Data):
             data_list = []
@@ -476,60 +518,41 @@ class SectionRewriter:
         else:
             raise Exception("error")
 
+    @queued
     def delete(self, query):
 
+        self.check_renumbering()
+        self.module.mark_dirty(self.sec_id)
         if self.typesec is not None and isinstance(query, Type):
-            type_list = []
-            for idx, item in enumerate(self.module.type_sec):
-                param_types, result_types = item.get_signature()
-                if all(
-                        (query.typeidx is None or query.typeidx == idx,
-                         query.arg_types is None or query.arg_types == param_types,
-                         query.ret_types is None or query.ret_types == result_types,)
-                ):
-                    type_list.append(Type(idx, param_types, result_types))
+            type_list = self.find_types(query)
             if len(type_list) != 1:
                 raise Exception("error")
 
             idx = type_list[0].typeidx
             self.module.type_sec.pop(idx)
-            self.indices_fixer.fix_func_functypeidx(self.module.func_sec, idx, type=Delete)
-            self.indices_fixer.fix_import_func_functypeidx(self.module.import_sec, idx, type=Delete)
+            self.module.drop_index(module.SecTypeID)
+            self.indices_fixer.record(SpaceType, idx, type=Delete)
+            self.indices_fixer.apply()
 
         elif self.importsec is not None and isinstance(query, Import):
 
-            import_list = []
-            for idx, item in enumerate(self.module.import_sec):
-                if item.desc.func_type is not None:
-                    if all(
-                            (query.importidx is None or query.importidx == idx,
-                             query.module is None or query.module == item.module,
-                             query.name is None or query.name == item.name,
-                             query.typeidx is None or query.typeidx == item.desc.func_type)
-                    ):
-                        import_list.append(Import(idx, item.module, item.name, item.desc.func_type))
+            import_list = self.find_imports(query)
 
             if len(import_list) != 1:
                 raise Exception("error")
 
             idx = import_list[0].importidx
 
+            # function index of the deleted import
+            import_func_id = self.module.get_import_space_idx(idx)
             self.module.import_sec.pop(idx)
-            import_func_id = None
-            for i, import_item in enumerate([i for i in self.module.import_sec if i.desc.func_type is not None]):
-                if import_item.module == item.module and import_item.name == item.name:
-                    import_func_id = i
-            for _, code in enumerate(self.module.code_sec):
-                self.indices_fixer.fix_call_instructions(code.expr, import_func_id, type=Delete)
-            self.indices_fixer.fix_elem_funcidx(self.module.elem_sec, import_func_id, type=Delete)
-            self.indices_fixer.fix_export_funcidx(self.module.export_sec, import_func_id, type=Delete)
+            self.module.drop_index(module.SecImportID)
+            self.indices_fixer.record(SpaceFunc, import_func_id, type=Delete)
+            self.indices_fixer.apply()
 
         elif self.funcsec is not None and isinstance(query, Function):
             function_list = []
-            import_func_num = 0
-            for import_func in self.module.import_sec:
-                if import_func.desc.func_type is not None:
-                    import_func_num += 1
+            import_func_num = self.module.get_import_func_num()
 
             if query.funcidx is not None:
                 query.funcidx -= import_func_num
@@ -546,10 +569,8 @@ class SectionRewriter:
 
             idx = function_list[0].funcidx
             self.module.func_sec.pop(idx - import_func_num)
-            self.indices_fixer.fix_export_funcidx(self.module.export_sec, idx, type=Delete)
-            self.indices_fixer.fix_elem_funcidx(self.module.elem_sec, idx, type=Delete)
-            for _, code in enumerate(self.module.code_sec):
-                self.indices_fixer.fix_call_instructions(code.expr, idx, type=Delete)
+            self.indices_fixer.record(SpaceFunc, idx, type=Delete)
+            self.indices_fixer.apply()
         # elif self.tablesec is not None and isinstance(query, Table):
         #     table_list = []
         #         if all(
@@ -580,25 +601,18 @@ class SectionRewriter:
             idx = global_list[0].globalidx
 
             self.module.global_sec.pop(idx)
-            self.indices_fixer.fix_export_globalidx(self.module.export_sec, idx, type=Delete)
-            for code in self.module.code_sec:
-                self.indices_fixer.fix_global_instructions(code.expr, idx, type=Delete)
+            self.indices_fixer.record(SpaceGlobal, self.get_import_global_num() + idx, type=Delete)
+            self.indices_fixer.apply()
 
         elif self.exportsec is not None and isinstance(query, Export):
-            export_list = []
-            for idx, item in enumerate(self.module.export_sec):
-                if all(
-                        (query.exportidx is None or query.exportidx == idx,
-                         query.name is None or query.name == item.name,
-                         query.funcidx is None or query.funcidx == item.desc.idx)
-                ) and item.desc.tag == 0:
-                    export_list.append(Export(idx, name=item.name, funcidx=item.desc.idx))
+            export_list = self.find_exports(query)
 
             if len(export_list) != 1:
                 raise Exception("error")
 
             idx = export_list[0].exportidx
             self.module.export_sec.pop(idx)
+            self.module.drop_index(module.SecExportID)
 
         elif self.startsec is not None and isinstance(query, Start):
             match query:
@@ -621,10 +635,7 @@ class SectionRewriter:
 
         elif self.codesec is not None and isinstance(query, Code):
             code_list = []
-            import_func_num = 0
-            for import_func in self.module.import_sec:
-                if import_func.desc.func_type is not None:
-                    import_func_num += 1
+            import_func_num = self.module.get_import_func_num()
             if query.funcidx < import_func_num:
                 raise Exception("Import function!")
             query.funcidx -= import_func_num
@@ -694,18 +705,12 @@ class SectionRewriter:
         else:
             raise Exception("error")
 
+    @queued
     def update(self, query, new_item):
 
+        self.module.mark_dirty(self.sec_id)
         if self.typesec is not None and isinstance(query, Type):
-            type_list = []
-            for idx, item in enumerate(self.module.type_sec):
-                param_types, result_types = item.get_signature()
-                if all(
-                        (query.typeidx is None or query.typeidx == idx,
-                         query.arg_types is None or query.arg_types == param_types,
-                         query.ret_types is None or query.ret_types == result_types,)
-                ):
-                    type_list.append(Type(idx, param_types, result_types))
+            type_list = self.find_types(query)
             for t in type_list:
                 if new_item.arg_types is not None:
                     param_types = []
@@ -735,19 +740,11 @@ class SectionRewriter:
                                 result_types.append(ValTypeF64)
                     t.result_types = result_types
                     self.module.type_sec[t.typeidx].result_types = result_types
+            self.module.drop_index(module.SecTypeID)
 
         elif self.importsec is not None and isinstance(query, Import):
 
-            import_list = []
-            for idx, item in enumerate(self.module.import_sec):
-                if item.desc.func_type is not None:
-                    if all(
-                            (query.importidx is None or query.importidx == idx,
-                             query.module is None or query.module == item.module,
-                             query.name is None or query.name == item.name,
-                             query.typeidx is None or query.typeidx == item.desc.func_type)
-                    ):
-                        import_list.append(Import(idx, item.module, item.name, item.desc.func_type))
+            import_list = self.find_imports(query)
             for i in import_list:
                 if new_item.module is not None:
                     self.module.import_sec[i.importidx].module = new_item.module
@@ -755,13 +752,11 @@ class SectionRewriter:
                     self.module.import_sec[i.importidx].name = new_item.name
                 if new_item.typeidx is not None:
                     self.module.import_sec[i.importidx].desc.func_type = new_item.typeidx
+            self.module.drop_index(module.SecImportID)
 
         elif self.funcsec is not None and isinstance(query, Function):
             function_list = []
-            import_func_num = 0
-            for import_func in self.module.import_sec:
-                if import_func.desc.func_type is not None:
-                    import_func_num += 1
+            import_func_num = self.module.get_import_func_num()
 
             if query.funcidx is not None:
                 query.funcidx -= import_func_num
@@ -838,19 +833,14 @@ class SectionRewriter:
                     self.module.global_sec[g.globalidx].init[0] = init_value_instr
 
         elif self.exportsec is not None and isinstance(query, Export):
-            export_list = []
-            for idx, item in enumerate(self.module.export_sec):
-                if all(
-                        (query.exportidx is None or query.exportidx == idx,
-                         query.name is None or query.name == item.name,
-                         query.funcidx is None or query.funcidx == item.desc.idx)
-                ) and item.desc.tag == 0:
-                    export_list.append(Export(idx, name=item.name, funcidx=item.desc.idx))
+            export_list = self.find_exports(query)
             for e in export_list:
                 if new_item.name is not None:
                     self.module.export_sec[e.exportidx].name = new_item.name
                 if new_item.funcidx is not None:
                     self.module.export_sec[e.exportidx].desc.idx = new_item.funcidx
+                    self.indices_fixer.mark_written(self.module.export_sec[e.exportidx])
+            self.module.drop_index(module.SecExportID)
         #     match query:
         #             return Start(self.module.start_sec)
         #             return Start(self.module.start_sec)
@@ -872,16 +862,14 @@ class SectionRewriter:
                     self.module.elem_sec[e.elemidx].offset = [Instruction(I32Const, new_item.offset)]
                 if new_item.funcidx_list is not None:
                     self.module.elem_sec[e.elemidx].init = new_item.funcidx_list
+                    self.indices_fixer.mark_written(self.module.elem_sec[e.elemidx])
 
                 indirect_func_list = e.funcidx_list
                 self.indices_fixer.fix_table_limits(self.module.table_sec, len(indirect_func_list) + 1)
 
         elif self.codesec is not None and isinstance(query, Code):
             code_list = []
-            import_func_num = 0
-            for import_func in self.module.import_sec:
-                if import_func.desc.func_type is not None:
-                    import_func_num += 1
+            import_func_num = self.module.get_import_func_num()
             if query.funcidx < import_func_num:
                 raise Exception("Import function!")
             query.funcidx -= import_func_num
@@ -900,6 +888,7 @@ class SectionRewriter:
                     self.module.code_sec[c.funcidx - import_func_num].locals = new_item.convert_local_vec()
                 if new_item.instr_list is not None:
                     self.module.code_sec[c.funcidx - import_func_num].expr = self.get_fold_instrs(new_item.instr_list)
+                    self.indices_fixer.mark_written(self.module.code_sec[c.funcidx - import_func_num])
 
 
 
@@ -974,113 +963,78 @@ class SectionRewriter:
         else:
             raise Exception("error")
 
-    def emit_binary(self, path: str):
-        ModifyBinary(self.module, self.module.path).emit_binary(path)
+    def check_renumbering(self):
+        # refuse an insert or delete up front when the references it may have to rewrite were not decoded
+        if self.sec_id in renumbering_secs:
+            for sec_id in index_ref_secs:
+                if not self.module.is_decoded(sec_id):
+                    raise Exception("section %s was not decoded" % module.section_attrs[sec_id])
+
+    def get_import_global_num(self):
+        # imported globals come first in the global index space
+        return self.module.get_import_global_num()
+
+    def emit_binary(self, path: str, reencode=False, copy_clean=False):
+        ModifyBinary(self.module, self.module.path).emit_binary(path, reencode, copy_clean)
     def get_flat_instrs(self, instrs):
+        # blocks are written in place and closed by End_, with Else_ between the two arms of an If. One pass
+        # over an explicit stack of iterators and pending markers, so the nesting depth is not bounded by the
+        # recursion limit
         ret_instrs = []
-        for _, i in enumerate(instrs):
-            if i.opcode in [Block, Loop]:
-                ret_instrs.append(i)
-                args = i.args
-                ret_instrs.extend(self.get_flat_instrs(args.instrs))
-                ret_instrs.append(Instruction(End_))
-            elif i.opcode == If:
-                ret_instrs.append(i)
-                args = i.args
-                ret_instrs.extend(self.get_flat_instrs(args.instrs1))
-                ret_instrs.append(Instruction(Else_))
-                ret_instrs.extend(self.get_flat_instrs(args.instrs2))
-                ret_instrs.append(Instruction(End_))
-            else:
+        stack = [iter(instrs)]
+        while stack:
+            top = stack.pop()
+            if isinstance(top, Instruction):
+                ret_instrs.append(top)
+                continue
+            for i in top:
                 ret_instrs.append(i)
+                if i.opcode in [Block, Loop]:
+                    stack.append(top)
+                    stack.append(Instruction(End_))
+                    stack.append(iter(i.args.instrs))
+                    break
+                elif i.opcode == If:
+                    stack.append(top)
+                    stack.append(Instruction(End_))
+                    stack.append(iter(i.args.instrs2))
+                    stack.append(Instruction(Else_))
+                    stack.append(iter(i.args.instrs1))
+                    break
         return ret_instrs
 
     def get_fold_instrs(self, instrs):
+        # the inverse of get_flat_instrs in one pass: the instructions of each open block are collected until
+        # its End_ and then attached to it. An If without Else_ gets an empty else arm
         ret_instrs = []
-        i = 0
-        while i < len(instrs):
-            if instrs[i].opcode in [Block, Loop]:
-                j = i
-                args_instrs_length = self.get_flat_Block_length(instrs[i:]) - 2
-                instrs[i].args.instrs = self.get_fold_instrs(instrs[i + 1: i + 1 + args_instrs_length])
-                i = i + args_instrs_length + 2
-                ret_instrs.append(instrs[j])
-            elif instrs[i].opcode == If:
-                j = i
-                else_offset, length = self.get_flat_If_length(instrs[i:]) - 2
-                instrs[j].args.instrs1 = self.get_fold_instrs(instrs[i + 1, i + else_offset])
-                i = i + else_offset
-                instrs[j].args.instrs2 = self.get_fold_instrs(instrs[i + 1, i + length - 1])
-                i = j + length
-                ret_instrs.append(instrs[j])
+        current = ret_instrs
+        # [block instr, enclosing list, whether its Else_ was seen]
+        stack = []
+        for instr in instrs:
+            opcode = instr.opcode
+            if opcode in [Block, Loop, If]:
+                current.append(instr)
+                stack.append([instr, current, False])
+                current = []
+            elif opcode == Else_:
+                if not stack or stack[-1][0].opcode != If or stack[-1][2]:
+                    raise Exception("else outside of if")
+                stack[-1][0].args.instrs1 = current
+                stack[-1][2] = True
+                current = []
+            elif opcode == End_ and stack:
+                block, parent, has_else = stack.pop()
+                if block.opcode == If:
+                    if has_else:
+                        block.args.instrs2 = current
+                    else:
+                        block.args.instrs1 = current
+                        block.args.instrs2 = []
+                else:
+                    block.args.instrs = current
+                current = parent
             else:
-                ret_instrs.append(instrs[i])
-                i += 1
+                current.append(instr)
+        if stack:
+            raise Exception("block without end")
         return ret_instrs
-
-    def get_flat_Block_length(self, instrs):
-
-        if instrs[0].opcode in [Block, Loop]:
-            instr_queue = [instrs[0]]
-            i = 1
-            while i < len(instrs):
-                if instrs[i].opcode in [Block, Loop]:
-                    instr_queue.append(instrs[i])
-                    i += 1
-                elif instrs[i].opcode in [If, Else_]:
-                    instr_queue.append(instrs[i])
-                    i += 1
-                elif instrs[i].opcode == End_:
-                    instr_queue.append(instrs[i])
-                    i += 1
-                    if instr_queue[-2].opcode == Else_:
-                        instr_queue = instr_queue[0: -3]
-                    elif instr_queue[-2].opcode in [Block, Loop]:
-                        instr_queue = instr_queue[0: -2]
-                    if instr_queue == []:
-                        length = i
-                        return length
-                else:
-                    i += 1
-        else:
-            raise Exception("error")
-
-    def get_flat_If_length(self, instrs):
-
-        if instrs[0].opcode in [If]:
-            instr_queue = [{
-                        "offset": 0,
-                        "instr": instrs[0]
-                    }]
-            i = 1
-            while i < len(instrs):
-                if instrs[i].opcode in [Block, Loop]:
-                    instr_queue.append({
-                        "offset": i,
-                        "instr": instrs[i]
-                    })
-                    i += 1
-                elif instrs[i].opcode in [If, Else_]:
-                    instr_queue.append({
-                        "offset": i,
-                        "instr": instrs[i]
-                    })
-                    i += 1
-                elif instrs[i].opcode == End_:
-                    instr_queue.append({
-                        "offset": i,
-                        "instr": instrs[i]
-                    })
-                    i += 1
-                    if instr_queue[-2].opcode == Else_ and len(instr_queue) != 3:
-                        instr_queue = instr_queue[0: -3]
-                    elif instr_queue[-2].opcode in [Block, Loop]:
-                        instr_queue = instr_queue[0: -2]
-                    elif instr_queue[-2].opcode == Else_ and len(instr_queue) == 3:
-                        else_offset = instr_queue[1]["offset"]
-                        length = i
-                        return else_offset, length
-                else:
-                    i += 1
-        else:
-            raise Exception("error")
@@ -9,18 +9,22 @@ class SemanticsRewriter:
         def __init__(self, module):
             self.module = module
 
+        @queued
         def insert_global_variable(self, idx, global_type, init_value):
             global_rewriter = SectionRewriter(self.module, globalsec=self.module.global_sec)
             global_rewriter.insert(Global(globalidx=idx), Global(valtype=global_type, val=init_value))
 
+        @queued
         def append_global_variable(self, global_type, init_value):
             global_rewriter = SectionRewriter(self.module, globalsec=self.module.global_sec)
             global_rewriter.insert(None, inserted_item=Global(valtype=global_type, val=init_value))
 
+        @queued
         def modify_global_variable(self, idx, global_type, init_value):
             global_rewriter = SectionRewriter(self.module, globalsec=self.module.global_sec)
             global_rewriter.update(Global(globalidx=idx), Global(valtype=global_type, val=init_value))
 
+        @queued
         def delete_global_variable(self, idx=None, global_type=None, init_value=None):
             if idx is not None:
                 global_rewriter = SectionRewriter(self.module, globalsec=self.module.global_sec)
@@ -35,6 +39,7 @@ class SemanticsRewriter:
         def __init__(self, module):
             self.module = module
 
+        @queued
         def insert_import_function(self, idx, module_name, func_name, params_type, results_type):
 
             type_rewriter = SectionRewriter(self.module, typesec=self.module.type_sec)
@@ -49,6 +54,7 @@ class SemanticsRewriter:
             import_rewriter.insert(Import(importidx=idx),
                                    Import(module=module_name, name=func_name, typeidx=typeidx))
 
+        @queued
         def delete_import_function(self, idx=None, module_name=None, func_name=None):
 
             if idx is not None:
@@ -60,6 +66,7 @@ class SemanticsRewriter:
                 import_function = import_rewriter.select(Import(module=module_name, name=func_name))
                 import_rewriter.delete(import_function[0].importidx)
 
+        @queued
         def modify_import_function(self, idx, module_name, func_name, params_type, results_type):
             type_rewriter = SectionRewriter(self.module, typesec=self.module.type_sec)
             result = type_rewriter.select(Type(arg_types=params_type, ret_types=results_type))
@@ -72,6 +79,7 @@ class SemanticsRewriter:
             import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
             import_rewriter.update(Import(importidx=idx), Import(module=module_name, name=func_name, typeidx=typeidx))
 
+        @queued
         def append_import_function(self, module_name, func_name, params_type, results_type):
             type_rewriter = SectionRewriter(self.module, typesec=self.module.type_sec)
             result = type_rewriter.select(Type(arg_types=params_type, ret_types=results_type))
@@ -84,16 +92,19 @@ class SemanticsRewriter:
             import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
             import_rewriter.insert(None, inserted_item=Import(module=module_name, name=func_name, typeidx=typeidx))
 
+        @queued
         def insert_export_function(self, idx, func_name, funcidx):
 
             export_rewriter = SectionRewriter(self.module, exportsec=self.module.export_sec)
             export_rewriter.insert(Export(exportidx=idx), Export(name=func_name, funcidx=funcidx))
 
+        @queued
         def modify_export_function(self, idx, func_name, funcidx):
 
             export_rewriter = SectionRewriter(self.module, exportsec=self.module.export_sec)
             export_rewriter.update(Export(exportidx=idx), Export(name=func_name, funcidx=funcidx))
 
+        @queued
         def delete_export_function(self, idx=None, func_name=None):
 
             if idx is not None:
@@ -105,6 +116,7 @@ class SemanticsRewriter:
                 export_function = export_rewriter.select(Export(name=func_name))
                 export_rewriter.delete(export_function[0].exportidx)
 
+        @queued
         def append_export_function(self, func_name, funcidx):
 
             export_rewriter = SectionRewriter(self.module, exportsec=self.module.export_sec)
@@ -187,6 +199,7 @@ class SemanticsRewriter:
             self.module = module
             self.indices_fixer = IndicesFixer(self.module)
 
+        @queued
         def insert_linear_memory(self, offset, bytes):
             memory_rewriter = SectionRewriter(self.module, memsec=self.module.mem_sec)
             memory_list = memory_rewriter.select(Memory())
@@ -206,7 +219,7 @@ class SemanticsRewriter:
                 elif offset + length >= data_item.offset:
                     is_overlap = True
                     if offset >= data_item.offset:
-                        data_item.init_data = data_item.init_data[:(offset - data_item.offset)] + bytearray(
+                        data_item.init_data = bytearray(data_item.init_data[:(offset - data_item.offset)]) + bytearray(
                             bytes) + data_item.init_data[(offset - data_item.offset):]
                     else:
                         data_item.offset -= (offset - data_item.offset)
@@ -217,6 +230,7 @@ class SemanticsRewriter:
             if data_rewriter.select(Data()) is [] or is_overlap is False:
                 data_rewriter.insert(None, inserted_item=Data(offset=offset, init_data=bytes))
 
+        @queued
         def append_linear_memory(self, page_num):
             memory_rewriter = SectionRewriter(self.module, memsec=self.module.mem_sec)
             mem_list = memory_rewriter.select(Memory())
@@ -224,6 +238,7 @@ class SemanticsRewriter:
             if mem_list[0].max != 0:
                 mem_list[0].max += page_num
 
+        @queued
         def modify_linear_memory(self, offset, bytes):
             memory_rewriter = SectionRewriter(self.module, memsec=self.module.mem_sec)
             mem_list = memory_rewriter.select(Memory())
@@ -238,10 +253,10 @@ class SemanticsRewriter:
         def __init__(self, module):
             self.module = module
 
+        @queued
         def insert_internal_function(self, idx, params_type, results_type, local_vec, func_body):
 
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             if import_func_num > idx:
                 raise Exception("The idx of internal function less than import function")
@@ -260,6 +275,7 @@ class SemanticsRewriter:
             code_rewriter = SectionRewriter(self.module, codesec=self.module.code_sec)
             code_rewriter.insert(Code(funcidx=idx), Code(local_vec=local_vec, instr_list=func_body))
 
+        @queued
         def insert_indirect_function(self, idx, params_type, results_type, local_vec, func_body):
 
             self.insert_internal_function(idx, params_type, results_type, local_vec, func_body)
@@ -279,22 +295,36 @@ class SemanticsRewriter:
                 element_list[0].funcidx_list.append(idx)
                 element_rewriter.update(Element(elemidx=element_list[0].elemidx), element_list[0])
 
+        @queued
         def insert_hook_function(self, hooked_funcidx, idx, params_type, results_type, locals_vec, func_body):
             self.insert_internal_function(idx, params_type, results_type, locals_vec, func_body)
+            # the insert moved the hooked function too when it was at or after idx
+            if hooked_funcidx >= idx:
+                hooked_funcidx += 1
 
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             code_rewriter = SectionRewriter(self.module, codesec=self.module.code_sec)
 
-            for funcidx in range(import_func_num, import_func_num + len(code_rewriter.select(Code()))):
+            if self.module.xref is not None:
+                # only the call sites of the hooked function are visited
+                code_rewriter.indices_fixer.settle()
+                hook = self.module.code_sec[idx - import_func_num]
+                for code in self.module.xref.retarget(SpaceFunc, hooked_funcidx, idx, opcode=Call, skip=hook):
+                    code.invalidate()
+                    self.module.mark_dirty(module.SecCodeID)
+                return idx
+
+            for funcidx in range(import_func_num, import_func_num + len(self.module.code_sec)):
                 if funcidx != idx:
-                    code = code_rewriter.select(Code(funcidx=funcidx))
+                    code = code_rewriter.select(Code(funcidx=funcidx))[0]
+                    hooked = False
                     for instr in code.instr_list:
-                        if instr == Instruction(Call, hooked_funcidx):
-                            instr.opcode = Call
+                        if instr.opcode == Call and instr.args == hooked_funcidx:
                             instr.args = idx
-                    code_rewriter.update(Code(funcidx=funcidx), Code(instr_list=code.instr_list))
+                            hooked = True
+                    if hooked:
+                        code_rewriter.update(Code(funcidx=funcidx), Code(instr_list=code.instr_list))
 
             return idx
 
@@ -306,10 +336,10 @@ class SemanticsRewriter:
         #
         #     self.section_rewriter.modify_code_instr(code, offset, instr)
 
+        @queued
         def delete_func_instr(self, funcidx, offset):
 
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             if funcidx < import_func_num:
                 raise Exception("funcidx error")
@@ -320,10 +350,10 @@ class SemanticsRewriter:
             code_list[0].instr_list.pop(offset)
             code_rewriter.update(Code(funcidx=funcidx), code_list[0])
 
+        @queued
         def insert_func_instrs(self, funcidx, offset, instrs: list):
 
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             if funcidx < import_func_num:
                 raise Exception("funcidx error")
@@ -336,10 +366,10 @@ class SemanticsRewriter:
 
             code_rewriter.update(Code(funcidx=funcidx), code_list[0])
 
+        @queued
         def append_func_instrs(self, funcidx, instrs: list):
 
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             if funcidx < import_func_num:
                 raise Exception("funcidx error")
@@ -350,9 +380,9 @@ class SemanticsRewriter:
             code_list[0].instr_list.extend(instrs)
             code_rewriter.update(Code(funcidx=funcidx), code_list[0])
 
+        @queued
         def modify_func_instrs(self, funcidx, instr, instrs: list):
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             if funcidx < import_func_num:
                 raise Exception("funcidx error")
@@ -368,9 +398,9 @@ class SemanticsRewriter:
 
             code_rewriter.update(Code(funcidx=funcidx), Code(instr_list=code_list[0].instr_list))
 
+        @queued
         def append_func_local(self, funcidx, valtype):
-            import_rewriter = SectionRewriter(self.module, importsec=self.module.import_sec)
-            import_func_num = len(import_rewriter.select(Import()))
+            import_func_num = self.module.get_import_func_num()
 
             if funcidx < import_func_num:
                 raise Exception("funcidx error")
@@ -385,6 +415,7 @@ class SemanticsRewriter:
         def __init__(self, module):
             self.module = module
 
+        @queued
         def modify_func_name(self, funcidx, name):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             funcname_list = self.section_rewriter.get_namesec_funcname_list(namesec)
@@ -392,6 +423,7 @@ class SemanticsRewriter:
                 if funcname.idx == funcidx:
                     funcname_list[_].name = name
 
+        @queued
         def delete_func_name(self, funcidx):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             funcname_list = self.section_rewriter.get_namesec_funcname_list(namesec)
@@ -399,6 +431,7 @@ class SemanticsRewriter:
                 if funcname.idx == funcidx:
                     funcname_list.pop(_)
 
+        @queued
         def insert_func_name(self, funcidx, name):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             funcname_list = self.section_rewriter.get_namesec_funcname_list(namesec)
@@ -407,31 +440,37 @@ class SemanticsRewriter:
                     funcname_list.insert(_ + 1, NameAssoc(funcidx, name))
                     return
 
+        @queued
         def insert_global_name(self, globalidx, name):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             globalname_list = self.section_rewriter.get_namesec_globalname_list(namesec)
             globalname_list.insert(globalidx, NameAssoc(globalidx, name))
 
+        @queued
         def delete_global_name(self, globalidx):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             globalname_list = self.section_rewriter.get_namesec_globalname_list(namesec)
             globalname_list.pop(globalidx)
 
+        @queued
         def modify_global_name(self, globalidx, name):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             globalname_list = self.section_rewriter.get_namesec_globalname_list(namesec)
             globalname_list[globalidx].name = name
 
+        @queued
         def insert_data_name(self, dataidx, name):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             dataname_list = self.section_rewriter.get_namesec_dataname_list(namesec)
             dataname_list.insert(dataidx, NameAssoc(dataidx, name))
 
+        @queued
         def delete_data_name(self, dataidx):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             dataname_list = self.section_rewriter.get_namesec_dataname_list(namesec)
             dataname_list.pop(dataidx)
 
+        @queued
         def modify_data_name(self, dataidx, name):
             namesec = self.section_rewriter.get_customsec_custom(name="name")
             dataname_list = self.section_rewriter.get_namesec_dataname_list(namesec)
@@ -0,0 +1,115 @@
+import functools
+
+from BREWasm.parser.module import SecCodeID, section_attrs
+from BREWasm.parser.reader import decode_code_body
+from BREWasm.parser.snapshot import pack_value, unpack_value
+from BREWasm.rewriter.indices_fixer import IndicesFixer
+from BREWasm.rewriter.xref import XrefIndex
+
+
+class Transaction:
+    # Rewriter calls made inside `with Transaction(module):` are queued and replayed in order when the block
+    # exits. The index shifts of the replayed edits are held back and applied to the module in a single pass
+    # at the end, so a run of inserts walks the code section once instead of once per insert. An exception
+    # inside the block drops the queue and leaves the module as it was, and so does an edit raising when it
+    # is replayed: commit restores the module to its state before the replay and raises the error again.
+    #
+    # Queued calls return None, whatever they return outside a transaction, and selects inside the block
+    # still see the module as it was before it, not the edits queued so far. The arguments of a call are
+    # used when it is replayed, in the numbering left by the calls before it, the same as if the calls had
+    # been made one by one.
+
+    def __init__(self, module):
+        self.module = module
+        # (method, rewriter, args, kwargs) in call order
+        self.ops = []
+        self.replaying = False
+        self.fixer = IndicesFixer(module, deferred=True)
+
+    def __enter__(self):
+        if self.module._transaction is not None:
+            raise Exception("A transaction is already open on this module")
+        self.module._transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.ops = []
+            self.module._transaction = None
+            return False
+        self.commit()
+        return False
+
+    def commit(self):
+        # replay the queued edits; if one raises, the module is restored and the error raised again
+        state = self.save() if self.ops else None
+        self.replaying = True
+        try:
+            for method, rewriter, args, kwargs in self.ops:
+                method(rewriter, *args, **kwargs)
+            self.fixer.flush()
+        except BaseException:
+            self.restore(state)
+            raise
+        finally:
+            self.ops = []
+            self.replaying = False
+            self.module._transaction = None
+
+    def save(self):
+        # the decoded sections as copies, and each code as the values of its slots. A body that still has
+        # its encoded bytes is decoded again from them on restore instead of being copied here
+        module = self.module
+        sections = {}
+        for sec_id, name in section_attrs.items():
+            if sec_id != SecCodeID and module.is_decoded(sec_id):
+                sections[name] = pack_value(getattr(module, name))
+        codes = None
+        if module.is_decoded(SecCodeID):
+            codes = []
+            for code in module.code_sec:
+                body = None
+                if code.is_decoded() and code._encoded is None:
+                    body = pack_value([code._locals, code._expr])
+                codes.append((code, [getattr(code, name) for name in code.__slots__], body))
+        return sections, codes, set(module.dirty_secs)
+
+    def restore(self, state):
+        if state is None:
+            return
+        module = self.module
+        sections, codes, dirty_secs = state
+        for name, value in sections.items():
+            setattr(module, name, unpack_value(value))
+        if codes is not None:
+            module.code_sec = []
+            for code, values, body in codes:
+                for name, value in zip(code.__slots__, values):
+                    setattr(code, name, value)
+                if body is not None:
+                    code._locals, code._expr = unpack_value(body)
+                elif code.is_decoded():
+                    code._locals, code._expr = decode_code_body(code._encoded, 0, len(code._encoded),
+                                                                  code._flyweight)
+                module.code_sec.append(code)
+        module.dirty_secs = dirty_secs
+        module._type_index = None
+        module._import_index = None
+        module._export_index = None
+        module._import_counts = None
+        if module.xref is not None:
+            module.xref = None
+            XrefIndex.enable(module)
+
+
+def queued(method):
+    # the call is queued while a transaction is open on the module of the rewriter
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        transaction = self.module._transaction
+        if transaction is not None and not transaction.replaying:
+            transaction.ops.append((method, self, args, kwargs))
+            return None
+        return method(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,149 @@
+from BREWasm.parser.opcodes import *
+from BREWasm.parser.walker import Walker
+from BREWasm.rewriter.indices_fixer import SpaceFunc, SpaceType, SpaceGlobal
+
+# opcode -> index space of the sites kept by XrefIndex
+xref_immediates = {
+    Call: SpaceFunc,
+    RefFunc: SpaceFunc,
+    CallIndirect: SpaceType,
+    GlobalGet: SpaceGlobal,
+    GlobalSet: SpaceGlobal,
+}
+
+
+class XrefIndex:
+    # Where each function, type and global is referenced from the code section: funcidx -> call and ref.func
+    # sites, typeidx -> call_indirect sites, globalidx -> global.get/set sites. A site is (code, instr) with
+    # instr the Instruction object inside code.expr.
+    #
+    # Built in one pass by enable and kept up to date by IndicesFixer, which renumbers functions and globals
+    # through it instead of walking every body. Bodies added, removed or replaced (code.expr set to a new
+    # list) since the last use are picked up by sync; instructions changed in place inside a body that is
+    # kept have to go through rescan.
+
+    def __init__(self, module):
+        self.module = module
+        # space -> idx -> {id(instr): site}, site = [code, instr, key]
+        self.sites = {SpaceFunc: {}, SpaceType: {}, SpaceGlobal: {}}
+        # id(code) -> (code, expr, [(space, site)]) of the bodies scanned
+        self.codes = {}
+        self.sync()
+
+    @staticmethod
+    def enable(module):
+        if module.xref is None:
+            module.xref = XrefIndex(module)
+        return module.xref
+
+    def get(self, space, idx):
+        # the (code, instr) sites referencing idx of the space; the instructions may be edited in place, so
+        # the bodies they are in are encoded again on emit
+        self.sync()
+        sites = [(site[0], site[1]) for site in self.sites[space].get(idx, {}).values()]
+        for code, instr in sites:
+            code.invalidate()
+        return sites
+
+    def get_callers(self, funcidx):
+        return self.get(SpaceFunc, funcidx)
+
+    def sync(self):
+        current = {}
+        for code in self.module.code_sec:
+            current[id(code)] = code
+        for key in [key for key in self.codes if key not in current]:
+            self.drop(self.codes[key][0])
+        for key, code in current.items():
+            entry = self.codes.get(key)
+            if entry is None or entry[1] is not code.peek_expr():
+                self.rescan(code)
+
+    def rescan(self, code):
+        self.drop(code)
+        entries = []
+
+        def add(instr):
+            site = [code, instr, instr.args]
+            space = xref_immediates[instr.opcode]
+            self.add_site(space, site)
+            entries.append((space, site))
+
+        expr = code.peek_expr()
+        Walker().on(list(xref_immediates), add).walk(expr)
+        self.codes[id(code)] = (code, expr, entries)
+
+    def drop(self, code):
+        entry = self.codes.pop(id(code), None)
+        if entry is None:
+            return
+        for space, site in entry[2]:
+            sites = self.sites[space].get(site[2])
+            if sites is not None:
+                sites.pop(id(site[1]), None)
+                if not sites:
+                    del self.sites[space][site[2]]
+
+    def add_site(self, space, site):
+        sites = self.sites[space].get(site[2])
+        if sites is None:
+            sites = self.sites[space][site[2]] = {}
+        sites[id(site[1])] = site
+
+    def move(self, space, site, new_idx):
+        # point the instruction of site at new_idx and file it under it
+        sites = self.sites[space][site[2]]
+        del sites[id(site[1])]
+        if not sites:
+            del self.sites[space][site[2]]
+        site[1].args = new_idx
+        site[2] = new_idx
+        self.add_site(space, site)
+
+    def retarget(self, space, idx, new_idx, opcode=None, skip=None):
+        # point the sites of idx at new_idx, those of opcode only and outside the body skip when given;
+        # returns the codes changed
+        self.sync()
+        changed = {}
+        for site in list(self.sites[space].get(idx, {}).values()):
+            if (opcode is None or site[1].opcode == opcode) and site[0] is not skip:
+                self.move(space, site, new_idx)
+                changed[id(site[0])] = site[0]
+        return changed.values()
+
+    def remap(self, space, shifts, get_shifts=None):
+        # renumber the sites of space for the IndexShifts, or for get_shifts(code) when the shifts differ
+        # between bodies. Only the sites at or above the lowest shifted index are visited; returns the codes
+        # changed
+        low = min(shift_idx for _, shift_idx, _ in shifts.shifts)
+        remapped = {}
+        changed = {}
+        for idx, sites in self.sites[space].items():
+            if idx < low:
+                self.merge(remapped, idx, sites)
+            elif get_shifts is None:
+                new_idx = shifts.map(idx)
+                if new_idx != idx:
+                    for site in sites.values():
+                        site[1].args = new_idx
+                        site[2] = new_idx
+                        changed[id(site[0])] = site[0]
+                self.merge(remapped, new_idx, sites)
+            else:
+                for key, site in sites.items():
+                    code_shifts = get_shifts(site[0])
+                    new_idx = code_shifts.map(idx) if code_shifts is not None else idx
+                    if new_idx != idx:
+                        site[1].args = new_idx
+                        site[2] = new_idx
+                        changed[id(site[0])] = site[0]
+                    self.merge(remapped, new_idx, {key: site})
+        self.sites[space] = remapped
+        return changed.values()
+
+    @staticmethod
+    def merge(remapped, idx, sites):
+        if idx in remapped:
+            remapped[idx].update(sites)
+        else:
+            remapped[idx] = sites
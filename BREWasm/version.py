@@ -0,0 +1,2 @@
+# the release of the package, kept in step with setup.py
+__version__ = "1.0.9"
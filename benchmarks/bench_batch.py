@@ -0,0 +1,51 @@
+# Inserting many functions one call at a time against the same calls inside a transaction, where the
+# index fixup of all the inserts walks the code section once at the end. Both runs emit the same module.
+#
+#   python benchmarks/bench_batch.py [functions] [instructions per function] [inserts]
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm import BREWasm, SemanticsRewriter
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Call, Drop, I32Const
+
+
+def insert_functions(binary, inserts, batched):
+    function = SemanticsRewriter.Function(binary.module)
+    n_funcs = len(binary.module.code_sec)
+    start = time.perf_counter()
+    if batched:
+        with binary.batch():
+            for i in range(inserts):
+                function.insert_internal_function(i * 7 % n_funcs, ["i32"], [], [],
+                                                  [Instruction(I32Const, i), Instruction(Call, i), Instruction(Drop)])
+    else:
+        for i in range(inserts):
+            function.insert_internal_function(i * 7 % n_funcs, ["i32"], [], [],
+                                              [Instruction(I32Const, i), Instruction(Call, i), Instruction(Drop)])
+    return time.perf_counter() - start
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    inserts = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    with tempfile.TemporaryDirectory() as tmp:
+        source = write_module(make_module(n_funcs, length, "call"), os.path.join(tmp, "source.wasm"))
+        outs = []
+        for name, batched in [("one by one", False), ("transaction", True)]:
+            binary = BREWasm(source)
+            print("%-12s %7.3f s" % (name, insert_functions(binary, inserts, batched)))
+            outs.append(os.path.join(tmp, name.replace(" ", "_") + ".wasm"))
+            binary.emit_binary(outs[-1])
+        print("same output:", filecmp.cmp(outs[0], outs[1], shallow=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Loading a module through a ParseCache against parsing it: the first load parses and stores the entry,
+# the later ones are hits. A hit builds the Instruction trees on first access, so the time to get every
+# tree is given separately.
+#
+#   python benchmarks/bench_cache.py [functions] [instructions per function] [loads]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm.parser import reader
+from BREWasm.parser.cache import ParseCache
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def load(path, cache=None):
+    module, err = reader.decode_file(path, cache=cache)
+    if err is not None:
+        raise err
+    return module
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    loads = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ParseCache(os.path.join(tmp, "cache"))
+        for kind in ["call", "nested"]:
+            path = write_module(make_module(n_funcs, length, kind), os.path.join(tmp, kind + ".wasm"))
+            parse_time = min(timed(lambda: load(path))[0] for _ in range(loads))
+            store_time, _ = timed(lambda: load(path, cache))
+            hit_time = min(timed(lambda: load(path, cache))[0] for _ in range(loads))
+            module = load(path, cache)
+            trees_time, _ = timed(lambda: [code.expr for code in module.code_sec])
+            print("%s: %d bytes, cache %d bytes" % (kind, os.path.getsize(path), cache.get_size()[1]))
+            print("  parse %8.1f ms   miss+store %8.1f ms   hit %8.1f ms   hit+trees %8.1f ms" % (
+                parse_time * 1000, store_time * 1000, hit_time * 1000, (hit_time + trees_time) * 1000))
+        print("hits %d, misses %d, evictions %d" % (cache.hits, cache.misses, cache.evictions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Decode time per instruction for call-heavy, SIMD-heavy and nested synthetic modules.
+#
+#   python benchmarks/bench_decode.py [functions] [instructions per function]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module, count_instructions, BODIES
+from BREWasm.parser import reader
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in BODIES:
+            path = write_module(make_module(n_funcs, length, kind), os.path.join(tmp, kind + ".wasm"))
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                module, err = reader.decode_file(path, buffered=True)
+                elapsed = time.perf_counter() - start
+                if err is not None:
+                    raise err
+                best = elapsed if best is None else min(best, elapsed)
+            n = sum(count_instructions(code.expr) for code in module.code_sec)
+            print("%-7s %9d instructions   %7.3f s   %6.0f ns/instr" % (kind, n, best, best / n * 1e9))
+
+
+if __name__ == "__main__":
+    main()
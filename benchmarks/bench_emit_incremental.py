@@ -0,0 +1,46 @@
+# Edit/emit loop: each round rewrites one function and emits the module again.
+# Only the bodies edited so far are encoded, the others are copied from their bytes in the source file.
+#
+#   python benchmarks/bench_emit_incremental.py [functions] [instructions per function] [rounds]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm import BREWasm, SectionRewriter, Code
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Nop
+
+
+def edit_emit_loop(binary, out, rounds, invalidate_all):
+    code_rewriter = SectionRewriter(binary.module, codesec=binary.module.code_sec)
+    n_funcs = len(binary.module.code_sec)
+    start = time.perf_counter()
+    for i in range(rounds):
+        funcidx = i * 7 % n_funcs
+        code = code_rewriter.select(Code(funcidx=funcidx))[0]
+        code.instr_list.insert(0, Instruction(Nop))
+        code_rewriter.update(Code(funcidx=funcidx), Code(instr_list=code.instr_list))
+        if invalidate_all:
+            for item in binary.module.code_sec:
+                item.invalidate()
+        binary.emit_binary(out)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        source = write_module(make_module(n_funcs, length), os.path.join(tmp, "source.wasm"))
+        out = os.path.join(tmp, "out.wasm")
+        print("%-18s %7.3f s/round" % ("cached bodies", edit_emit_loop(BREWasm(source), out, rounds, False)))
+        print("%-18s %7.3f s/round" % ("re-encode all", edit_emit_loop(BREWasm(source), out, rounds, True)))
+
+
+if __name__ == "__main__":
+    main()
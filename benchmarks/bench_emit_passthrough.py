@@ -0,0 +1,44 @@
+# Emit time of a decoded module when nothing, one export or everything has changed.
+# Sections the rewriters did not touch are copied from the source file (copy_clean).
+#
+#   python benchmarks/bench_emit_passthrough.py [functions] [instructions per function]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm import BREWasm, SectionRewriter, Export
+
+
+def time_emit(binary, path):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        binary.emit_binary(path, copy_clean=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    with tempfile.TemporaryDirectory() as tmp:
+        source = write_module(make_module(n_funcs, length), os.path.join(tmp, "source.wasm"))
+        out = os.path.join(tmp, "out.wasm")
+        binary = BREWasm(source, lazy=True)
+        print("%-14s %7.3f s" % ("unchanged", time_emit(binary, out)))
+        SectionRewriter(binary.module, exportsec=binary.module.export_sec).update(Export(exportidx=0),
+                                                                                 Export(name="renamed"))
+        print("%-14s %7.3f s" % ("one export", time_emit(binary, out)))
+        binary = BREWasm(source)
+        for sec_id in range(13):
+            binary.module.mark_dirty(sec_id)
+        print("%-14s %7.3f s" % ("all sections", time_emit(binary, out)))
+
+
+if __name__ == "__main__":
+    main()
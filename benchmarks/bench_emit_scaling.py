@@ -0,0 +1,49 @@
+# Emit time as the module grows, up to 10k functions and up to 80k instructions in one body.
+# With linear emission the time per instruction stays flat across each series.
+#
+#   python benchmarks/bench_emit_scaling.py [max functions] [instructions per function]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, count_instructions
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def time_emit(module, path):
+    module.path = path
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        ModifyBinary(module, path).emit_binary(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sum(count_instructions(code.expr) for code in module.code_sec)
+
+
+def report(label, best, n):
+    print("%-24s %9d instructions   %7.3f s   %6.0f ns/instr" % (label, n, best, best / n * 1e9))
+
+
+def main():
+    max_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "scaling.wasm")
+        n_funcs = max_funcs // 8
+        while n_funcs <= max_funcs:
+            best, n = time_emit(make_module(n_funcs, length), path)
+            report("%d functions" % n_funcs, best, n)
+            n_funcs *= 2
+        body_length = 10000
+        while body_length <= 80000:
+            best, n = time_emit(make_module(1, body_length), path)
+            report("1 function x %d" % body_length, best, n)
+            body_length *= 2
+
+
+if __name__ == "__main__":
+    main()
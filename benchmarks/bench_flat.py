@@ -0,0 +1,103 @@
+# Whole-module analyses over FlatCode columns against the same analyses walking the Instruction trees: an
+# opcode histogram, a scan for the call sites and a renumbering of the called functions. Decoding the code
+# section both ways is timed too, the columns straight from the bytes by the reader.
+#
+#   python benchmarks/bench_flat.py [functions] [instructions per function]
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm.parser import reader
+from BREWasm.parser.opcodes import Call
+from BREWasm.parser.walker import Walker
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def tree_histogram(exprs):
+    histogram = Counter()
+
+    def count(instr):
+        histogram[instr.opcode] += 1
+
+    walker = Walker().on(None, count)
+    for expr in exprs:
+        walker.walk(expr)
+    return histogram
+
+
+def tree_calls(exprs):
+    sites = []
+    walker = Walker().on(Call, sites.append)
+    for expr in exprs:
+        walker.walk(expr)
+    return len(sites)
+
+
+def call_targets(expr):
+    targets = []
+    Walker().on(Call, lambda instr: targets.append(instr.args)).walk(expr)
+    return targets
+
+
+def tree_remap(exprs, shift):
+    def remap(instr):
+        instr.args = shift(instr.args)
+
+    walker = Walker().on(Call, remap)
+    for expr in exprs:
+        walker.walk(expr)
+
+
+def flat_histogram(flats):
+    histogram = Counter()
+    for flat in flats:
+        histogram.update(flat.opcodes)
+    return histogram
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    def shift(idx):
+        return idx + 1 if idx >= n_funcs // 2 else idx
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in ["call", "nested"]:
+            path = write_module(make_module(n_funcs, length, kind), os.path.join(tmp, kind + ".wasm"))
+            module, err = reader.decode_file(path, lazy=True)
+            tree_decode, exprs = timed(lambda: [code.expr for code in module.code_sec])
+            module, err = reader.decode_file(path, lazy=True)
+            flat_decode, flats = timed(lambda: [code.get_flat() for code in module.code_sec])
+            rows = [("decode", tree_decode, flat_decode, None)]
+            tree_time, tree_result = timed(lambda: tree_histogram(exprs))
+            flat_time, flat_result = timed(lambda: flat_histogram(flats))
+            # the columns count the Else_ and End_ rows the tree has no instructions for
+            same = all(tree_result[opcode] == count for opcode, count in flat_result.items() if opcode in tree_result)
+            rows.append(("histogram", tree_time, flat_time, same))
+            tree_time, tree_result = timed(lambda: tree_calls(exprs))
+            flat_time, flat_result = timed(lambda: sum(len(flat.find(Call)) for flat in flats))
+            rows.append(("call sites", tree_time, flat_time, tree_result == flat_result))
+            tree_time, _ = timed(lambda: tree_remap(exprs, shift))
+            flat_time, _ = timed(lambda: [flat.remap(Call, shift) for flat in flats])
+            same = all(call_targets(expr) == [flat.imms[row] for row in flat.find(Call)]
+                       for expr, flat in zip(exprs, flats))
+            rows.append(("remap calls", tree_time, flat_time, same))
+            print("%s: %d functions x %d instructions" % (kind, n_funcs, length))
+            for label, tree_time, flat_time, same in rows:
+                print("  %-12s tree %8.1f ms   columns %8.1f ms   %s" % (
+                    label, tree_time * 1000, flat_time * 1000, "" if same is None else "same: %s" % same))
+
+
+if __name__ == "__main__":
+    main()
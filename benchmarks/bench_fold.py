@@ -0,0 +1,93 @@
+# Flattening a code body to the End_/Else_ form of SectionRewriter.select and folding it back, on long and
+# deeply nested functions. The previous recursive version is timed alongside where its recursion allows;
+# it only handles Block and Loop, so the bodies compared with it have no If.
+#
+#   python benchmarks/bench_fold.py [instructions] [max depth]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import nested_body, count_instructions
+from BREWasm import SectionRewriter
+from BREWasm.parser.instruction import Instruction, BlockArgs
+from BREWasm.parser.module import Module
+from BREWasm.parser.opcodes import Block, Loop, End_, Call, Drop
+from BREWasm.parser.types import BlockTypeEmpty
+
+
+def recursive_flat(instrs):
+    ret_instrs = []
+    for i in instrs:
+        ret_instrs.append(i)
+        if i.opcode in [Block, Loop]:
+            ret_instrs.extend(recursive_flat(i.args.instrs))
+            ret_instrs.append(Instruction(End_))
+    return ret_instrs
+
+
+def block_length(instrs):
+    depth = 0
+    for i, instr in enumerate(instrs):
+        if instr.opcode in [Block, Loop]:
+            depth += 1
+        elif instr.opcode == End_:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+
+
+def recursive_fold(instrs):
+    ret_instrs = []
+    i = 0
+    while i < len(instrs):
+        if instrs[i].opcode in [Block, Loop]:
+            length = block_length(instrs[i:]) - 2
+            instrs[i].args.instrs = recursive_fold(instrs[i + 1: i + 1 + length])
+            ret_instrs.append(instrs[i])
+            i += length + 2
+        else:
+            ret_instrs.append(instrs[i])
+            i += 1
+    return ret_instrs
+
+
+def block_body(length, depth):
+    inner = []
+    for i in range(max(length - depth, 0) // 2):
+        inner.append(Instruction(Call, 0))
+        inner.append(Instruction(Drop))
+    for _ in range(depth):
+        inner = [Instruction(Block, BlockArgs(BlockTypeEmpty, inner))]
+    return inner
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    max_depth = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    rewriter = SectionRewriter(Module(), codesec=[])
+    print("%-8s %6s %9s %10s %10s %10s %10s" % ("body", "depth", "instrs", "flat", "fold", "old flat", "old fold"))
+    for depth in [1, 30, 300, max_depth]:
+        for kind in ["block", "nested"]:
+            body = block_body(length, depth) if kind == "block" else nested_body(0, 1, length, depth)
+            n = count_instructions(body)
+            flat_time, flat = timed(rewriter.get_flat_instrs, body)
+            fold_time, _ = timed(rewriter.get_fold_instrs, flat)
+            old = ["", ""]
+            if kind == "block" and depth < sys.getrecursionlimit() - 100:
+                old_flat_time, old_flat = timed(recursive_flat, body)
+                old_fold_time, _ = timed(recursive_fold, old_flat)
+                old = ["%8.1fms" % (old_flat_time * 1000), "%8.1fms" % (old_fold_time * 1000)]
+            print("%-8s %6d %9d %8.1fms %8.1fms %10s %10s" % (kind, depth, n, flat_time * 1000, fold_time * 1000,
+                                                               old[0], old[1]))
+
+
+if __name__ == "__main__":
+    main()
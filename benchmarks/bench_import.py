@@ -0,0 +1,44 @@
+# Measure import time and peak RSS of the opcode registry in a fresh interpreter.
+#
+#   python benchmarks/bench_import.py [runs]
+#
+# The "legacy" row allocates the former 16M-slot opnames list on top of the
+# same import, which is what every process paid before the compact registry.
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = '''
+import resource, time
+t = time.perf_counter()
+import BREWasm.parser.opnames
+%s
+t = time.perf_counter() - t
+print(t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+CASES = {
+    "registry": "",
+    "legacy": 'legacy = [""] * 0xFFFFFF',
+}
+
+
+def run(code):
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT)
+    seconds, rss = out.split()
+    return float(seconds), int(rss)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, extra in CASES.items():
+        results = [run(SNIPPET % extra) for _ in range(runs)]
+        best = min(r[0] for r in results)
+        rss = max(r[1] for r in results)
+        print("%-10s import %8.2f ms   max rss %8.1f MB" % (name, best * 1000, rss / 1024))
+
+
+if __name__ == "__main__":
+    main()
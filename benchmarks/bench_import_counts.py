@@ -0,0 +1,59 @@
+# Translating function indices to code entries on a module with many imports. Each select of a Code or
+# Function counts the function imports to find its code entry; with the counts cached on Module that is a
+# lookup, without them (the cache dropped before every select) a scan of the import section.
+#
+#   python benchmarks/bench_import_counts.py [functions] [imports] [selects]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module
+from BREWasm import SectionRewriter, Code, Function
+from BREWasm.parser.module import Import, ImportDesc, ImportTagFunc, ImportTagGlobal, SecImportID
+from BREWasm.parser.types import GlobalType, ValTypeI32
+
+
+def add_imports(module, n_imports):
+    # function imports with every fourth a global in between
+    for i in range(n_imports):
+        if i % 4 == 3:
+            desc = ImportDesc(tag=ImportTagGlobal, global_type=GlobalType(ValTypeI32, 0))
+        else:
+            desc = ImportDesc(tag=ImportTagFunc, func_type=0)
+        module.import_sec.append(Import("env", "import%d" % i, desc))
+
+
+def run(module, selects, cached):
+    function_rewriter = SectionRewriter(module, funcsec=module.func_sec)
+    code_rewriter = SectionRewriter(module, codesec=module.code_sec)
+    import_func_num = module.get_import_func_num()
+    n_funcs = len(module.code_sec)
+    found = 0
+    start = time.perf_counter()
+    for i in range(selects):
+        funcidx = import_func_num + i * 7 % n_funcs
+        if not cached:
+            module.drop_index(SecImportID)
+        found += len(function_rewriter.select(Function(funcidx=funcidx)))
+        if not cached:
+            module.drop_index(SecImportID)
+        found += len(code_rewriter.select(Code(funcidx=funcidx)))
+    return time.perf_counter() - start, found
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_imports = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    selects = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    module = make_module(n_funcs, 20, "call")
+    add_imports(module, n_imports)
+    for cached in [False, True]:
+        elapsed, found = run(module, selects, cached)
+        print("%-8s %8.1f us/select pair   %d found" % ("cached" if cached else "scan", elapsed / selects * 1e6,
+                                                        found))
+
+
+if __name__ == "__main__":
+    main()
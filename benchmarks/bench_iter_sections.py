@@ -0,0 +1,70 @@
+# Corpus-scanner style queries with reader.iter_sections against decoding the module: the exports (the
+# scan stops at the export section) and the total size of the function bodies. Peak Python memory of each
+# query is measured with tracemalloc.
+#
+#   python benchmarks/bench_iter_sections.py [functions] [instructions per function]
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm.parser import reader
+from BREWasm.parser.module import SecExportID, SecCodeID
+
+
+def measured(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def decoded(path, lazy):
+    module, err = reader.decode_file(path, lazy=lazy)
+    if err is not None:
+        raise err
+    return module
+
+
+def iter_exports(path):
+    for sec_id, byte_range, payload in reader.iter_sections(path):
+        if sec_id == SecExportID:
+            return [export.name for export in payload]
+    return []
+
+
+def iter_code_size(path):
+    return sum(end - start for sec_id, (start, end), payload in reader.iter_sections(path) if sec_id == SecCodeID)
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_module(make_module(n_funcs, length, "call"), os.path.join(tmp, "call.wasm"))
+        print("%d bytes of wasm" % os.path.getsize(path))
+        for query, scan, lazy_decode, full_decode in [
+            ("exports", lambda: iter_exports(path),
+             lambda: [export.name for export in decoded(path, True).export_sec],
+             lambda: [export.name for export in decoded(path, False).export_sec]),
+            ("code size", lambda: iter_code_size(path),
+             lambda: sum(code._body_end - code._body_start for code in decoded(path, True).code_sec),
+             lambda: sum(code._body_end - code._body_start for code in decoded(path, False).code_sec)),
+        ]:
+            results = []
+            for label, fn in [("iter_sections", scan), ("lazy decode", lazy_decode), ("decode", full_decode)]:
+                elapsed, peak, result = measured(fn)
+                results.append(result)
+                print("  %-9s %-13s %8.2f ms   peak %9d bytes" % (query, label, elapsed * 1000, peak))
+            print("  %-9s same: %s" % (query, results[0] == results[1] == results[2]))
+
+
+if __name__ == "__main__":
+    main()
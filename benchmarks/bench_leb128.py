@@ -0,0 +1,44 @@
+# Micro-benchmarks of the LEB128 decoders for 1-, 2- and 5-byte encodings.
+#
+#   python benchmarks/bench_leb128.py
+#
+# "stream" is the per-byte file-object decoder, "offset" the buffer-offset decoder used by the readers.
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BREWasm.parser.leb128 import decode_var_uint, decode_var_int, decode_var_uint_at, decode_var_int_at
+
+NUMBER = 200000
+
+CASES = [
+    ("u32 1 byte", b"\x2a", False),
+    ("u32 2 bytes", b"\xe5\x0e", False),
+    ("u32 5 bytes", b"\xff\xff\xff\xff\x0f", False),
+    ("s32 1 byte", b"\x7b", True),
+    ("s32 2 bytes", b"\xc0\x7b", True),
+    ("s32 5 bytes", b"\x80\x80\x80\x80\x78", True),
+]
+
+
+def main():
+    for name, data, signed in CASES:
+        stream_decode = decode_var_int if signed else decode_var_uint
+        offset_decode = decode_var_int_at if signed else decode_var_uint_at
+        stream = io.BytesIO(data)
+
+        def run_stream():
+            stream.seek(0)
+            stream_decode(stream, 32)
+
+        t_stream = timeit.timeit(run_stream, number=NUMBER)
+        t_offset = timeit.timeit(lambda: offset_decode(data, 0, 32), number=NUMBER)
+        print("%-12s stream %7.1f ns   offset %7.1f ns   %5.2fx"
+              % (name, t_stream / NUMBER * 1e9, t_offset / NUMBER * 1e9, t_stream / t_offset))
+
+
+if __name__ == "__main__":
+    main()
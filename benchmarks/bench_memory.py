@@ -0,0 +1,81 @@
+# Bytes per instruction of the decoded code section. The bodies are decoded lazily so that only the
+# instruction trees are measured, with and without flyweight instructions, and then copied into classes
+# without __slots__ (the representation before they were added) to compare against. The copies share the
+# immediate values with the decoded trees, so the copy rows count the IR objects and lists only.
+#
+#   python benchmarks/bench_memory.py [functions] [instructions per function]
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module, count_instructions
+from BREWasm.parser import reader
+from BREWasm.parser.instruction import Instruction, get_shared_instruction
+
+dict_classes = {}
+
+
+def copy_ir(value, dict_backed, shared):
+    # copy of value with the IR objects as instances of classes with a __dict__ when dict_backed, and the
+    # instructions without immediates shared when shared
+    if isinstance(value, list):
+        return [copy_ir(item, dict_backed, shared) for item in value]
+    slots = getattr(type(value), "__slots__", None)
+    if not slots:
+        return value
+    if shared and type(value) is Instruction and value.args is None:
+        return get_shared_instruction(value.opcode)
+    if dict_backed:
+        cls = dict_classes.get(type(value))
+        if cls is None:
+            cls = dict_classes[type(value)] = type("Dict" + type(value).__name__, (), {})
+        copy = cls()
+    else:
+        copy = type(value).__new__(type(value))
+    for name in slots:
+        setattr(copy, name, copy_ir(getattr(value, name), dict_backed, shared))
+    return copy
+
+
+def measured(fn):
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def decode_bodies(path, flyweight):
+    module, err = reader.decode_file(path, lazy=True, flyweight=flyweight)
+    if err is not None:
+        raise err
+    size, _ = measured(lambda: [code.decode() for code in module.code_sec])
+    return size, [code.expr for code in module.code_sec]
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in ["call", "simd", "nested"]:
+            path = write_module(make_module(n_funcs, length, kind), os.path.join(tmp, kind + ".wasm"))
+            size, exprs = decode_bodies(path, False)
+            n = sum(count_instructions(expr) for expr in exprs)
+            rows = [("decoded", size)]
+            rows.append(("decoded, flyweight", decode_bodies(path, True)[0]))
+            rows.append(("copy, __dict__", measured(lambda: copy_ir(exprs, True, False))[0]))
+            rows.append(("copy, __slots__", measured(lambda: copy_ir(exprs, False, False))[0]))
+            rows.append(("copy, __slots__ + flyweight", measured(lambda: copy_ir(exprs, False, True))[0]))
+            print("%s: %d instructions" % (kind, n))
+            for label, size in rows:
+                print("  %-28s %8.1f bytes/instruction" % (label, size / n))
+
+
+if __name__ == "__main__":
+    main()
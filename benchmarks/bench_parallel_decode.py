@@ -0,0 +1,31 @@
+# Time reader.decode_file with the code section decoded by 1..N worker processes.
+#
+#   python benchmarks/bench_parallel_decode.py module.wasm [max_workers]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BREWasm.parser import reader
+
+
+def main():
+    path = sys.argv[1]
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    workers = 1
+    base = None
+    while workers <= max_workers:
+        start = time.perf_counter()
+        module, err = reader.decode_file(path, buffered=True, workers=workers)
+        elapsed = time.perf_counter() - start
+        if err is not None:
+            raise err
+        base = base or elapsed
+        print("workers %3d   %8.3f s   speedup %5.2fx   (%d functions)"
+              % (workers, elapsed, base / elapsed, len(module.code_sec)))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Jobs that only need a few sections, run on a module decoded in full and on one decoded with sections=:
+# renaming an export, and adding one. Each job loads the module, makes the edit and emits it.
+#
+#   python benchmarks/bench_sections.py [functions] [instructions per function]
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm import BREWasm
+from BREWasm.rewriter.defination import Export
+from BREWasm.rewriter.section_rewriter import SectionRewriter
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def rename_export(binary):
+    rewriter = SectionRewriter(binary.module, exportsec=binary.module.export_sec)
+    export = rewriter.select(Export())[0]
+    rewriter.update(Export(exportidx=export.exportidx), Export(name="renamed"))
+
+
+def add_export(binary):
+    rewriter = SectionRewriter(binary.module, exportsec=binary.module.export_sec)
+    rewriter.insert(None, Export(name="added", funcidx=0))
+
+
+def run(path, out, job, sections):
+    binary = BREWasm(path, sections=sections)
+    job(binary)
+    binary.emit_binary(out)
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        path = write_module(make_module(n_funcs, length, "call"), os.path.join(tmp, "call.wasm"))
+        print("%d bytes of wasm" % os.path.getsize(path))
+        full_out, partial_out = os.path.join(tmp, "full.wasm"), os.path.join(tmp, "partial.wasm")
+        for label, job in [("rename export", rename_export), ("add export", add_export)]:
+            full_time, _ = timed(lambda: run(path, full_out, job, None))
+            partial_time, _ = timed(lambda: run(path, partial_out, job, ["exportsec"]))
+            print("  %-14s all sections %8.1f ms   exportsec only %8.1f ms   same output: %s" % (
+                label, full_time * 1000, partial_time * 1000, filecmp.cmp(full_out, partial_out, shallow=False)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Keyed SectionRewriter selects (type by signature, export by name, import by module and name)
+# against the linear scans they replace.
+#
+#   python benchmarks/bench_select.py [items per section] [queries]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module
+from BREWasm import SectionRewriter, Type, Import, Export
+from BREWasm.parser.module import Import as OriginImport, ImportDesc
+from BREWasm.parser.types import FuncType, FtTag, ValTypeI32, ValTypeI64
+
+
+def scan_types(module, arg_types, ret_types):
+    return [idx for idx, item in enumerate(module.type_sec) if item.get_signature() == (arg_types, ret_types)]
+
+
+def scan_exports(module, name):
+    return [idx for idx, item in enumerate(module.export_sec) if item.name == name and item.desc.tag == 0]
+
+
+def scan_imports(module, module_name, name):
+    return [idx for idx, item in enumerate(module.import_sec)
+            if item.desc.func_type is not None and item.module == module_name and item.name == name]
+
+
+def best_of(fn, queries):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for query in queries:
+            fn(*query)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(queries)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    module = make_module(n * 10, 4)
+    # distinct signatures: i + 1 i32 params, i64 result
+    module.type_sec = [FuncType(FtTag, [ValTypeI32] * (i + 1), [ValTypeI64]) for i in range(n)]
+    module.import_sec = [OriginImport("env", "f%d" % i, ImportDesc(0, func_type=0)) for i in range(n)]
+    module.func_sec = [0] * len(module.code_sec)
+    types = SectionRewriter(module, typesec=module.type_sec)
+    exports = SectionRewriter(module, exportsec=module.export_sec)
+    imports = SectionRewriter(module, importsec=module.import_sec)
+
+    keys = [(n * 7 + 13 * q) % n for q in range(n_queries)]
+    type_queries = [(["i32"] * (k + 1), ["i64"]) for k in keys]
+    export_queries = [("f%d" % (k * 10),) for k in keys]
+    import_queries = [("env", "f%d" % k) for k in keys]
+
+    rows = [
+        ("type", lambda a, r: types.select(Type(arg_types=a, ret_types=r)),
+         lambda a, r: scan_types(module, a, r), type_queries),
+        ("export", lambda name: exports.select(Export(name=name)),
+         lambda name: scan_exports(module, name), export_queries),
+        ("import", lambda module_name, name: imports.select(Import(module=module_name, name=name)),
+         lambda module_name, name: scan_imports(module, module_name, name), import_queries),
+    ]
+    for label, select, scan, queries in rows:
+        print("%-7s %6d items   select %8.2f us   scan %8.2f us" % (
+            label, len(getattr(module, label + "_sec")), best_of(select, queries) * 1e6,
+            best_of(scan, queries) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Fanning a module out to worker processes that each count the instructions of a shard of its functions:
+# every task gets the module pickled, every task gets its snapshot, or the wasm bytes and body offsets are
+# published once in shared memory (BREWasm.map_functions) and each task decodes only its own bodies.
+#
+#   python benchmarks/bench_shared.py [functions] [instructions per function] [workers]
+import os
+import pickle
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module, count_instructions
+from BREWasm import BREWasm
+from BREWasm.parser.module import Module
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def count_shared(shared, funcidx):
+    return count_instructions(shared.get_code(funcidx).expr)
+
+
+def count_pickled(data, idxs):
+    module = pickle.loads(data)
+    return sum(count_instructions(module.code_sec[idx].expr) for idx in idxs)
+
+
+def count_snapshot(data, idxs):
+    module = Module.load_snapshot(data)
+    return sum(count_instructions(module.code_sec[idx].expr) for idx in idxs)
+
+
+def fan_out(fn, data, n_codes, workers, tasks):
+    shards = [range(n_codes * i // tasks, n_codes * (i + 1) // tasks) for i in range(tasks)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(future.result() for future in [executor.submit(fn, data, shard) for shard in shards])
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    tasks = workers * 4
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in ["call", "nested"]:
+            path = write_module(make_module(n_funcs, length, kind), os.path.join(tmp, kind + ".wasm"))
+            binary = BREWasm(path)
+            n_codes = len(binary.module.code_sec)
+            # the pool is started within each timing, map_functions starts its own
+            shared_time, counts = timed(lambda: binary.map_functions(count_shared, workers=workers))
+            rows = [("shared", shared_time, sum(counts.values()))]
+            snapshot_time, total = timed(lambda: fan_out(count_snapshot, binary.module.dump_snapshot(), n_codes,
+                                                         workers, tasks))
+            rows.append(("snapshot", snapshot_time, total))
+            pickle_time, total = timed(lambda: fan_out(count_pickled, pickle.dumps(binary.module), n_codes, workers,
+                                                       tasks))
+            rows.append(("pickle", pickle_time, total))
+            print("%s: %d bytes of wasm, %d workers, %d tasks" % (kind, os.path.getsize(path), workers, tasks))
+            for label, elapsed, total in rows:
+                print("  %-9s %8.1f ms   %d instructions" % (label, elapsed * 1000, total))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Module snapshots against pickle and a fresh parse: size, dump and load time, load with every Instruction
+# tree built, and a round trip of the module to a worker process that counts its instructions.
+#
+#   python benchmarks/bench_snapshot.py [functions] [instructions per function]
+import os
+import pickle
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module, count_instructions
+from BREWasm.parser import reader
+from BREWasm.parser.module import Module
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def count_snapshot(snapshot):
+    module = Module.load_snapshot(snapshot)
+    return sum(count_instructions(code.expr) for code in module.code_sec)
+
+
+def count_pickle(data):
+    module = pickle.loads(data)
+    return sum(count_instructions(code.expr) for code in module.code_sec)
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=1) as executor:
+        executor.submit(len, "").result()
+        for kind in ["call", "nested"]:
+            path = write_module(make_module(n_funcs, length, kind), os.path.join(tmp, kind + ".wasm"))
+            parse_time, (module, err) = timed(lambda: reader.decode_file(path))
+            print("%s: %d bytes of wasm, parse %.1f ms" % (kind, os.path.getsize(path), parse_time * 1000))
+            for label, dump, load, count in [("snapshot", Module.dump_snapshot, Module.load_snapshot, count_snapshot),
+                                             ("pickle", pickle.dumps, pickle.loads, count_pickle)]:
+                dump_time, data = timed(lambda: dump(module))
+                load_time, loaded = timed(lambda: load(data))
+                trees_time, _ = timed(lambda: [code.expr for code in loaded.code_sec])
+                ship_time, _ = timed(lambda: executor.submit(count, data).result())
+                print("  %-9s %9d bytes   dump %7.1f ms   load %7.1f ms   +trees %7.1f ms   to a worker %7.1f ms" % (
+                    label, len(data), dump_time * 1000, load_time * 1000, (load_time + trees_time) * 1000,
+                    ship_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
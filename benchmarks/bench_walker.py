@@ -0,0 +1,61 @@
+# Several analyses of the code section as separate walks and fused into one Walker, and a walk of a body
+# nested far beyond the recursion limit.
+#
+#   python benchmarks/bench_walker.py [functions] [instructions per function] [depth]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, nested_body
+from BREWasm.parser.opcodes import Call, CallIndirect, GlobalGet, GlobalSet, LocalGet, LocalSet
+from BREWasm.parser.walker import Walker
+
+
+def analyses():
+    # call targets, globals accessed, indirect call types and local reads
+    counts = {"calls": {}, "globals": set(), "indirect": set(), "locals": [0]}
+
+    def count_call(instr):
+        counts["calls"][instr.args] = counts["calls"].get(instr.args, 0) + 1
+
+    walkers = [
+        Walker().on(Call, count_call),
+        Walker().on([GlobalGet, GlobalSet], lambda instr: counts["globals"].add(instr.args)),
+        Walker().on(CallIndirect, lambda instr: counts["indirect"].add(instr.args)),
+        Walker().on([LocalGet, LocalSet], lambda instr: counts["locals"].__setitem__(0, counts["locals"][0] + 1)),
+    ]
+    return walkers, counts
+
+
+def run(module, fused):
+    walkers, counts = analyses()
+    if fused:
+        walkers = [Walker.fuse(*walkers)]
+    start = time.perf_counter()
+    for walker in walkers:
+        for code in module.code_sec:
+            walker.walk(code.expr)
+    return time.perf_counter() - start, counts
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    depth = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+    for kind in ["call", "nested"]:
+        module = make_module(n_funcs, length, kind)
+        separate, counts = run(module, False)
+        fused, fused_counts = run(module, True)
+        print("%-7s 4 walks %7.1f ms   fused %7.1f ms   same result: %s" % (
+            kind, separate * 1000, fused * 1000, counts == fused_counts))
+    ends = [0]
+    start = time.perf_counter()
+    Walker().on_end(lambda instr: ends.__setitem__(0, ends[0] + 1)).walk(nested_body(0, 1, 1000, depth))
+    print("depth %d (recursion limit %d): %d blocks closed in %.1f ms" % (
+        depth, sys.getrecursionlimit(), ends[0], (time.perf_counter() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Renumbering globals and hooking functions with and without the xref index. With it, a global insert
+# visits only the global.get/set sites of the shifted globals (none here, every body reads global 0) and a hook only the calls of the hooked
+# function, instead of every instruction of the module.
+#
+#   python benchmarks/bench_xref.py [functions] [instructions per function] [edits]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synth import make_module, write_module
+from BREWasm import BREWasm, SectionRewriter, SemanticsRewriter, Global
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Nop
+from BREWasm.parser.types import ValTypeI32
+
+
+def insert_globals(binary, edits):
+    global_rewriter = SectionRewriter(binary.module, globalsec=binary.module.global_sec)
+    # the synthetic bodies read global 0 without defining it, the inserts go behind it
+    global_rewriter.insert(None, Global(valtype=ValTypeI32, val=0))
+    global_rewriter.insert(None, Global(valtype=ValTypeI32, val=1))
+    start = time.perf_counter()
+    for i in range(edits):
+        global_rewriter.insert(Global(globalidx=1), Global(valtype=ValTypeI32, val=i))
+    return time.perf_counter() - start
+
+
+def insert_hooks(binary, edits):
+    function = SemanticsRewriter.Function(binary.module)
+    n_funcs = len(binary.module.code_sec)
+    start = time.perf_counter()
+    for i in range(edits):
+        function.insert_hook_function(i * 7 % n_funcs, i * 13 % n_funcs, [], [], [], [Instruction(Nop)])
+    return time.perf_counter() - start
+
+
+def main():
+    n_funcs = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    edits = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        source = write_module(make_module(n_funcs, length, "call"), os.path.join(tmp, "source.wasm"))
+        for name, edit in [("global insert", insert_globals), ("hook function", insert_hooks)]:
+            outs = []
+            for xref in [False, True]:
+                binary = BREWasm(source, xref=xref)
+                elapsed = edit(binary, edits)
+                out = os.path.join(tmp, "xref.wasm" if xref else "walk.wasm")
+                binary.emit_binary(out)
+                with open(out, "rb") as f:
+                    outs.append(f.read())
+                print("%-14s %-8s %8.2f ms/edit" % (name, "xref" if xref else "walk", elapsed / edits * 1000))
+            print("%-14s same output: %s" % (name, outs[0] == outs[1]))
+
+
+if __name__ == "__main__":
+    main()
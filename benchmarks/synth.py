@@ -0,0 +1,88 @@
+# Synthetic modules for the benchmarks, built as IR and written with ModifyBinary.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from BREWasm.parser.instruction import Instruction, BlockArgs, IfArgs, MemArg, MemLaneArg
+from BREWasm.parser.module import Module, Code, Locals, Export, ExportDesc, MagicNumber, Version
+from BREWasm.parser.opcodes import *
+from BREWasm.parser.types import FuncType, FtTag, ValTypeI32, BlockTypeEmpty
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def call_heavy_body(funcidx, n_funcs, length):
+    body = []
+    for i in range(length // 4):
+        body.append(Instruction(LocalGet, 0))
+        body.append(Instruction(Call, (funcidx * 7 + i) % n_funcs))
+        body.append(Instruction(GlobalGet, 0))
+        body.append(Instruction(Drop))
+    return body
+
+
+def simd_heavy_body(funcidx, n_funcs, length):
+    body = []
+    for i in range(length // 6):
+        body.append(Instruction(I32Const, i))
+        body.append(Instruction(V128Load, MemArg(4, 16)))
+        body.append(Instruction(V128Const, i * 0x0102030405060708))
+        body.append(Instruction(I32x4Add))
+        body.append(Instruction(I32x4ExtractLane, i % 4))
+        body.append(Instruction(Drop))
+    return body
+
+
+def nested_body(funcidx, n_funcs, length, depth=8):
+    # blocks, loops and ifs nested depth deep around straight-line code
+    inner = call_heavy_body(funcidx, n_funcs, max(length - 3 * depth, 4))
+    for level in range(depth):
+        if level % 3 == 0:
+            inner = [Instruction(Block, BlockArgs(BlockTypeEmpty, inner))]
+        elif level % 3 == 1:
+            inner = [Instruction(Loop, BlockArgs(BlockTypeEmpty, inner + [Instruction(Br, 1)]))]
+        else:
+            args = IfArgs()
+            args.bt = BlockTypeEmpty
+            args.instrs1 = inner
+            args.instrs2 = [Instruction(Nop)]
+            inner = [Instruction(LocalGet, 0), Instruction(If, args)]
+    return inner
+
+
+BODIES = {
+    "call": call_heavy_body,
+    "simd": simd_heavy_body,
+    "nested": nested_body,
+}
+
+
+def make_module(n_funcs, length, kind="call"):
+    module = Module()
+    module.magic = MagicNumber
+    module.version = Version
+    module.type_sec = [FuncType(FtTag, [ValTypeI32], [])]
+    module.func_sec = [0] * n_funcs
+    module.code_sec = [Code([Locals(2, ValTypeI32)], BODIES[kind](i, n_funcs, length)) for i in range(n_funcs)]
+    module.export_sec = [Export("f%d" % i, ExportDesc(0, i)) for i in range(0, n_funcs, 10)]
+    return module
+
+
+def write_module(module, path):
+    module.path = path
+    ModifyBinary(module, path).emit_binary(path)
+    return path
+
+
+def count_instructions(expr):
+    n = 0
+    stack = [expr]
+    while stack:
+        for instr in stack.pop():
+            n += 1
+            if instr.opcode in [Block, Loop]:
+                stack.append(instr.args.instrs)
+            elif instr.opcode == If:
+                stack.append(instr.args.instrs1)
+                stack.append(instr.args.instrs2)
+    return n
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from synth import make_module, write_module
+
+
+@pytest.fixture
+def wasm_path(tmp_path):
+    # a module of 20 functions with calls, global reads and exports, written to a file
+    return write_module(make_module(20, 40, "call"), str(tmp_path / "call.wasm"))
+
+
+@pytest.fixture
+def nested_path(tmp_path):
+    # a module of 20 functions with blocks, loops and ifs nested 8 deep
+    return write_module(make_module(20, 60, "nested"), str(tmp_path / "nested.wasm"))
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+from synth import make_module, write_module
+
+from BREWasm.parser import reader
+from BREWasm.parser.cache import ParseCache
+
+
+def decode(path, **kwargs):
+    module, err = reader.decode_file(path, **kwargs)
+    assert err is None
+    return module
+
+
+def test_hit_gives_the_same_module(wasm_path, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    module = decode(wasm_path, cache=cache)
+    cached = decode(wasm_path, cache=cache)
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert [export.name for export in cached.export_sec] == [export.name for export in module.export_sec]
+    for code, decoded in zip(cached.code_sec, module.code_sec):
+        assert [instr.opcode for instr in code.expr] == [instr.opcode for instr in decoded.expr]
+
+
+def test_partial_decode_is_not_stored(wasm_path, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    decode(wasm_path, cache=cache, sections=[7])
+    assert cache.get_size() == (0, 0)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    paths = [write_module(make_module(10 + i, 40), str(tmp_path / ("%d.wasm" % i))) for i in range(3)]
+    cache = ParseCache(str(tmp_path / "cache"))
+    decode(paths[0], cache=cache)
+    entry_size = cache.get_size()[1]
+    cache.max_bytes = entry_size * 5 // 2
+    os.utime(cache.get_entry_path(cache.get_key(open(paths[0], "rb").read())), ns=(0, 0))
+    decode(paths[1], cache=cache)
+    # a hit refreshes the first entry, the second is now the oldest
+    decode(paths[0], cache=cache)
+    os.utime(cache.get_entry_path(cache.get_key(open(paths[1], "rb").read())), ns=(0, 0))
+    decode(paths[2], cache=cache)
+    assert cache.evictions == 1
+    assert cache.get_size()[0] == 2
+    decode(paths[1], cache=cache)
+    assert cache.misses == 4
+
+
+def test_failed_store_leaves_no_file(wasm_path, tmp_path):
+    cache = ParseCache(str(tmp_path / "cache"))
+    module = decode(wasm_path)
+    module.export_sec.append(object())
+    with pytest.raises(Exception):
+        cache.store(open(wasm_path, "rb").read(), module)
+    assert os.listdir(str(tmp_path / "cache")) == []
@@ -0,0 +1,72 @@
+import pickle
+
+from synth import make_module, write_module
+
+from BREWasm import BREWasm
+from BREWasm.parser import reader
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Nop
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def decode(path, **kwargs):
+    module, err = reader.decode_file(path, **kwargs)
+    assert err is None
+    return module
+
+
+def test_edit_after_emit_of_module_built_in_memory(tmp_path):
+    module = make_module(2, 4, "call")
+    module.code_sec[0].expr = [Instruction(Nop)]
+    write_module(module, str(tmp_path / "a.wasm"))
+    module.code_sec[0].expr.append(Instruction(Nop))
+    write_module(module, str(tmp_path / "b.wasm"))
+    assert len(decode(str(tmp_path / "b.wasm")).code_sec[0].expr) == 2
+
+
+def test_edit_in_place_of_decoded_body(wasm_path, tmp_path):
+    for lazy in [False, True]:
+        binary = BREWasm(wasm_path, lazy=lazy)
+        n = len(binary.module.code_sec[3].expr)
+        binary.module.code_sec[3].expr.insert(0, Instruction(Nop))
+        binary.emit_binary(str(tmp_path / "out.wasm"))
+        assert len(decode(str(tmp_path / "out.wasm")).code_sec[3].expr) == n + 1
+
+
+def test_edit_in_place_after_emit(wasm_path, tmp_path):
+    binary = BREWasm(wasm_path, lazy=True)
+    binary.emit_binary(str(tmp_path / "a.wasm"))
+    expr = binary.module.code_sec[3].expr
+    n = len(expr)
+    binary.emit_binary(str(tmp_path / "b.wasm"))
+    expr.append(Instruction(Nop))
+    binary.emit_binary(str(tmp_path / "c.wasm"))
+    assert len(decode(str(tmp_path / "c.wasm")).code_sec[3].expr) == n + 1
+
+
+def test_untouched_bodies_are_copied(wasm_path, tmp_path):
+    binary = BREWasm(wasm_path, lazy=True)
+    binary.module.code_sec[0].peek_expr()
+    assert binary.module.code_sec[0].get_raw_body() is not None
+    binary.module.code_sec[1].expr
+    assert binary.module.code_sec[1].get_raw_body() is None
+    binary.emit_binary(str(tmp_path / "out.wasm"))
+    with open(wasm_path, "rb") as a, open(str(tmp_path / "out.wasm"), "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_direct_edit_of_decoded_section(wasm_path, tmp_path):
+    binary = BREWasm(wasm_path)
+    binary.module.export_sec[0].name = "renamed"
+    binary.emit_binary(str(tmp_path / "out.wasm"))
+    assert decode(str(tmp_path / "out.wasm")).export_sec[0].name == "renamed"
+    binary.emit_binary(str(tmp_path / "copied.wasm"), copy_clean=True)
+    assert decode(str(tmp_path / "copied.wasm")).export_sec[0].name == "f0"
+
+
+def test_pickle_of_lazy_module(nested_path, tmp_path):
+    loaded = pickle.loads(pickle.dumps(decode(nested_path, lazy=True)))
+    out = str(tmp_path / "out.wasm")
+    ModifyBinary(loaded, out).emit_binary(out, reencode=True)
+    with open(nested_path, "rb") as a, open(out, "rb") as b:
+        assert a.read() == b.read()
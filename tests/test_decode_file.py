@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from BREWasm import BREWasm
+from BREWasm.parser import reader
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Nop
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def emit(module, path):
+    # everything encoded again from the decoded module
+    ModifyBinary(module, path).emit_binary(path, reencode=True)
+    return read(path)
+
+
+def decode(path, **kwargs):
+    module, err = reader.decode_file(path, **kwargs)
+    assert err is None
+    return module
+
+
+def test_mapped_close_keeps_the_module_usable(wasm_path, tmp_path):
+    module = decode(wasm_path, mapped=True, lazy=True)
+    module.code_sec[1].peek_expr()
+    module.close()
+    assert module._mapping is None
+    assert emit(module, str(tmp_path / "out.wasm")) == read(wasm_path)
+    module.close()
+
+
+def test_mapped_context_manager(wasm_path, tmp_path):
+    with decode(wasm_path, mapped=True) as module:
+        n = len(module.code_sec[2].expr)
+    assert module._mapping is None
+    assert len(module.code_sec[2].expr) == n
+
+
+def test_mapped_close_with_views_in_use(wasm_path):
+    module = decode(wasm_path, mapped=True, lazy=True)
+    view = module.code_sec[0].get_raw_body()
+    with pytest.raises(Exception):
+        module.close()
+    view.release()
+
+
+def test_mapped_emit_over_source(wasm_path):
+    binary = BREWasm(wasm_path)
+    binary.module = decode(wasm_path, mapped=True, lazy=True)
+    binary.module.path = wasm_path
+    binary.module.code_sec[0].expr.append(Instruction(Nop))
+    n = len(binary.module.code_sec[0].expr)
+    binary.emit_binary(wasm_path)
+    assert binary.module._mapping is None
+    assert len(decode(wasm_path).code_sec[0].expr) == n
+    assert not os.path.exists(wasm_path + ".tmp")
+
+
+def test_buffered_round_trip(nested_path, tmp_path):
+    assert emit(decode(nested_path, buffered=True), str(tmp_path / "out.wasm")) == read(nested_path)
+    module, err = reader.decode(read(nested_path))
+    assert err is None
+    assert emit(module, str(tmp_path / "out.wasm")) == read(nested_path)
+
+
+def test_mapped_round_trip(nested_path, tmp_path):
+    with decode(nested_path, mapped=True) as module:
+        assert emit(module, str(tmp_path / "out.wasm")) == read(nested_path)
+
+
+def test_lazy_bodies(nested_path, tmp_path):
+    module = decode(nested_path, lazy=True)
+    assert not any(code.is_decoded() for code in module.code_sec)
+    # an untouched body is copied as it is, without being decoded
+    ModifyBinary(module, str(tmp_path / "copy.wasm")).emit_binary(str(tmp_path / "copy.wasm"))
+    assert read(str(tmp_path / "copy.wasm")) == read(nested_path)
+    assert not any(code.is_decoded() for code in module.code_sec)
+    assert emit(module, str(tmp_path / "out.wasm")) == read(nested_path)
+
+
+def test_workers(nested_path, tmp_path):
+    module = decode(nested_path, workers=2)
+    assert emit(module, str(tmp_path / "out.wasm")) == read(nested_path)
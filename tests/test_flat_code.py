@@ -0,0 +1,51 @@
+from BREWasm.parser import reader
+from BREWasm.parser.flat_code import FlatCode
+from BREWasm.parser.opcodes import Call
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def decode(path, **kwargs):
+    module, err = reader.decode_file(path, **kwargs)
+    assert err is None
+    return module
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_from_expr_to_expr_round_trip(nested_path, tmp_path):
+    module = decode(nested_path)
+    for code in module.code_sec:
+        code.expr = FlatCode.from_expr(code.expr).to_expr()
+    out = str(tmp_path / "out.wasm")
+    ModifyBinary(module, out).emit_binary(out, reencode=True)
+    assert read(out) == read(nested_path)
+
+
+def test_flat_of_undecoded_body_matches_the_tree(nested_path):
+    lazy = decode(nested_path, lazy=True)
+    module = decode(nested_path)
+    for lazy_code, code in zip(lazy.code_sec, module.code_sec):
+        flat = lazy_code.get_flat()
+        assert not lazy_code.is_decoded()
+        expected = FlatCode.from_expr(code.expr)
+        assert flat.opcodes == expected.opcodes
+        assert flat.imms == expected.imms
+        assert flat.depths == expected.depths
+        assert flat.matches == expected.matches
+
+
+def test_remap_and_set_flat(wasm_path, tmp_path):
+    module = decode(wasm_path, lazy=True)
+    code = module.code_sec[0]
+    flat = code.get_flat()
+    calls = flat.find(Call)
+    assert calls
+    assert flat.remap(Call, lambda funcidx: funcidx + 1) == len(calls)
+    code.set_flat(flat)
+    out = str(tmp_path / "out.wasm")
+    ModifyBinary(module, out).emit_binary(out)
+    expected = [instr.args + 1 for instr in decode(wasm_path).code_sec[0].expr if instr.opcode == Call]
+    assert [instr.args for instr in decode(out).code_sec[0].expr if instr.opcode == Call] == expected
@@ -0,0 +1,25 @@
+from BREWasm.parser import reader
+from BREWasm.parser.instruction import get_shared_instruction
+from BREWasm.parser.opcodes import Drop
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def decode(path, **kwargs):
+    module, err = reader.decode_file(path, **kwargs)
+    assert err is None
+    return module
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_instructions_without_immediates_are_shared(wasm_path, tmp_path):
+    for lazy in [False, True]:
+        module = decode(wasm_path, flyweight=True, lazy=lazy)
+        drops = [instr for code in module.code_sec for instr in code.expr if instr.opcode == Drop]
+        assert drops and all(instr is get_shared_instruction(Drop) for instr in drops)
+        out = str(tmp_path / "out.wasm")
+        ModifyBinary(module, out).emit_binary(out, reencode=True)
+        assert read(out) == read(wasm_path)
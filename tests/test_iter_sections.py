@@ -0,0 +1,47 @@
+import gc
+
+from BREWasm.parser import reader
+from BREWasm.parser.module import SecCodeID, SecExportID, SecTypeID
+
+
+def decode(path):
+    module, err = reader.decode_file(path)
+    assert err is None
+    return module
+
+
+def test_items_match_the_decoded_module(wasm_path):
+    module = decode(wasm_path)
+    codes = []
+    exports = None
+    for sec_id, (start, end), payload in reader.iter_sections(wasm_path):
+        if sec_id == SecCodeID:
+            codes.append(payload)
+        elif sec_id == SecExportID:
+            exports = [export.name for export in payload]
+        elif sec_id != 0:
+            assert (start, end) == (module.section_range[sec_id].start, module.section_range[sec_id].end)
+    assert exports == [export.name for export in module.export_sec]
+    assert len(codes) == len(module.code_sec)
+    # the bodies kept outlive the scan
+    for code, decoded in zip(codes, module.code_sec):
+        assert [instr.opcode for instr in code.expr] == [instr.opcode for instr in decoded.expr]
+
+
+def test_buffer(wasm_path):
+    with open(wasm_path, "rb") as f:
+        data = bytearray(f.read())
+    assert [item[0] for item in reader.iter_sections(data)] == [item[0] for item in reader.iter_sections(wasm_path)]
+    # the view of the scan is released, the buffer can be resized again
+    data.append(0)
+
+
+def test_scan_broken_off_releases_the_buffer(wasm_path):
+    with open(wasm_path, "rb") as f:
+        data = bytearray(f.read())
+    scan = reader.iter_sections(data)
+    sec_id, _, _ = next(scan)
+    assert sec_id == SecTypeID
+    scan.close()
+    gc.collect()
+    data.append(0)
@@ -0,0 +1,47 @@
+import os
+import re
+
+import pytest
+
+from BREWasm import BREWasm
+from BREWasm.parser import reader
+from BREWasm.parser.module import SecCodeID, SecExportID
+from BREWasm.rewriter.defination import Code, Export
+from BREWasm.rewriter.section_rewriter import SectionRewriter
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def rename_export(binary, out):
+    rewriter = SectionRewriter(binary.module, exportsec=binary.module.export_sec)
+    rewriter.update(Export(exportidx=0), Export(name="renamed"))
+    binary.emit_binary(out)
+    return read(out)
+
+
+def test_partial_decode_emits_the_same_as_a_full_one(wasm_path, tmp_path):
+    full = rename_export(BREWasm(wasm_path), str(tmp_path / "full.wasm"))
+    binary = BREWasm(wasm_path, sections=["exportsec"])
+    assert binary.module.undecoded_secs and not binary.module.is_decoded(SecCodeID)
+    assert rename_export(binary, str(tmp_path / "partial.wasm")) == full
+
+
+def test_undecoded_sections_raise_on_use(wasm_path):
+    module, err = reader.decode_file(wasm_path, sections=[SecExportID])
+    assert err is None
+    with pytest.raises(Exception, match="not decoded"):
+        len(module.code_sec)
+    with pytest.raises(Exception, match="not decoded"):
+        SectionRewriter(module, codesec=module.code_sec).delete(Code(funcidx=0))
+
+
+def test_changed_source_cannot_be_emitted(wasm_path, tmp_path):
+    binary = BREWasm(wasm_path, sections=["exportsec"])
+    with open(wasm_path, "ab") as f:
+        f.write(b"\0")
+    os.utime(wasm_path, ns=(0, 0))
+    with pytest.raises(Exception, match=re.escape(wasm_path)):
+        binary.emit_binary(str(tmp_path / "out.wasm"))
@@ -0,0 +1,43 @@
+from synth import count_instructions
+
+from BREWasm import BREWasm
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Nop
+from BREWasm.parser.shared import SharedModule
+from BREWasm.rewriter.defination import Code
+
+
+def count(shared, funcidx):
+    return count_instructions(shared.get_code(funcidx).expr)
+
+
+def prepend_nop(shared, funcidx):
+    if funcidx % 2:
+        return None
+    instrs = [Instruction(Nop)] + shared.get_code(funcidx).expr
+    return Code(local_vec=[], instr_list=instrs)
+
+
+def test_shared_bodies_match_the_module(nested_path):
+    binary = BREWasm(nested_path)
+    with SharedModule.publish(binary.module) as shared:
+        assert list(shared.get_funcidxs()) == list(range(len(binary.module.code_sec)))
+        for funcidx in shared.get_funcidxs():
+            assert count(shared, funcidx) == count_instructions(binary.module.code_sec[funcidx].expr)
+        assert len(shared.get_module().export_sec) == len(binary.module.export_sec)
+
+
+def test_map_functions(nested_path):
+    binary = BREWasm(nested_path)
+    counts = binary.map_functions(count, workers=2)
+    assert counts == {funcidx: count_instructions(code.expr) for funcidx, code in enumerate(binary.module.code_sec)}
+
+
+def test_rewrite_functions(wasm_path, tmp_path):
+    binary = BREWasm(wasm_path)
+    before = [len(code.expr) for code in binary.module.code_sec]
+    codes = binary.rewrite_functions(prepend_nop, workers=2)
+    assert sum(code is not None for code in codes.values()) == 10
+    binary.emit_binary(str(tmp_path / "out.wasm"))
+    after = [len(code.expr) for code in BREWasm(str(tmp_path / "out.wasm")).module.code_sec]
+    assert after == [n + (funcidx % 2 == 0) for funcidx, n in enumerate(before)]
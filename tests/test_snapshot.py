@@ -0,0 +1,19 @@
+from BREWasm.parser import reader
+from BREWasm.parser.module import Module
+from BREWasm.rewriter.modify_binary import ModifyBinary
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_snapshot_round_trip(nested_path, tmp_path):
+    for lazy in [False, True]:
+        module, err = reader.decode_file(nested_path, lazy=lazy)
+        assert err is None
+        loaded = Module.load_snapshot(module.dump_snapshot())
+        out = str(tmp_path / "out.wasm")
+        ModifyBinary(loaded, out).emit_binary(out)
+        assert read(out) == read(nested_path)
+
@@ -0,0 +1,56 @@
+import pytest
+
+from BREWasm import BREWasm, SectionRewriter, SemanticsRewriter
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Call, Drop, I32Const
+from BREWasm.rewriter.defination import Code, Export
+
+
+def insert_functions(binary, n):
+    function = SemanticsRewriter.Function(binary.module)
+    for i in range(n):
+        function.insert_internal_function(i * 7 % 20, ["i32"], [], [],
+                                          [Instruction(I32Const, i), Instruction(Call, i), Instruction(Drop)])
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_batch_emits_the_same_as_one_by_one(wasm_path, tmp_path):
+    binary = BREWasm(wasm_path)
+    insert_functions(binary, 5)
+    binary.emit_binary(str(tmp_path / "one.wasm"))
+    binary = BREWasm(wasm_path)
+    with binary.batch():
+        insert_functions(binary, 5)
+    binary.emit_binary(str(tmp_path / "batch.wasm"))
+    assert read(str(tmp_path / "one.wasm")) == read(str(tmp_path / "batch.wasm"))
+
+
+def test_queued_calls_return_none_and_selects_see_the_module_before_the_block(wasm_path):
+    binary = BREWasm(wasm_path)
+    rewriter = SectionRewriter(binary.module, exportsec=binary.module.export_sec)
+    n = len(rewriter.select(Export()))
+    with binary.batch():
+        assert rewriter.insert(None, Export(name="added", funcidx=0)) is None
+        assert len(rewriter.select(Export())) == n
+    assert len(rewriter.select(Export())) == n + 1
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_failed_replay_restores_the_module(wasm_path, tmp_path, lazy):
+    binary = BREWasm(wasm_path, lazy=lazy, xref=True)
+    binary.module.code_sec[0].expr
+    binary.emit_binary(str(tmp_path / "before.wasm"))
+    callers = len(binary.module.xref.get_callers(5))
+    with pytest.raises(Exception):
+        with binary.batch():
+            insert_functions(binary, 3)
+            SectionRewriter(binary.module, exportsec=binary.module.export_sec).insert(None, Export(name="x", funcidx=0))
+            SectionRewriter(binary.module, codesec=binary.module.code_sec).delete(Code(funcidx=999))
+    assert binary.module._transaction is None
+    assert len(binary.module.xref.get_callers(5)) == callers
+    binary.emit_binary(str(tmp_path / "after.wasm"))
+    assert read(str(tmp_path / "before.wasm")) == read(str(tmp_path / "after.wasm"))
@@ -0,0 +1,36 @@
+import sys
+
+from synth import count_instructions
+
+from BREWasm.parser import reader
+from BREWasm.parser.instruction import Instruction, BlockArgs
+from BREWasm.parser.opcodes import Block, Call, If, Loop, Nop
+from BREWasm.parser.types import BlockTypeEmpty
+from BREWasm.parser.walker import Walker
+
+
+def test_visitors_see_every_instruction(nested_path):
+    module, err = reader.decode_file(nested_path)
+    assert err is None
+    for code in module.code_sec:
+        seen = []
+        calls = []
+        ends = []
+        elses = []
+        walker = Walker.fuse(Walker().on(None, seen.append).on_end(ends.append),
+                             Walker().on(Call, calls.append).on_else(elses.append))
+        walker.walk(code.expr)
+        assert len(seen) == count_instructions(code.expr)
+        assert len(calls) == len([instr for instr in seen if instr.opcode == Call])
+        assert len(ends) == len([instr for instr in seen if instr.opcode in [Block, Loop, If]])
+        assert len(elses) == len([instr for instr in seen if instr.opcode == If])
+
+
+def test_nesting_deeper_than_the_recursion_limit():
+    expr = [Instruction(Nop)]
+    depth = sys.getrecursionlimit() * 2
+    for _ in range(depth):
+        expr = [Instruction(Block, BlockArgs(BlockTypeEmpty, expr))]
+    blocks = []
+    Walker().on(Block, blocks.append).walk(expr)
+    assert len(blocks) == depth
@@ -0,0 +1,48 @@
+from BREWasm import BREWasm, SemanticsRewriter
+from BREWasm.parser.instruction import Instruction
+from BREWasm.parser.opcodes import Call, Drop, GlobalGet, I32Const
+from BREWasm.parser.walker import Walker
+from BREWasm.rewriter.indices_fixer import SpaceGlobal
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def scan(module, opcode, idx):
+    sites = []
+    for code in module.code_sec:
+        Walker().on(opcode, lambda instr: instr.args == idx and sites.append(instr)).walk(code.peek_expr())
+    return sites
+
+
+def test_sites_match_a_full_scan(wasm_path):
+    binary = BREWasm(wasm_path, xref=True)
+    xref = binary.module.xref
+    for funcidx in range(20):
+        assert {id(instr) for _, instr in xref.get_callers(funcidx)} == \
+               {id(instr) for instr in scan(binary.module, Call, funcidx)}
+    assert len(xref.get(SpaceGlobal, 0)) == len(scan(binary.module, GlobalGet, 0))
+
+
+def test_renumbering_through_the_index(wasm_path, tmp_path):
+    outs = []
+    for xref in [False, True]:
+        binary = BREWasm(wasm_path, xref=xref)
+        function = SemanticsRewriter.Function(binary.module)
+        for i in range(3):
+            function.insert_internal_function(i * 5, ["i32"], [], [],
+                                              [Instruction(I32Const, i), Instruction(Call, i), Instruction(Drop)])
+        outs.append(str(tmp_path / ("%s.wasm" % xref)))
+        binary.emit_binary(outs[-1])
+        if xref:
+            for funcidx in range(23):
+                assert len(binary.module.xref.get_callers(funcidx)) == len(scan(binary.module, Call, funcidx))
+    assert read(outs[0]) == read(outs[1])
+
+
+def test_bodies_replaced_are_picked_up(wasm_path):
+    binary = BREWasm(wasm_path, xref=True)
+    binary.module.code_sec[0].expr = [Instruction(Call, 3)]
+    assert len(binary.module.xref.get_callers(3)) == len(scan(binary.module, Call, 3))